@@ -32,6 +32,7 @@ def main():  # pragma: no cover
         loop = asyncio.get_event_loop()
         resolver = STSResolver(loop=loop)
         result = loop.run_until_complete(resolver.resolve(args.domain, args.known_version))
+        loop.run_until_complete(resolver.close())
     print(result)
 
 
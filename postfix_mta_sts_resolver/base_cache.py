@@ -4,7 +4,18 @@ import collections
 from abc import ABC, abstractmethod
 
 
-CacheEntry = collections.namedtuple('CacheEntry', ('ts', 'pol_id', 'pol_body'))
+class CacheEntry(collections.namedtuple('CacheEntry', ('ts', 'pol_id', 'pol_body'))):
+    """ Cached policy of domain. Entry without policy body is negative: it
+    records the fact domain has no MTA-STS policy. """
+    __slots__ = ()
+
+    @property
+    def negative(self):
+        return self.pol_body is None
+
+
+def negative_entry(ts):  # pylint: disable=invalid-name
+    return CacheEntry(ts, None, None)
 
 
 class BaseCache(ABC):
@@ -20,6 +31,11 @@ class BaseCache(ABC):
     async def set(self, key, value):
         """ Abstract method """
 
+    def get_nowait(self, key):  # pylint: disable=unused-argument
+        """ Returns entry for key if it is readable without I/O, None otherwise.
+        Caches held in process memory override it. """
+        return None
+
     async def safe_set(self, domain, entry, logger):
         try:
             await self.set(domain, entry)
@@ -28,6 +44,66 @@ class BaseCache(ABC):
         except Exception as exc:  # pragma: no cover
             logger.exception("Cache set failed: %s", str(exc))
 
+    async def get_many(self, keys):
+        """ Returns list of entries for keys, None for missing ones.
+        Backends override it to fetch all keys in one round trip. """
+        return [await self.get(key) for key in keys]
+
+    async def set_many(self, items):
+        """ Stores (key, value) pairs.
+        Backends override it to store all pairs in one round trip. """
+        for key, value in items:
+            await self.set(key, value)
+
+    async def touch(self, key, ts):  # pylint: disable=invalid-name
+        """ Updates timestamp of cached entry if it is older than ts,
+        keeping its policy. Does nothing if there is no entry for key.
+        Backends override it to avoid rewrite of policy body. """
+        entry = await self.get(key)
+        if entry is not None and entry.ts < ts:
+            await self.set(key, entry._replace(ts=ts))
+
+    async def touch_many(self, items):
+        """ Updates timestamps of cached entries from (key, ts) pairs.
+        Backends override it to update all entries in one round trip. """
+        for key, ts in items:
+            await self.touch(key, ts)
+
+    async def safe_set_many(self, items, logger):
+        try:
+            await self.set_many(items)
+        except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
+            raise
+        except Exception as exc:  # pragma: no cover
+            logger.exception("Cache set failed: %s", str(exc))
+
+    async def safe_touch(self, domain, ts, logger):  # pylint: disable=invalid-name
+        try:
+            await self.touch(domain, ts)
+        except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
+            raise
+        except Exception as exc:  # pragma: no cover
+            logger.exception("Cache touch failed: %s", str(exc))
+
+    async def safe_touch_many(self, items, logger):
+        try:
+            await self.touch_many(items)
+        except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
+            raise
+        except Exception as exc:  # pragma: no cover
+            logger.exception("Cache touch failed: %s", str(exc))
+
+    async def publish(self, channel, messages):  # pylint: disable=unused-argument
+        """ Sends messages (strings) to instances subscribed to channel.
+        Backends shared by several hosts override it. """
+
+    async def subscribe(self, channel, callback):  # pylint: disable=unused-argument
+        """ Calls callback(message) for every message published to channel
+        until teardown. callback(None) is called when messages might have
+        been lost. Returns False if backend has no means to deliver
+        messages. """
+        return False
+
     @abstractmethod
     async def scan(self, token, amount_hint):
         """ Abstract method """
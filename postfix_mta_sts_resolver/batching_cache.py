@@ -0,0 +1,126 @@
+import asyncio
+import collections
+
+from .base_cache import BaseCache
+
+
+class BatchingCache(BaseCache):
+    """ Cache which merges concurrent reads of backend cache into batches.
+
+    Keys requested with get() are collected for `window` seconds (until
+    next event loop iteration if window is zero) or until `batch_size`
+    distinct keys are pending, and then fetched from backend with single
+    get_many() call. Concurrent reads of the same key share one lookup.
+    All other operations go to backend directly. """
+
+    def __init__(self, backend, batch_size, window):
+        self._backend = backend
+        self._batch_size = batch_size
+        self._window = window
+        # key -> future of pending read
+        self._pending = {}
+        self._flush_handle = None
+        # batch lookups in progress
+        self._fetches = set()
+        self._stats = collections.Counter()
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def _schedule_flush(self):
+        loop = asyncio.get_event_loop()
+        if self._window > 0:
+            self._flush_handle = loop.call_later(self._window, self._flush)
+        else:
+            self._flush_handle = loop.call_soon(self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._stats["batches"] += 1
+        self._stats["batched_keys"] += len(batch)
+        task = asyncio.ensure_future(self._fetch(batch))
+        self._fetches.add(task)
+        task.add_done_callback(self._fetches.discard)
+
+    async def _fetch(self, batch):
+        keys = list(batch)
+        try:
+            values = await self._backend.get_many(keys)
+        except Exception as exc:  # pylint: disable=broad-except
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        for key, value in zip(keys, values):
+            fut = batch[key]
+            if not fut.done():
+                fut.set_result(value)
+
+    def get_nowait(self, key):
+        return self._backend.get_nowait(key)
+
+    async def setup(self):
+        await self._backend.setup()
+
+    async def teardown(self):
+        self._flush()
+        if self._fetches:
+            await asyncio.wait(self._fetches)
+        await self._backend.teardown()
+
+    async def get(self, key):
+        self._stats["reads"] += 1
+        fut = self._pending.get(key)
+        if fut is None:
+            fut = asyncio.get_event_loop().create_future()
+            self._pending[key] = fut
+            if len(self._pending) >= self._batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._schedule_flush()
+        # Cancellation of one reader must not cancel lookup for others
+        return await asyncio.shield(fut)
+
+    async def set(self, key, value):
+        await self._backend.set(key, value)
+
+    async def get_many(self, keys):
+        return await self._backend.get_many(keys)
+
+    async def set_many(self, items):
+        await self._backend.set_many(items)
+
+    async def touch(self, key, ts):  # pylint: disable=invalid-name
+        await self._backend.touch(key, ts)
+
+    async def touch_many(self, items):
+        await self._backend.touch_many(items)
+
+    async def scan(self, token, amount_hint):
+        return await self._backend.scan(token, amount_hint)
+
+    async def publish(self, channel, messages):
+        await self._backend.publish(channel, messages)
+
+    async def subscribe(self, channel, callback):
+        return await self._backend.subscribe(channel, callback)
+
+    async def get_proactive_fetch_ts(self):
+        return await self._backend.get_proactive_fetch_ts()
+
+    async def set_proactive_fetch_ts(self, timestamp):
+        await self._backend.set_proactive_fetch_ts(timestamp)
+
+    def stats(self):
+        batches = self._stats["batches"]
+        return {
+            "reads": self._stats["reads"],
+            "batches": batches,
+            "avg_batch_size": self._stats["batched_keys"] / batches if batches else 0.0,
+        }
@@ -0,0 +1,91 @@
+import asyncio
+import collections
+import time
+
+from .constants import AIMD_DECREASE_FACTOR
+
+
+# pylint: disable=too-many-instance-attributes
+class AIMDLimiter:
+    """ Limits number of concurrent operations, adjusting the limit within
+    `floor` and `ceiling` by observed outcome of operations.
+
+    Operation which succeeded within `latency_target` seconds raises limit
+    additively, by one per `limit` such operations. Failed or slow operation
+    cuts limit by AIMD_DECREASE_FACTOR, at most once per round of operations
+    started after previous cut. Until the first cut limit grows by one per
+    successful operation. If `floor` equals `ceiling` limit is fixed. """
+
+    def __init__(self, floor, ceiling, latency_target):
+        self._floor = floor
+        self._ceiling = ceiling
+        self._latency_target = latency_target
+        self._limit = float(floor)
+        self._slow_start = True
+        self._active = 0
+        self._waiters = collections.deque()
+        self._last_decrease = float('-inf')
+        self._stats = collections.Counter()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    async def acquire(self):
+        """ Waits for free slot. Returns token which has to be passed
+        to release() when operation is complete. """
+        while self._active >= self.limit:
+            fut = asyncio.get_event_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+                # Pass wakeup which could be destined to this waiter
+                self._wakeup()
+                raise
+        self._active += 1
+        return time.monotonic()
+
+    def release(self, token, success=None):
+        """ Frees slot taken by acquire(). `success` tells if operation
+        succeeded. None means outcome is unknown and limit stays intact. """
+        self._active -= 1
+        now = time.monotonic()
+        if success is not None:
+            if success and now - token <= self._latency_target:
+                self._increase()
+            elif token >= self._last_decrease:
+                self._decrease(now)
+        self._wakeup()
+
+    def _increase(self):
+        if self._slow_start:
+            self._limit = min(self._ceiling, self._limit + 1)
+        else:
+            self._limit = min(self._ceiling, self._limit + 1 / self._limit)
+        self._stats["increases"] += 1
+
+    def _decrease(self, now):
+        self._limit = max(self._floor, self._limit * AIMD_DECREASE_FACTOR)
+        self._slow_start = False
+        self._last_decrease = now
+        self._stats["decreases"] += 1
+
+    def _wakeup(self):
+        free = self.limit - self._active
+        while free > 0 and self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "increases": self._stats["increases"],
+            "decreases": self._stats["decreases"],
+        }
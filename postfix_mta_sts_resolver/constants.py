@@ -1,6 +1,26 @@
 HARD_RESP_LIMIT = 64 * 1024
 CHUNK = 4096
 QUEUE_LIMIT = 128
+WRITE_BUFFER_LIMIT = 64 * 1024
+RESPONSE_CACHE_LIMIT = 10000
 REQUEST_LIMIT = 1024
 DOMAIN_QUEUE_LIMIT = 1000
 MIN_PROACTIVE_FETCH_INTERVAL = 1
+BACKOFF_TABLE_LIMIT = 10000
+HTTP_CONN_LIMIT = 100
+HTTP_CONN_LIMIT_PER_HOST = 2
+DNS_CACHE_LIMIT = 10000
+DNS_CACHE_MAX_TTL = 3600
+PROACTIVE_FETCH_RETRY_DELAY = 600
+PROACTIVE_FETCH_WRITE_BATCH = 100
+AIMD_DECREASE_FACTOR = 0.5
+SQLITE_BATCH_LIMIT = 500
+WORKER_RESTART_DELAY = 1
+WORKER_CHECK_INTERVAL = .5
+WORKER_STOP_MARGIN = 5
+SHM_CACHE_PROBE_LIMIT = 16
+SHM_CACHE_READ_RETRIES = 100
+SHM_CACHE_LOCK_RETRY_DELAY = .001
+NEGATIVE_PURGE_INTERVAL = 300
+LMDB_PURGE_BATCH = 1000
+SUBSCRIBE_RETRY_DELAY = 5
@@ -13,8 +13,11 @@ from functools import partial
 from .asdnotify import AsyncSystemdNotifier
 from . import utils
 from . import defaults
+from .constants import WORKER_CHECK_INTERVAL, WORKER_STOP_MARGIN
 from .proactive_fetcher import STSProactiveFetcher
+from .resolver import create_resolver
 from .responder import STSSocketmapResponder
+from .workers import WorkerPool
 
 
 def parse_args():
@@ -41,6 +44,10 @@ def parse_args():
                         help="name of the file to write the current pid to")
     parser.add_argument("-u", "--user",
                         help="change eUID to this user")
+    parser.add_argument("-w", "--workers",
+                        help="number of worker processes serving requests "
+                        "(overrides config file)",
+                        type=int)
 
     return parser.parse_args()
 
@@ -55,6 +62,17 @@ def exit_handler(exit_event, signum, frame):  # pragma: no cover pylint: disable
         exit_event.set()
 
 
+def stats_handler(sources, signum, frame):  # pragma: no cover pylint: disable=unused-argument
+    logger = logging.getLogger('MAIN')
+    for name, source in sources:
+        logger.info("%s stats: %s", name, source.stats())
+
+
+def supervisor_stats_handler(pool, signum, frame):  # pragma: no cover
+    stats_handler([("Workers", pool)], signum, frame)
+    pool.send_signal(signum)
+
+
 async def heartbeat():
     """ Hacky coroutine which keeps event loop spinning with some interval
     even if no events are coming. This is required to handle Futures and
@@ -63,25 +81,35 @@ async def heartbeat():
         await asyncio.sleep(.5)
 
 
-async def amain(cfg, loop):  # pragma: no cover
+async def amain(cfg, loop, worker_id=None):  # pragma: no cover
+    """ Runs server until exit signal. worker_id is set when server runs
+    as one of worker processes spawned by supervisor. """
     logger = logging.getLogger("MAIN")
 
-    proactive_fetch_enabled = cfg['proactive_policy_fetching']['enabled']
+    # Only one worker refreshes policies proactively
+    proactive_fetch_enabled = (cfg['proactive_policy_fetching']['enabled'] and
+                               not worker_id)
 
     # Create policy cache
     cache = utils.create_cache(cfg["cache"]["type"],
-                               cfg["cache"]["options"])
+                               cfg["cache"]["options"],
+                               cfg["cache"]["memory_tier"],
+                               cfg["cache"]["read_batching"],
+                               cfg["negative_cache_ttl"])
     await cache.setup()
 
+    # Create resolver shared by all zones and proactive fetcher
+    resolver = create_resolver(cfg, loop)
+
     # Construct request handler
-    responder = STSSocketmapResponder(cfg, loop, cache)
+    responder = STSSocketmapResponder(cfg, loop, cache, resolver)
     await responder.start()
     logger.info("Server started.")
 
     # Conditionally construct proactive policy fetcher
     proactive_fetcher = None
     if proactive_fetch_enabled:
-        proactive_fetcher = STSProactiveFetcher(cfg, loop, cache)
+        proactive_fetcher = STSProactiveFetcher(cfg, loop, cache, resolver)
         await proactive_fetcher.start()
         logger.info("Proactive policy fetcher started.")
     else:
@@ -91,19 +119,98 @@ async def amain(cfg, loop):  # pragma: no cover
     beat = asyncio.ensure_future(heartbeat())
     sig_handler = partial(exit_handler, exit_event)
     signal.signal(signal.SIGTERM, sig_handler)
-    signal.signal(signal.SIGINT, sig_handler)
-    async with AsyncSystemdNotifier() as notifier:
-        await notifier.notify(b"READY=1")
+    if worker_id is None:
+        signal.signal(signal.SIGINT, sig_handler)
+    stats_sources = [("Responder", responder)]
+    if proactive_fetch_enabled:
+        stats_sources.append(("Proactive fetcher", proactive_fetcher))
+    # Report every cache layer which keeps statistics
+    layer = cache
+    while layer is not None:
+        if callable(getattr(layer, "stats", None)):
+            stats_sources.append(("Cache (%s)" % type(layer).__name__, layer))
+        layer = getattr(layer, "backend", None)
+    signal.signal(signal.SIGUSR1, partial(stats_handler, stats_sources))
+    if worker_id is None:
+        async with AsyncSystemdNotifier() as notifier:
+            await notifier.notify(b"READY=1")
+            await exit_event.wait()
+            logger.debug("Eventloop interrupted. Shutting down server...")
+            await notifier.notify(b"STOPPING=1")
+    else:
         await exit_event.wait()
         logger.debug("Eventloop interrupted. Shutting down server...")
-        await notifier.notify(b"STOPPING=1")
     beat.cancel()
     await responder.stop()
     if proactive_fetch_enabled:
         await proactive_fetcher.stop()
+    await resolver.close()
     await cache.teardown()
 
 
+async def asupervise(cfg, args, workers):  # pragma: no cover
+    """ Runs worker processes until exit signal, restarting ones which die. """
+    logger = logging.getLogger("MAIN")
+
+    pool = WorkerPool(workers, worker_main, (args, cfg))
+    pool.start()
+    logger.info("Started %d worker processes.", workers)
+
+    exit_event = asyncio.Event()
+    sig_handler = partial(exit_handler, exit_event)
+    signal.signal(signal.SIGTERM, sig_handler)
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGUSR1, partial(supervisor_stats_handler, pool))
+    async with AsyncSystemdNotifier() as notifier:
+        await notifier.notify(b"READY=1")
+        while not exit_event.is_set():
+            pool.check()
+            try:
+                await asyncio.wait_for(exit_event.wait(), WORKER_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        logger.debug("Eventloop interrupted. Stopping workers...")
+        await notifier.notify(b"STOPPING=1")
+    await asyncio.get_event_loop().run_in_executor(
+        None, pool.stop, cfg['shutdown_timeout'] + WORKER_STOP_MARGIN)
+
+
+def setup_loggers(verbosity, log_handler):
+    logger = utils.setup_logger('MAIN', verbosity, log_handler)
+    utils.setup_logger('STS', verbosity, log_handler)
+    utils.setup_logger('PF', verbosity, log_handler)
+    utils.setup_logger('RES', verbosity, log_handler)
+    return logger
+
+
+def run_eventloop(args, coro_factory):  # pragma: no cover
+    logger = logging.getLogger('MAIN')
+    logger.info("Starting eventloop...")
+    if not args.disable_uvloop:
+        if utils.enable_uvloop():
+            logger.info("uvloop enabled.")
+        else:
+            logger.info("uvloop is not available. "
+                        "Falling back to built-in event loop.")
+    evloop = asyncio.get_event_loop()
+    logger.info("Eventloop started.")
+
+    evloop.run_until_complete(coro_factory(evloop))
+    evloop.close()
+
+
+def worker_main(args, cfg, worker_id):  # pragma: no cover
+    """ Entry point of worker process """
+    # Interrupt from terminal reaches whole process group. Let supervisor
+    # handle it and stop workers in orderly fashion.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with utils.AsyncLoggingHandler(args.logfile) as log_handler:
+        logger = setup_loggers(args.verbosity, log_handler)
+        logger.info("Worker #%d starting...", worker_id)
+        run_eventloop(args, lambda loop: amain(cfg, loop, worker_id))
+        logger.info("Worker #%d finished its work.", worker_id)
+
+
 def main():  # pragma: no cover
     args = parse_args()
     if args.pidfile is not None:
@@ -124,28 +231,20 @@ def main():  # pragma: no cover
             print("Unable to change eUID to '{}': {}".format(args.user, exc), file=sys.stderr)
             return os.EX_OSERR
     with utils.AsyncLoggingHandler(args.logfile) as log_handler:
-        logger = utils.setup_logger('MAIN', args.verbosity, log_handler)
-        utils.setup_logger('STS', args.verbosity, log_handler)
-        utils.setup_logger('PF', args.verbosity, log_handler)
-        utils.setup_logger('RES', args.verbosity, log_handler)
+        logger = setup_loggers(args.verbosity, log_handler)
         logger.info("MTA-STS daemon starting...")
 
         # Read config and populate with defaults
         cfg = utils.load_config(args.config)
-
-        # Construct event loop
-        logger.info("Starting eventloop...")
-        if not args.disable_uvloop:
-            if utils.enable_uvloop():
-                logger.info("uvloop enabled.")
-            else:
-                logger.info("uvloop is not available. "
-                            "Falling back to built-in event loop.")
-        evloop = asyncio.get_event_loop()
-        logger.info("Eventloop started.")
-
-
-        evloop.run_until_complete(amain(cfg, evloop))
-        evloop.close()
+        workers = cfg['workers'] if args.workers is None else args.workers
+
+        if workers > 1:
+            if cfg.get('path') is not None or not cfg['reuse_port']:
+                logger.error("Multiple workers require TCP socket "
+                             "with reuse_port enabled.")
+                return os.EX_USAGE
+            run_eventloop(args, lambda loop: asupervise(cfg, args, workers))
+        else:
+            run_eventloop(args, lambda loop: amain(cfg, loop))
         logger.info("Server finished its work.")
     return os.EX_OK
@@ -4,21 +4,48 @@ HOST = "127.0.0.1"
 PORT = 8461
 REUSE_PORT = True
 TIMEOUT = 4
+RESPONSE_DEADLINE = 0
 TLSRPT = False
 SHUTDOWN_TIMEOUT = 20
+WORKERS = 1
 STRICT_TESTING = False
 CONFIG_LOCATION = "/etc/mta-sts-daemon.yml"
 CACHE_BACKEND = "internal"
 INTERNAL_CACHE_SIZE = 10000
+INTERNAL_CACHE_SNAPSHOT_INTERVAL = 300
+MEMORY_TIER_ENABLED = False
+MEMORY_TIER_SIZE = 1000
+MEMORY_TIER_TTL = 5
+MEMORY_TIER_INVALIDATION = False
+MEMORY_TIER_INVALIDATION_CHANNEL = "mta_sts_invalidation"
+READ_BATCHING_ENABLED = False
+READ_BATCHING_SIZE = 100
+READ_BATCHING_WINDOW = 0
+SHM_CACHE_SLOTS = 10000
+SHM_CACHE_SLOT_SIZE = 1024
+LMDB_MAP_SIZE = 256 * 1024 * 1024
 SQLITE_THREADS = cpu_count()
 SQLITE_TIMEOUT = 5
 POSTGRES_TIMEOUT = 5
 REDIS_CONNECT_TIMEOUT = 5
 REDIS_TIMEOUT = 5
+REDIS_SCAN_COUNT = None
+REDIS_FORMAT = 1
+REDIS_MIGRATE = True
 CACHE_GRACE = 60
+NEGATIVE_CACHE_TTL = 300
+FETCH_BACKOFF_ENABLED = True
+FETCH_BACKOFF_INITIAL = 10
+FETCH_BACKOFF_MAX = 600
+STALE_WHILE_REVALIDATE = False
+REFRESH_AHEAD = 0
 PROACTIVE_FETCH_ENABLED = False
 PROACTIVE_FETCH_INTERVAL = 86400
 PROACTIVE_FETCH_CONCURRENCY_LIMIT = 100
 PROACTIVE_FETCH_GRACE_RATIO = 2.0
+PROACTIVE_FETCH_SCHEDULE = "interval"
+PROACTIVE_FETCH_ADAPTIVE_CONCURRENCY = False
+PROACTIVE_FETCH_CONCURRENCY_MIN = 1
+PROACTIVE_FETCH_LATENCY_TARGET = 2
 USER_AGENT = "postfix-mta-sts-resolver"
 REQUIRE_SNI = True
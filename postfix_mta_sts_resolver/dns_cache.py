@@ -0,0 +1,43 @@
+import collections
+import time
+
+from .constants import DNS_CACHE_LIMIT, DNS_CACHE_MAX_TTL
+
+
+class DNSCache:
+    """ Keeps DNS answers until their TTL expires.
+
+    Answers are keyed by (name, query type). TTL is capped at `max_ttl`
+    seconds and answers with zero TTL are not stored. When cache holds
+    `size` answers, least recently used one is evicted. """
+
+    def __init__(self, size=DNS_CACHE_LIMIT, max_ttl=DNS_CACHE_MAX_TTL):
+        self._size = size
+        self._max_ttl = max_ttl
+        # (name, qtype) -> (expire_ts, answer), least recently used first
+        self._records = collections.OrderedDict()
+
+    def get(self, name, qtype):
+        key = (name, qtype)
+        record = self._records.get(key)
+        if record is None:
+            return None
+        expire_ts, answer = record
+        if time.time() >= expire_ts:
+            del self._records[key]
+            return None
+        self._records.move_to_end(key)
+        return answer
+
+    def set(self, name, qtype, answer, ttl):
+        ttl = min(ttl, self._max_ttl)
+        if ttl <= 0:
+            return
+        key = (name, qtype)
+        self._records.pop(key, None)
+        if len(self._records) >= self._size:
+            self._records.popitem(last=False)
+        self._records[key] = (time.time() + ttl, answer)
+
+    def __len__(self):
+        return len(self._records)
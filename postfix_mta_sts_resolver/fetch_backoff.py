@@ -0,0 +1,47 @@
+import collections
+import time
+
+from .constants import BACKOFF_TABLE_LIMIT
+
+
+class FetchBackoff:
+    """ Keeps track of consecutive policy fetch failures per domain.
+
+    After each failure next fetch attempt for domain is postponed
+    for exponentially growing delay, starting at `initial` seconds and
+    capped at `maximum` seconds. Successful fetch resets the record. """
+
+    def __init__(self, initial, maximum, size=BACKOFF_TABLE_LIMIT):
+        self._initial = initial
+        self._maximum = maximum
+        self._size = size
+        # domain -> (failures, retry_ts), oldest updates first
+        self._records = collections.OrderedDict()
+
+    def blocked(self, domain):
+        record = self._records.get(domain)
+        return record is not None and time.time() < record[1]
+
+    def retry_ts(self, domain):
+        """ Returns time when next fetch attempt for domain is allowed. """
+        record = self._records.get(domain)
+        return 0 if record is None else record[1]
+
+    def failure(self, domain):
+        failures, _ = self._records.pop(domain, (0, None))
+        failures += 1
+        delay = min(self._initial * 2 ** (failures - 1), self._maximum)
+        if len(self._records) >= self._size:
+            self._records.popitem(last=False)
+        self._records[domain] = (failures, time.time() + delay)
+        return delay
+
+    def success(self, domain):
+        self._records.pop(domain, None)
+
+    def stats(self):
+        ts = time.time()  # pylint: disable=invalid-name
+        return {
+            "domains": len(self._records),
+            "blocked": sum(1 for _, retry_ts in self._records.values() if ts < retry_ts),
+        }
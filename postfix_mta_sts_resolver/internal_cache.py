@@ -1,22 +1,112 @@
+import asyncio
 import collections
+import json
+import logging
+import os
+import time
 from itertools import islice
 
-from .base_cache import BaseCache
+from .defaults import INTERNAL_CACHE_SNAPSHOT_INTERVAL
+from .base_cache import BaseCache, CacheEntry
+
+SNAPSHOT_VERSION = 1
 
 
 class InternalLRUCache(BaseCache):
-    def __init__(self, cache_size=10000):
+    """ In-memory LRU cache.
+
+    If snapshot_file is set, cache contents are saved to that file every
+    snapshot_interval seconds and on teardown, and loaded back on setup.
+    Snapshot holds one JSON record per line, from least to most recently
+    used entry. """
+
+    def __init__(self, cache_size=10000, *, snapshot_file=None,
+                 snapshot_interval=INTERNAL_CACHE_SNAPSHOT_INTERVAL):
         self._cache_size = cache_size
         self._cache = collections.OrderedDict()
         self._proactive_fetch_ts = 0
+        self._snapshot_file = snapshot_file
+        self._snapshot_interval = snapshot_interval
+        self._snapshot_task = None
+        self._logger = logging.getLogger("STS")
 
     async def setup(self):
-        pass
+        if self._snapshot_file is None:
+            return
+        try:
+            self._load_snapshot()
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exc:
+            self._logger.warning("Unable to load cache snapshot from %s: %s",
+                                 self._snapshot_file, str(exc))
+        if self._snapshot_interval > 0:
+            self._snapshot_task = asyncio.ensure_future(self._snapshot_loop())
 
     async def teardown(self):
-        pass
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            await asyncio.gather(self._snapshot_task, return_exceptions=True)
+            self._snapshot_task = None
+        if self._snapshot_file is not None:
+            await self.save_snapshot()
 
-    async def get(self, key):
+    def _load_snapshot(self):
+        """ Loads entries from snapshot file, skipping expired policies. """
+        now = time.time()
+        loaded = 0
+        with open(self._snapshot_file, encoding='utf-8') as snapshot:
+            header = json.loads(snapshot.readline())
+            if header.get("version") != SNAPSHOT_VERSION:
+                raise ValueError("unsupported snapshot version")
+            self._proactive_fetch_ts = header.get("proactive_fetch_ts", 0)
+            for line in snapshot:
+                key, ts, pol_id, pol_body = json.loads(line)
+                if pol_body is not None and pol_body['max_age'] + ts < now:
+                    continue
+                self._set(key, CacheEntry(ts, pol_id, pol_body))
+                loaded += 1
+        self._logger.info("Loaded %d cache entries from snapshot.", loaded)
+
+    def _write_snapshot(self, header, items):
+        # Each worker process writes its own temporary file
+        tmp_name = "%s.%d.tmp" % (self._snapshot_file, os.getpid())
+        try:
+            with open(tmp_name, 'w', encoding='utf-8') as snapshot:
+                snapshot.write(json.dumps(header) + '\n')
+                for key, (ts, pol_id, pol_body) in items:
+                    snapshot.write(json.dumps([key, ts, pol_id, pol_body],
+                                              separators=(',', ':')) + '\n')
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(tmp_name, self._snapshot_file)
+        except OSError:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+
+    async def save_snapshot(self):
+        """ Atomically replaces snapshot file with current cache contents. """
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "proactive_fetch_ts": self._proactive_fetch_ts,
+        }
+        items = list(self._cache.items())
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._write_snapshot, header, items)
+        except OSError as exc:
+            self._logger.error("Unable to save cache snapshot to %s: %s",
+                               self._snapshot_file, str(exc))
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self._snapshot_interval)
+            await self.save_snapshot()
+
+    def _get(self, key):
         try:
             value = self._cache.pop(key)
             self._cache[key] = value
@@ -24,7 +114,7 @@ class InternalLRUCache(BaseCache):
         except KeyError:
             return None
 
-    async def set(self, key, value):
+    def _set(self, key, value):
         try:
             self._cache.pop(key)
         except KeyError:
@@ -32,6 +122,27 @@ class InternalLRUCache(BaseCache):
                 self._cache.popitem(last=False)
         self._cache[key] = value
 
+    def get_nowait(self, key):
+        return self._get(key)
+
+    async def get(self, key):
+        return self._get(key)
+
+    async def set(self, key, value):
+        self._set(key, value)
+
+    async def get_many(self, keys):
+        return [self._get(key) for key in keys]
+
+    async def set_many(self, items):
+        for key, value in items:
+            self._set(key, value)
+
+    async def touch(self, key, ts):  # pylint: disable=invalid-name
+        entry = self._cache.get(key)
+        if entry is not None and entry.ts < ts:
+            self._cache[key] = entry._replace(ts=ts)
+
     async def scan(self, token, amount_hint):
         if token is None:
             token = 0
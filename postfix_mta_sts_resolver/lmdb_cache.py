@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import struct
+import time
+
+import lmdb
+
+from .defaults import LMDB_MAP_SIZE, NEGATIVE_CACHE_TTL
+from .constants import LMDB_PURGE_BATCH
+from .base_cache import BaseCache, CacheEntry
+
+# timestamp, length of policy id
+ENTRY_HEADER = struct.Struct('<qH')
+TS = struct.Struct('<q')
+NO_POL_ID = 0xFFFF
+PROACTIVE_FETCH_TS_KEY = b'proactive_fetch_ts'
+
+
+def encode_entry(entry):
+    ts, pol_id, pol_body = entry
+    if pol_id is None:
+        res = ENTRY_HEADER.pack(int(ts), NO_POL_ID)
+    else:
+        pol_id = pol_id.encode('utf-8')
+        res = ENTRY_HEADER.pack(int(ts), len(pol_id)) + pol_id
+    if pol_body is not None:
+        res += json.dumps(pol_body, separators=(',', ':')).encode('utf-8')
+    return res
+
+
+def decode_entry(buf):
+    ts, id_len = ENTRY_HEADER.unpack_from(buf)
+    pos = ENTRY_HEADER.size
+    if id_len == NO_POL_ID:
+        pol_id = None
+    else:
+        pol_id = bytes(buf[pos:pos + id_len]).decode('utf-8')
+        pos += id_len
+    pol_body = json.loads(bytes(buf[pos:])) if len(buf) > pos else None
+    return CacheEntry(ts, pol_id, pol_body)
+
+
+def is_negative(buf):
+    """ Tells if encoded entry is negative without decoding it """
+    return (len(buf) == ENTRY_HEADER.size and
+            ENTRY_HEADER.unpack_from(buf)[1] == NO_POL_ID)
+
+
+def is_expired(buf, now):
+    """ Tells if encoded entry holds policy which is expired """
+    ts, _, pol_body = decode_entry(buf)
+    return (isinstance(pol_body, dict) and 'max_age' in pol_body and
+            ts + pol_body['max_age'] < now)
+
+
+# pylint: disable=too-many-instance-attributes
+class LmdbCache(BaseCache):
+    """ Persistent cache in LMDB environment.
+
+    Reads are served from memory map within event loop thread. Writes
+    issued while previous write transaction commits are grouped and
+    committed together in executor thread. Every commit also sweeps
+    next part of database for expired negative entries. When map gets
+    full, all negative entries and expired policies are evicted. """
+
+    def __init__(self, path, *, map_size=LMDB_MAP_SIZE, negative_ttl=NEGATIVE_CACHE_TTL):
+        self._path = path
+        self._map_size = map_size
+        self._negative_ttl = negative_ttl
+        # Key where next sweep for expired negative entries starts
+        self._purge_key = None
+        self._env = None
+        self._policies = None
+        self._meta = None
+        # Pending write operations: (key, entry, touch)
+        self._ops = []
+        self._writer = None
+        self._logger = logging.getLogger("STS")
+
+    async def setup(self):
+        self._env = lmdb.open(self._path, map_size=self._map_size,
+                              max_dbs=2, readahead=False)
+        self._policies = self._env.open_db(b'sts_policy_cache')
+        self._meta = self._env.open_db(b'meta')
+
+    async def teardown(self):
+        if self._writer is not None:
+            await asyncio.shield(self._writer)
+        self._env.close()
+
+    def _read(self, key):
+        with self._env.begin(db=self._policies, buffers=True) as txn:
+            buf = txn.get(key.encode('utf-8'))
+            return None if buf is None else decode_entry(buf)
+
+    def _purge_negative(self, txn):
+        """ Deletes expired negative entries among next LMDB_PURGE_BATCH
+        entries of database, starting where previous sweep stopped. """
+        expired_ts = time.time() - self._negative_ttl
+        cursor = txn.cursor()
+        if self._purge_key is None:
+            positioned = cursor.first()
+        else:
+            positioned = cursor.set_range(self._purge_key)
+        for _ in range(LMDB_PURGE_BATCH):
+            if not positioned:
+                self._purge_key = None
+                return
+            value = cursor.value()
+            if is_negative(value) and TS.unpack_from(value)[0] < expired_ts:
+                # Cursor moves to next entry, if there is one
+                cursor.delete()
+                positioned = bool(cursor.key())
+            else:
+                positioned = cursor.next()
+        self._purge_key = cursor.key() if positioned else None
+
+    def _evict(self):
+        """ Deletes all negative entries and expired policies.
+        Returns number of deleted entries. """
+        now = time.time()
+        deleted = 0
+        with self._env.begin(db=self._policies, write=True) as txn:
+            cursor = txn.cursor()
+            positioned = cursor.first()
+            while positioned:
+                value = cursor.value()
+                if is_negative(value) or is_expired(value, now):
+                    cursor.delete()
+                    deleted += 1
+                    positioned = bool(cursor.key())
+                else:
+                    positioned = cursor.next()
+        self._purge_key = None
+        return deleted
+
+    def _commit(self, ops):
+        try:
+            self._apply(ops)
+        except lmdb.MapFullError:
+            # Make room and retry once. If map is still full, writes fail.
+            deleted = self._evict()
+            self._logger.warning("LMDB map is full, evicted %d negative or "
+                                 "expired entries.", deleted)
+            if not deleted:
+                raise
+            self._apply(ops)
+
+    def _apply(self, ops):
+        with self._env.begin(db=self._policies, write=True) as txn:
+            self._purge_negative(txn)
+            for key, entry, touch in ops:
+                key = key.encode('utf-8')
+                current = txn.get(key)
+                current_ts = None if current is None else TS.unpack_from(current)[0]
+                if touch:
+                    if current_ts is not None and current_ts < entry.ts:
+                        txn.put(key, TS.pack(int(entry.ts)) + current[TS.size:])
+                elif current_ts is None or current_ts < entry.ts:
+                    txn.put(key, encode_entry(entry))
+
+    async def _write_all(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._ops:
+                ops, self._ops = self._ops, []
+                await loop.run_in_executor(None, self._commit, ops)
+        finally:
+            self._writer = None
+
+    async def _write(self, ops):
+        """ Queues operations and waits until they are committed. """
+        self._ops.extend(ops)
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write_all())
+        await asyncio.shield(self._writer)
+
+    def get_nowait(self, key):
+        return self._read(key)
+
+    async def get(self, key):
+        return self._read(key)
+
+    async def get_many(self, keys):
+        with self._env.begin(db=self._policies, buffers=True) as txn:
+            res = []
+            for key in keys:
+                buf = txn.get(key.encode('utf-8'))
+                res.append(None if buf is None else decode_entry(buf))
+            return res
+
+    async def set(self, key, value):
+        await self._write([(key, value, False)])
+
+    async def set_many(self, items):
+        if items:
+            await self._write([(key, value, False) for key, value in items])
+
+    async def touch(self, key, ts):  # pylint: disable=invalid-name
+        await self._write([(key, CacheEntry(ts, None, None), True)])
+
+    async def touch_many(self, items):
+        if items:
+            await self._write([(key, CacheEntry(ts, None, None), True)
+                               for key, ts in items])
+
+    async def scan(self, token, amount_hint):
+        result = []
+        with self._env.begin(db=self._policies, buffers=True) as txn:
+            cursor = txn.cursor()
+            if token is None:
+                positioned = cursor.first()
+            else:
+                token = token.encode('utf-8')
+                positioned = cursor.set_range(token)
+                if positioned and cursor.key() == token:
+                    positioned = cursor.next()
+            while positioned and len(result) < amount_hint:
+                result.append((bytes(cursor.key()).decode('utf-8'),
+                               decode_entry(cursor.value())))
+                positioned = cursor.next()
+        if not positioned or not result:
+            return None, result
+        return result[-1][0], result
+
+    async def get_proactive_fetch_ts(self):
+        with self._env.begin(db=self._meta) as txn:
+            res = txn.get(PROACTIVE_FETCH_TS_KEY)
+        return 0 if res is None else TS.unpack(res)[0]
+
+    async def set_proactive_fetch_ts(self, timestamp):
+        def store():
+            with self._env.begin(db=self._meta, write=True) as txn:
+                txn.put(PROACTIVE_FETCH_TS_KEY, TS.pack(int(timestamp)))
+        await asyncio.get_event_loop().run_in_executor(None, store)
@@ -2,6 +2,7 @@ import ssl
 
 COLON = b':'
 COMMA = b','
+COMMA_ORD = ord(COMMA)
 ZERO = b'0'
 ZERO_ORD = ord(ZERO)
 
@@ -38,6 +39,9 @@ class BadTerminator(ParseError):
 
 
 class SingleNetstringFetcher:
+    """ Reader of parts of single netstring. Instances are created by
+    StreamReader.next_string(). """
+
     def __init__(self, incoming, maxlen=-1):
         self._incoming = incoming
         self._maxlen = maxlen
@@ -99,7 +103,12 @@ class StreamReader:
 
     SingleNestringFetcher.read() returns b'' in case of string end or raises
     WantRead exception when StreamReader needs to be filled with additional
-    data. Parsing errors signalized with exceptions subclassing ParseError"""
+    data. Parsing errors signalized with exceptions subclassing ParseError.
+
+    Responder uses Decoder, which only yields complete netstrings. This
+    reader, together with SingleNetstringFetcher and WantRead, is kept as
+    public API for clients which consume netstrings in parts, such as
+    socketmap clients in the test suite."""
 
     def __init__(self, maxlen=-1):
         """ Creates StreamReader instance.
@@ -126,24 +135,81 @@ class StreamReader:
         return self._fetcher
 
 
+class Decoder:
+    """ Incremental netstring decoder.
+
+    feed() appends received data to internal buffer and returns list of
+    all netstrings completed by it. Incomplete tail stays in buffer until
+    next feed(). Parsing errors signalized with exceptions subclassing
+    ParseError, after which decoder should not be used anymore. If error
+    follows complete netstrings, feed() returns them and keeps error in
+    `error` attribute, raising it on next feed() call. """
+
+    def __init__(self, maxlen=-1):
+        """ Creates Decoder instance.
+
+        Params:
+
+        maxlen - maximal allowed netstring length.
+        """
+        self._maxlen = maxlen
+        self._buf = bytearray()
+        self.error = None
+
+    def pending(self):
+        return bool(self._buf)
+
+    def _parse_length(self, start, end):
+        digits = self._buf[start:end]
+        if not digits.isdigit():
+            raise BadLength("Non-digit symbol in netstring length.")
+        length = int(digits)
+        if self._maxlen != -1 and length > self._maxlen:
+            raise TooLong("Netstring length is over limit.")
+        return length
+
+    def feed(self, data):
+        if self.error is not None:
+            raise self.error
+        buf = self._buf
+        buf += data
+        end = len(buf)
+        pos = 0
+        res = []
+        try:
+            with memoryview(buf) as view:
+                while pos < end:
+                    colon = buf.find(COLON, pos)
+                    if colon == -1:
+                        # Validate length prefix seen so far
+                        self._parse_length(pos, end)
+                        break
+                    if colon == pos:
+                        raise BadLength("No netstring length digits seen.")
+                    stop = colon + 1 + self._parse_length(pos, colon)
+                    if stop >= end:
+                        break
+                    if buf[stop] != COMMA_ORD:
+                        raise BadTerminator("Bad netstring terminator.")
+                    res.append(bytes(view[colon + 1:stop]))
+                    pos = stop + 1
+        except ParseError as exc:
+            if not res:
+                raise
+            # Hand out netstrings parsed before error
+            self.error = exc
+        del buf[:pos]
+        return res
+
+
 def encode(data):
     return b'%d:%s,' % (len(data), data)
 
 
 def decode(data):
-    reader = StreamReader()
-    reader.feed(data)
-    try:
-        while True:
-            res = []
-            string_reader = reader.next_string()
-            while True:
-                buf = string_reader.read()
-                if not buf:
-                    break
-                res.append(buf)
-            yield b''.join(res)
-    except WantRead:
-        if reader.pending():
-            # pylint: disable=raise-missing-from
-            raise IncompleteNetstring("Input ends on unfinished string.")
+    decoder = Decoder()
+    yield from decoder.feed(data)
+    if decoder.error is not None:
+        raise decoder.error
+    if decoder.pending():
+        raise IncompleteNetstring("Input ends on unfinished string.")
@@ -1,22 +1,33 @@
 # pylint: disable=invalid-name,protected-access
 
+import asyncio
 import json
 import logging
+import time
 
 import asyncpg
 
-from .defaults import POSTGRES_TIMEOUT
+from .defaults import POSTGRES_TIMEOUT, NEGATIVE_CACHE_TTL
+from .constants import SUBSCRIBE_RETRY_DELAY, NEGATIVE_PURGE_INTERVAL
 from .base_cache import BaseCache, CacheEntry
 
 
+def compact_json(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
 class PostgresCache(BaseCache):
-    def __init__(self, *, timeout=POSTGRES_TIMEOUT, **kwargs):
+    def __init__(self, *, timeout=POSTGRES_TIMEOUT, negative_ttl=NEGATIVE_CACHE_TTL,
+                 **kwargs):
         self._last_proactive_fetch_ts_id = 1
+        self._negative_ttl = negative_ttl
+        self._next_purge_ts = 0
         asyncpglogger = logging.getLogger("asyncpg")
         if not asyncpglogger.hasHandlers():  # pragma: no cover
             asyncpglogger.addHandler(logging.NullHandler())
         self._timeout = timeout
         self._pool = None
+        self._listener = None
         self.kwargs = kwargs
 
     async def setup(self):
@@ -27,12 +38,17 @@ class PostgresCache(BaseCache):
             "(id serial primary key, domain text, ts integer, pol_id text, pol_body jsonb)",
             "CREATE UNIQUE INDEX IF NOT EXISTS sts_policy_domain ON sts_policy_cache (domain)",
             "CREATE INDEX IF NOT EXISTS sts_policy_domain_ts ON sts_policy_cache (domain, ts)",
+            "CREATE INDEX IF NOT EXISTS sts_policy_negative_ts ON sts_policy_cache (ts) "
+            "WHERE pol_id IS NULL",
         ]
 
+        # Policies are small: json.loads() spends its time in C scanner
+        # already, so decoding is left as is. Encoding is made compact to
+        # shrink stored rows.
         async def set_type_codec(conn):
             await conn.set_type_codec(
                 'jsonb',
-                encoder=json.dumps,
+                encoder=compact_json,
                 decoder=json.loads,
                 schema='pg_catalog',
             )
@@ -44,15 +60,14 @@ class PostgresCache(BaseCache):
                     await conn.execute(q)
 
     async def get_proactive_fetch_ts(self):
-        async with self._pool.acquire(timeout=self._timeout) as conn, conn.transaction():
-            cur = await conn.cursor('SELECT last_fetch_ts FROM '
-                                    'proactive_fetch_ts where id = $1',
-                                    self._last_proactive_fetch_ts_id)
-            res = await cur.fetchrow()
-        return int(res[0]) if res is not None else 0
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            res = await conn.fetchval('SELECT last_fetch_ts FROM '
+                                      'proactive_fetch_ts where id = $1',
+                                      self._last_proactive_fetch_ts_id)
+        return int(res) if res is not None else 0
 
     async def set_proactive_fetch_ts(self, timestamp):
-        async with self._pool.acquire(timeout=self._timeout) as conn, conn.transaction():
+        async with self._pool.acquire(timeout=self._timeout) as conn:
             await conn.execute("""
                 INSERT INTO proactive_fetch_ts (last_fetch_ts, id)
                 VALUES ($1, $2)
@@ -62,11 +77,12 @@ class PostgresCache(BaseCache):
             )
 
     async def get(self, key):
-        async with self._pool.acquire(timeout=self._timeout) as conn, conn.transaction():
-            cur = await conn.cursor('SELECT ts, pol_id, pol_body FROM '
-                                    'sts_policy_cache WHERE domain=$1',
-                                    key)
-            res = await cur.fetchrow()
+        # Single statement needs neither transaction nor cursor. Statement
+        # is prepared once per connection and kept in its statement cache.
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            res = await conn.fetchrow('SELECT ts, pol_id, pol_body FROM '
+                                      'sts_policy_cache WHERE domain=$1',
+                                      key)
         if res is not None:
             ts, pol_id, pol_body = res
             ts = int(ts)
@@ -74,9 +90,21 @@ class PostgresCache(BaseCache):
         else:
             return None
 
+    async def _purge_negative(self, conn):
+        """ Deletes expired negative entries. Runs along with writes,
+        at most once per NEGATIVE_PURGE_INTERVAL. """
+        ts = time.time()
+        if ts < self._next_purge_ts:
+            return
+        self._next_purge_ts = ts + NEGATIVE_PURGE_INTERVAL
+        await conn.execute('DELETE FROM sts_policy_cache '
+                           'WHERE pol_id IS NULL AND ts < $1',
+                           int(ts - self._negative_ttl))
+
     async def set(self, key, value):
         ts, pol_id, pol_body = value
-        async with self._pool.acquire(timeout=self._timeout) as conn, conn.transaction():
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            await self._purge_negative(conn)
             await conn.execute("""
                 INSERT INTO sts_policy_cache (domain, ts, pol_id, pol_body) VALUES ($1, $2, $3, $4)
                 ON CONFLICT (domain) DO UPDATE
@@ -84,11 +112,58 @@ class PostgresCache(BaseCache):
                 WHERE sts_policy_cache.ts < EXCLUDED.ts
             """, key, int(ts), pol_id, pol_body)
 
+    async def get_many(self, keys):
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            res = await conn.fetch('SELECT domain, ts, pol_id, pol_body FROM '
+                                   'sts_policy_cache WHERE domain = ANY($1::text[])',
+                                   list(keys))
+        found = dict((domain, CacheEntry(int(ts), pol_id, pol_body))
+                     for domain, ts, pol_id, pol_body in res)
+        return [found.get(key) for key in keys]
+
+    async def set_many(self, items):
+        if not items:
+            return
+        # Only one row per domain is allowed in single upsert
+        items = dict(items)
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            await self._purge_negative(conn)
+            await conn.execute("""
+                INSERT INTO sts_policy_cache (domain, ts, pol_id, pol_body)
+                SELECT * FROM unnest($1::text[], $2::integer[], $3::text[], $4::jsonb[])
+                ON CONFLICT (domain) DO UPDATE
+                SET ts = EXCLUDED.ts, pol_id = EXCLUDED.pol_id, pol_body = EXCLUDED.pol_body
+                WHERE sts_policy_cache.ts < EXCLUDED.ts
+            """,
+            list(items.keys()),
+            [int(value.ts) for value in items.values()],
+            [value.pol_id for value in items.values()],
+            [value.pol_body for value in items.values()])
+
+    async def touch(self, key, ts):
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            await conn.execute('UPDATE sts_policy_cache SET ts = $2 '
+                               'WHERE domain = $1 AND ts < $2',
+                               key, int(ts))
+
+    async def touch_many(self, items):
+        if not items:
+            return
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            await conn.execute("""
+                UPDATE sts_policy_cache SET ts = touched.ts
+                FROM unnest($1::text[], $2::integer[]) AS touched (domain, ts)
+                WHERE sts_policy_cache.domain = touched.domain
+                AND sts_policy_cache.ts < touched.ts
+            """,
+            [key for key, _ in items],
+            [int(ts) for _, ts in items])
+
     async def scan(self, token, amount_hint):
         if token is None:
             token = 1
 
-        async with self._pool.acquire(timeout=self._timeout) as conn, conn.transaction():
+        async with self._pool.acquire(timeout=self._timeout) as conn:
             res = await conn.fetch('SELECT id, ts, pol_id, pol_body, domain FROM '
                                     'sts_policy_cache WHERE id >= $1 ORDER BY id ASC LIMIT $2',
                                     token, amount_hint)
@@ -106,5 +181,58 @@ class PostgresCache(BaseCache):
         else:
             return None, []
 
+    async def publish(self, channel, messages):
+        async with self._pool.acquire(timeout=self._timeout) as conn:
+            await conn.executemany('SELECT pg_notify($1, $2)',
+                                   [(channel, message) for message in messages])
+
+    async def subscribe(self, channel, callback):
+        self._listener = asyncio.ensure_future(self._listen(channel, callback))
+        return True
+
+    async def _listen(self, channel, callback):
+        """ Holds one pooled connection listening for notifications """
+        logger = logging.getLogger("STS")
+        lost = False
+
+        def on_notify(conn, pid, chan, payload):  # pylint: disable=unused-argument
+            callback(payload)
+
+        while True:
+            terminated = asyncio.Event()
+
+            def on_terminate(conn):  # pylint: disable=unused-argument
+                terminated.set()
+
+            try:
+                async with self._pool.acquire(timeout=self._timeout) as conn:
+                    conn.add_termination_listener(on_terminate)
+                    try:
+                        await conn.add_listener(channel, on_notify)
+                        if lost:
+                            lost = False
+                            callback(None)
+                        await terminated.wait()
+                    finally:
+                        conn.remove_termination_listener(on_terminate)
+                        if not conn.is_closed():
+                            await conn.remove_listener(channel, on_notify)
+                logger.warning("Connection listening on Postgres channel %s was lost",
+                               channel)
+            except asyncio.CancelledError:  # pylint: disable=try-except-raise
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning("Listening on Postgres channel %s failed: %s",
+                               channel, str(exc))
+            lost = True
+            await asyncio.sleep(SUBSCRIBE_RETRY_DELAY)
+
     async def teardown(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
         await self._pool.close()
@@ -1,48 +1,86 @@
 import asyncio
+import heapq
 import logging
 import time
 
 from postfix_mta_sts_resolver import constants
-from postfix_mta_sts_resolver.base_cache import CacheEntry
-from postfix_mta_sts_resolver.resolver import STSResolver, STSFetchResult
+from postfix_mta_sts_resolver.base_cache import CacheEntry, negative_entry
+from postfix_mta_sts_resolver.concurrency import AIMDLimiter
+from postfix_mta_sts_resolver.fetch_backoff import FetchBackoff
+from postfix_mta_sts_resolver.resolver import STSFetchResult, create_resolver
 
 
 # pylint: disable=too-many-instance-attributes
 class STSProactiveFetcher:
-    def __init__(self, cfg, loop, cache):
+    def __init__(self, cfg, loop, cache, resolver=None):
         self._shutdown_timeout = cfg['shutdown_timeout']
         self._pf_interval = cfg['proactive_policy_fetching']['interval']
         self._pf_concurrency_limit = cfg['proactive_policy_fetching']['concurrency_limit']
         self._pf_grace_ratio = cfg['proactive_policy_fetching']['grace_ratio']
+        self._pf_schedule = cfg['proactive_policy_fetching']['schedule']
+        if cfg['proactive_policy_fetching']['adaptive_concurrency']:
+            floor = min(cfg['proactive_policy_fetching']['concurrency_min'],
+                        self._pf_concurrency_limit)
+        else:
+            floor = self._pf_concurrency_limit
+        self._limiter = AIMDLimiter(floor, self._pf_concurrency_limit,
+                                    cfg['proactive_policy_fetching']['latency_target'])
+        # Failed scheduled refreshes are retried with growing delay,
+        # but not less often than every interval
+        self._backoff = FetchBackoff(constants.PROACTIVE_FETCH_RETRY_DELAY,
+                                     max(constants.PROACTIVE_FETCH_RETRY_DELAY,
+                                         self._pf_interval))
+        self._negative_ttl = cfg['negative_cache_ttl']
+        if self._pf_schedule not in ('interval', 'deadline'):
+            raise NotImplementedError("Unsupported proactive fetch schedule!")
         self._logger = logging.getLogger("PF")
         self._loop = loop
         self._cache = cache
         self._periodic_fetch_task = None
-        self._resolver = STSResolver(loop=loop,
-                                     timeout=cfg["default_zone"]["timeout"])
-
-    async def process_domain(self, domain_queue):
-        async def update(cached):
-            status, policy = await self._resolver.resolve(domain, cached.pol_id)
-            if status is STSFetchResult.VALID:
-                pol_id, pol_body = policy
-                updated = CacheEntry(ts, pol_id, pol_body)
-                await self._cache.safe_set(domain, updated, self._logger)
-            elif status is STSFetchResult.NOT_CHANGED:
-                updated = CacheEntry(ts, cached.pol_id, cached.pol_body)
-                await self._cache.safe_set(domain, updated, self._logger)
-            else:
-                self._logger.warning("Domain %s does not have a valid policy.", domain)
+        self._timeout = cfg["default_zone"]["timeout"]
+        self._own_resolver = resolver is None
+        self._resolver = create_resolver(cfg, loop) if resolver is None else resolver
+
+    async def fetch_update(self, domain, cached):
+        """ Resolves policy for domain. Returns fetch status and cache entry
+        which supersedes cached one or None if domain has no valid policy. """
+        token = await self._limiter.acquire()
+        try:
+            ts = time.time()  # pylint: disable=invalid-name
+            status, policy = await self._resolver.resolve(domain, cached.pol_id,
+                                                          timeout=self._timeout)
+        except:
+            self._limiter.release(token)
+            raise
+        self._limiter.release(token, status is not STSFetchResult.FETCH_ERROR)
+        if status is STSFetchResult.VALID:
+            pol_id, pol_body = policy
+            return status, CacheEntry(ts, pol_id, pol_body)
+        if status is STSFetchResult.NOT_CHANGED:
+            return status, CacheEntry(ts, cached.pol_id, cached.pol_body)
+        self._logger.warning("Domain %s does not have a valid policy.", domain)
+        return status, None
 
+    async def process_domain(self, domain_queue, changed, touched):
+        """ Refreshes domains from queue. Results are collected in changed
+        and touched lists, which are written to cache in batches. """
         while True:  # Run until cancelled
             cache_item = await domain_queue.get()
             ts = time.time()  # pylint: disable=invalid-name
             try:
                 domain, cached = cache_item
-                if ts - cached.ts < self._pf_interval / self._pf_grace_ratio:
+                if cached.negative:
+                    self._logger.debug("Domain %s skipped (negative entry).", domain)
+                elif ts - cached.ts < self._pf_interval / self._pf_grace_ratio:
                     self._logger.debug("Domain %s skipped (cache recent enough).", domain)
                 else:
-                    await update(cached)
+                    status, updated = await self.fetch_update(domain, cached)
+                    if status is STSFetchResult.VALID:
+                        changed.append((domain, updated))
+                    elif status is STSFetchResult.NOT_CHANGED:
+                        touched.append((domain, updated))
+                    if len(changed) + len(touched) >= constants.PROACTIVE_FETCH_WRITE_BATCH:
+                        await self.write_updates(changed, touched)
             except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
                 raise
             except Exception as exc:  # pragma: no cover
@@ -57,8 +95,11 @@ class STSProactiveFetcher:
         # Create domain processor tasks
         domain_processors = []
         domain_queue = asyncio.Queue(maxsize=constants.DOMAIN_QUEUE_LIMIT)
+        changed = []
+        touched = []
         for _ in range(self._pf_concurrency_limit):
-            domain_processor = self._loop.create_task(self.process_domain(domain_queue))
+            domain_processor = self._loop.create_task(
+                self.process_domain(domain_queue, changed, touched))
             domain_processors.append(domain_processor)
 
         # Produce work for domain processors
@@ -79,6 +120,7 @@ class STSProactiveFetcher:
             for domain_processor in domain_processors:
                 domain_processor.cancel()
             await asyncio.gather(*domain_processors, return_exceptions=True)
+            await self.write_updates(changed, touched)
 
         # Update the proactive fetch timestamp
         await self._cache.set_proactive_fetch_ts(time.time())
@@ -96,8 +138,201 @@ class STSProactiveFetcher:
             await asyncio.sleep(sleep_duration)
             await self.iterate_domains()
 
+    def refresh_deadline(self, cached):
+        """ Returns time when cached policy is due for proactive refresh:
+        after `1/grace_ratio` part of its max_age. """
+        try:
+            lifetime = int(cached.pol_body['max_age'])
+        except (KeyError, TypeError, ValueError):
+            lifetime = self._pf_interval
+        return cached.ts + lifetime / self._pf_grace_ratio
+
+    def reschedule(self, domain, cached, status, updated):
+        """ Returns time of next refresh of domain after fetch with given
+        result or None if domain has to leave schedule: it has no policy
+        anymore and its cached one is expired. Failed fetches are retried
+        with exponentially growing delay. """
+        ts = time.time()  # pylint: disable=invalid-name
+        if updated is not None:
+            self._backoff.success(domain)
+            return self.refresh_deadline(updated)
+        if (status is STSFetchResult.NONE and
+                cached.pol_body['max_age'] + cached.ts < ts):
+            self._backoff.success(domain)
+            return None
+        self._backoff.failure(domain)
+        return self._backoff.retry_ts(domain)
+
+    async def build_schedule(self):
+        """ Returns heap of (refresh deadline, domain) for all domains
+        with policy in cache. """
+        schedule = []
+        token = None
+        while True:
+            token, cache_items = await self._cache.scan(token, constants.DOMAIN_QUEUE_LIMIT)
+            schedule.extend((max(self.refresh_deadline(cached),
+                                 self._backoff.retry_ts(domain)), domain)
+                            for domain, cached in cache_items if not cached.negative)
+            if token is None:
+                break
+        heapq.heapify(schedule)
+        self._logger.info("Proactive fetch schedule rebuilt: %d domains.", len(schedule))
+        return schedule
+
+    async def _fetch_due(self, domain, cached):
+        """ Returns (domain, cached, status, updated) for fetch_update() of
+        domain. Status is None if fetch failed. """
+        try:
+            status, updated = await self.fetch_update(domain, cached)
+        except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
+            raise
+        except Exception as exc:  # pylint: disable=broad-except
+            self._logger.exception("Policy fetch for domain %s failed: %s", domain, exc)
+            return domain, cached, None, None
+        return domain, cached, status, updated
+
+    async def select_due(self, domains, schedule, done):
+        """ Returns (domain, cached) for domains which are still due for
+        refresh according to cache. Other domains are put back to schedule
+        or dropped if they have no policy in cache anymore. """
+        domains = list(dict.fromkeys(domains))
+        due = []
+        ts = time.time()  # pylint: disable=invalid-name
+        for domain, cached in zip(domains, await self._cache.get_many(domains)):
+            if cached is None or cached.negative:
+                done(domain)
+                continue
+            deadline = self.refresh_deadline(cached)
+            if deadline <= ts:
+                due.append((domain, cached))
+            else:
+                # Policy was refreshed by responder meanwhile
+                self._logger.debug("Domain %s skipped (cache recent enough).", domain)
+                heapq.heappush(schedule, (deadline, domain))
+                done(domain)
+        return due
+
+    async def write_updates(self, changed, touched):
+        """ Stores changed policies and timestamps of unchanged ones
+        collected in lists and empties lists. """
+        changed_items, touched_items = changed[:], touched[:]
+        del changed[:], touched[:]
+        if changed_items:
+            await self._cache.safe_set_many(changed_items, self._logger)
+        if touched_items:
+            await self._cache.safe_touch_many([(domain, updated.ts)
+                                               for domain, updated in touched_items],
+                                              self._logger)
+
+    async def refresh_scheduled(self, domains, schedule, done):
+        """ Refreshes domains which are due for refresh and reschedules them.
+        Cache is read for all domains at once and updated in chunks as
+        fetches complete. Domains which have no policy anymore get negative
+        cache entry once their cached policy expires. done(domain) is called
+        when domain is put back to schedule or dropped from it. """
+        changed = []
+        touched = []
+        fetches = [self._loop.create_task(self._fetch_due(domain, cached))
+                   for domain, cached in await self.select_due(domains, schedule, done)]
+        try:
+            for fetch in asyncio.as_completed(fetches):
+                domain, cached, status, updated = await fetch
+                if status is STSFetchResult.VALID:
+                    changed.append((domain, updated))
+                elif status is STSFetchResult.NOT_CHANGED:
+                    touched.append((domain, updated))
+                deadline = self.reschedule(domain, cached, status, updated)
+                if deadline is not None:
+                    heapq.heappush(schedule, (deadline, domain))
+                else:
+                    self._logger.info("Domain %s dropped from schedule "
+                                      "(policy expired).", domain)
+                    if self._negative_ttl > 0:
+                        changed.append((domain, negative_entry(time.time())))
+                done(domain)
+                if len(changed) + len(touched) >= constants.PROACTIVE_FETCH_WRITE_BATCH:
+                    await self.write_updates(changed, touched)
+            await self.write_updates(changed, touched)
+        finally:
+            for fetch in fetches:
+                fetch.cancel()
+
+    async def fetch_scheduled(self):
+        """ Refreshes every domain when its deadline comes. Schedule is
+        rebuilt from cache every `interval` to pick up new domains. At most
+        `concurrency_limit` domains are refreshed at the same time. """
+        schedule = []
+        rebuild_ts = 0
+        wakeup = asyncio.Event()
+        # Domains taken from schedule and not put back yet
+        inflight = set()
+        refreshes = set()
+
+        def done(domain):
+            inflight.discard(domain)
+            wakeup.set()
+
+        async def refresh(domains):
+            try:
+                await self.refresh_scheduled(domains, schedule, done)
+            except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
+                raise
+            except Exception as exc:  # pragma: no cover
+                self._logger.exception("Unhandled exception: %s", exc)
+                # Retry domains which were not rescheduled
+                retry_ts = time.time() + constants.PROACTIVE_FETCH_RETRY_DELAY
+                for domain in domains:
+                    if domain in inflight:
+                        heapq.heappush(schedule, (retry_ts, domain))
+                        done(domain)
+
+        try:
+            while True:  # Run until cancelled
+                ts = time.time()  # pylint: disable=invalid-name
+                if ts >= rebuild_ts:
+                    rebuilt = await self.build_schedule()
+                    # Domains being refreshed are put back when done
+                    schedule[:] = [item for item in rebuilt if item[1] not in inflight]
+                    heapq.heapify(schedule)
+                    rebuild_ts = ts + self._pf_interval
+                can_start = len(inflight) < self._pf_concurrency_limit
+                if can_start and schedule and schedule[0][0] <= ts:
+                    domains = []
+                    while (schedule and schedule[0][0] <= ts and
+                           len(domains) < constants.DOMAIN_QUEUE_LIMIT and
+                           len(inflight) < self._pf_concurrency_limit):
+                        domain = heapq.heappop(schedule)[1]
+                        if domain not in inflight:
+                            inflight.add(domain)
+                            domains.append(domain)
+                    if domains:
+                        task = self._loop.create_task(refresh(domains))
+                        refreshes.add(task)
+                        task.add_done_callback(refreshes.discard)
+                    continue
+                if can_start and schedule:
+                    next_ts = min(rebuild_ts, schedule[0][0])
+                else:
+                    next_ts = rebuild_ts
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), max(0, next_ts - ts))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in refreshes:
+                task.cancel()
+            await asyncio.gather(*refreshes, return_exceptions=True)
+
+    def stats(self):
+        return dict(("concurrency_" + key, value)
+                    for key, value in self._limiter.stats().items())
+
     async def start(self):
-        self._periodic_fetch_task = self._loop.create_task(self.fetch_periodically())
+        if self._pf_schedule == 'deadline':
+            self._periodic_fetch_task = self._loop.create_task(self.fetch_scheduled())
+        else:
+            self._periodic_fetch_task = self._loop.create_task(self.fetch_periodically())
 
     async def stop(self):
         self._periodic_fetch_task.cancel()
@@ -107,3 +342,5 @@ class STSProactiveFetcher:
             await self._periodic_fetch_task
         except asyncio.CancelledError:  # pragma: no cover
             pass
+        if self._own_resolver:
+            await self._resolver.close()
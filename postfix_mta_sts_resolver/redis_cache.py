@@ -1,10 +1,22 @@
+import asyncio
 import json
+import logging
+import math
+import struct
+import time
 import uuid
 
 from redis import asyncio as aioredis
 from . import defaults
+from .constants import SUBSCRIBE_RETRY_DELAY
 from .base_cache import BaseCache, CacheEntry
 
+# Storage format 2: one string key per domain
+V2_PREFIX = 'sts:'
+# timestamp, length of policy id
+V2_HEADER = struct.Struct('>dH')
+NO_POL_ID = 0xFFFF
+
 def pack_entry(entry):
     ts, pol_id, pol_body = entry  # pylint: disable=invalid-name,unused-variable
     obj = (pol_id, pol_body)
@@ -14,6 +26,15 @@ def pack_entry(entry):
     return packed
 
 
+# Raise score (timestamp) of the only member of entry ZSET
+TOUCH_SCRIPT = """
+local member = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if member[1] and tonumber(member[2]) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], member[1])
+end
+"""
+
+
 def unpack_entry(packed):
     bin_obj = packed[16:]
     obj = json.loads(bin_obj.decode('utf-8'))
@@ -21,23 +42,109 @@ def unpack_entry(packed):
     return CacheEntry(ts=0, pol_id=pol_id, pol_body=pol_body)
 
 
+def pack_entry_v2(entry):
+    ts, pol_id, pol_body = entry  # pylint: disable=invalid-name
+    if pol_id is None:
+        packed = V2_HEADER.pack(ts, NO_POL_ID)
+    else:
+        pol_id = pol_id.encode('utf-8')
+        packed = V2_HEADER.pack(ts, len(pol_id)) + pol_id
+    if pol_body is not None:
+        packed += json.dumps(pol_body, separators=(',', ':')).encode('utf-8')
+    return packed
+
+
+def unpack_entry_v2(packed):
+    ts, id_len = V2_HEADER.unpack_from(packed)  # pylint: disable=invalid-name
+    pos = V2_HEADER.size
+    if id_len == NO_POL_ID:
+        pol_id = None
+    else:
+        pol_id = packed[pos:pos + id_len].decode('utf-8')
+        pos += id_len
+    pol_body = json.loads(packed[pos:]) if len(packed) > pos else None
+    return CacheEntry(ts=ts, pol_id=pol_id, pol_body=pol_body)
+
+
+def entry_expire_at(entry, now, negative_ttl=defaults.NEGATIVE_CACHE_TTL):
+    """ Returns unix time when format 2 key of entry shall expire,
+    or empty string if it shall not expire. """
+    ts, _, pol_body = entry  # pylint: disable=invalid-name
+    if pol_body is None:
+        return int(now) + math.ceil(negative_ttl)
+    if isinstance(pol_body, dict) and 'max_age' in pol_body:
+        return int(ts + pol_body['max_age']) + 1
+    return ''
+
+
+# Store format 2 entry unless stored one is same age or newer
+SET_SCRIPT_V2 = """
+local current = redis.call('GET', KEYS[1])
+if current and struct.unpack('>d', current) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('EXPIREAT', KEYS[1], ARGV[3])
+end
+return 1
+"""
+
+
+# Raise timestamp of format 2 entry, shifting its expiration accordingly
+TOUCH_SCRIPT_V2 = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return 0
+end
+local current_ts = struct.unpack('>d', current)
+local ts = tonumber(ARGV[1])
+if current_ts >= ts then
+    return 0
+end
+redis.call('SETRANGE', KEYS[1], 0, struct.pack('>d', ts))
+local pttl = redis.call('PTTL', KEYS[1])
+if pttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], pttl + math.floor((ts - current_ts) * 1000))
+end
+return 1
+"""
+
+
+# pylint: disable=too-many-instance-attributes
 class RedisCache(BaseCache):
     def __init__(self, **opts):
         self._opts = dict(opts)
+        self._scan_count = self._opts.pop('scan_count', defaults.REDIS_SCAN_COUNT)
+        self._format = self._opts.pop('format', defaults.REDIS_FORMAT)
+        self._negative_ttl = self._opts.pop('negative_ttl', defaults.NEGATIVE_CACHE_TTL)
+        self._migrate_v1 = self._opts.pop('migrate', defaults.REDIS_MIGRATE)
         self._opts['socket_timeout'] = self._opts.get('socket_timeout',
             defaults.REDIS_TIMEOUT)
         self._opts['socket_connect_timeout'] = self._opts.get(
             'socket_connect_timeout', defaults.REDIS_CONNECT_TIMEOUT)
         self._opts['encoding'] = 'utf-8'
         self._pool = None
+        self._touch_script = None
+        self._set_script_v2 = None
+        self._touch_script_v2 = None
+        self._subscriber = None
 
     async def setup(self):
         url = self._opts['url']
         opts = dict((k,v) for k, v in self._opts.items() if k != 'url')
         self._pool = aioredis.from_url(url, **opts)
+        self._register_scripts()
+
+    def _register_scripts(self):
+        self._touch_script = self._pool.register_script(TOUCH_SCRIPT)
+        self._set_script_v2 = self._pool.register_script(SET_SCRIPT_V2)
+        self._touch_script_v2 = self._pool.register_script(TOUCH_SCRIPT_V2)
 
     async def get(self, key):
         assert self._pool is not None
+        if self._format == 2:
+            return (await self.get_many([key]))[0]
         key = key.encode('utf-8')
         res = await self._pool.zrevrange(key, 0, 0, withscores=True)
         if not res:
@@ -48,14 +155,124 @@ class RedisCache(BaseCache):
 
     async def set(self, key, value):
         assert self._pool is not None
-        packed = pack_entry(value)
-        ts = value.ts  # pylint: disable=invalid-name
+        if self._format == 2:
+            await self._set_v2(key, value, time.time())
+            return
+        # Write
+        async with self._pool.pipeline(transaction=True) as pipe:
+            self._set_v1(key, value, pipe)
+            await pipe.execute()
+
+    def _set_v1(self, key, value, pipe):
+        """ Queues format 1 write of entry into transaction """
         key = key.encode('utf-8')
+        pipe.zadd(key, {pack_entry(value): value.ts})
+        pipe.zremrangebyrank(key, 0, -2)
+        # Keys of negative entries expire, so domains without policy
+        # do not pile up in keyspace
+        if value.negative:
+            pipe.expire(key, math.ceil(self._negative_ttl))
+        else:
+            pipe.persist(key)
 
-        # Write
+    async def _set_v2(self, key, value, now, client=None):
+        return await self._set_script_v2(keys=[(V2_PREFIX + key).encode('utf-8')],
+                                         args=[value.ts, pack_entry_v2(value),
+                                               entry_expire_at(value, now,
+                                                               self._negative_ttl)],
+                                         client=client)
+
+    async def _get_v1(self, keys):
+        """ Reads entries stored in format 1 """
+        async with self._pool.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zrevrange(key.encode('utf-8'), 0, 0, withscores=True)
+            replies = await pipe.execute()
+        result = []
+        for res in replies:
+            if not res:
+                result.append(None)
+                continue
+            packed, ts = res[0]  # pylint: disable=invalid-name
+            entry = unpack_entry(packed)
+            result.append(CacheEntry(ts=ts, pol_id=entry.pol_id, pol_body=entry.pol_body))
+        return result
+
+    async def _get_v2(self, keys):
+        """ Reads entries stored in format 2 """
+        async with self._pool.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get((V2_PREFIX + key).encode('utf-8'))
+            replies = await pipe.execute()
+        return [None if res is None else unpack_entry_v2(res) for res in replies]
+
+    async def _migrate(self, items):
+        """ Rewrites format 1 entries in format 2 and removes old keys """
+        now = time.time()
+        async with self._pool.pipeline(transaction=False) as pipe:
+            for key, value in items:
+                await self._set_v2(key, value, now, pipe)
+                pipe.delete(key.encode('utf-8'))
+            await pipe.execute()
+
+    async def _get_v1_migrated(self, keys):
+        """ Reads format 1 entries and migrates found ones to format 2 """
+        entries = await self._get_v1(keys)
+        found = [(key, entry) for key, entry in zip(keys, entries) if entry is not None]
+        if found:
+            await self._migrate(found)
+        return entries
+
+    async def get_many(self, keys):
+        assert self._pool is not None
+        if not keys:
+            return []
+        if self._format != 2:
+            return await self._get_v1(keys)
+        result = await self._get_v2(keys)
+        missing = [idx for idx, entry in enumerate(result) if entry is None]
+        if missing and self._migrate_v1:
+            # Look for entries not migrated yet
+            legacy = await self._get_v1_migrated([keys[idx] for idx in missing])
+            for idx, entry in zip(missing, legacy):
+                result[idx] = entry
+        return result
+
+    async def set_many(self, items):
+        assert self._pool is not None
+        if not items:
+            return
+        if self._format == 2:
+            now = time.time()
+            async with self._pool.pipeline(transaction=False) as pipe:
+                for key, value in items:
+                    await self._set_v2(key, value, now, pipe)
+                await pipe.execute()
+            return
         async with self._pool.pipeline(transaction=True) as pipe:
-            pipe.zadd(key, {packed: ts})
-            pipe.zremrangebyrank(key, 0, -2)
+            for key, value in items:
+                self._set_v1(key, value, pipe)
+            await pipe.execute()
+
+    async def touch(self, key, ts):  # pylint: disable=invalid-name
+        assert self._pool is not None
+        if self._format == 2:
+            await self._touch_script_v2(keys=[(V2_PREFIX + key).encode('utf-8')], args=[ts])
+        else:
+            await self._touch_script(keys=[key.encode('utf-8')], args=[ts])
+
+    async def touch_many(self, items):
+        assert self._pool is not None
+        if not items:
+            return
+        async with self._pool.pipeline(transaction=False) as pipe:
+            for key, ts in items:
+                if self._format == 2:
+                    await self._touch_script_v2(keys=[(V2_PREFIX + key).encode('utf-8')],
+                                                args=[ts], client=pipe)
+                else:
+                    await self._touch_script(keys=[key.encode('utf-8')], args=[ts],
+                                             client=pipe)
             await pipe.execute()
 
     async def scan(self, token, amount_hint):
@@ -63,15 +280,29 @@ class RedisCache(BaseCache):
         if token is None:
             token = b'0'
 
-        new_token, keys = await self._pool.scan(cursor=token, count=amount_hint)
+        count = amount_hint if self._scan_count is None else self._scan_count
+        new_token, keys = await self._pool.scan(cursor=token, count=count)
         if not new_token:
             new_token = None
 
-        result = []
-        for key in keys:
-            key = key.decode('utf-8')
-            if key != '_metadata':
-                result.append((key, await self.get(key)))
+        # Fetch entries of whole page in one round trip
+        keys = [key.decode('utf-8') for key in keys]
+        if self._format == 2:
+            v2_keys = [key[len(V2_PREFIX):] for key in keys if key.startswith(V2_PREFIX)]
+            v1_keys = [key for key in keys
+                       if not key.startswith(V2_PREFIX) and key != '_metadata']
+            if not self._migrate_v1:
+                v1_keys = []
+            keys = v2_keys + v1_keys
+            entries = await self._get_v2(v2_keys)
+            if v1_keys:
+                entries += await self._get_v1_migrated(v1_keys)
+        else:
+            keys = [key for key in keys if key != '_metadata']
+            entries = await self.get_many(keys)
+        # Skip keys removed after they were scanned
+        result = [(key, entry) for key, entry in zip(keys, entries)
+                  if entry is not None]
         return new_token, result
 
     async def get_proactive_fetch_ts(self):
@@ -84,13 +315,61 @@ class RedisCache(BaseCache):
         val = str(timestamp).encode('utf-8')
         await self._pool.hset('_metadata', 'proactive_fetch_ts', val)
 
+    async def publish(self, channel, messages):
+        assert self._pool is not None
+        async with self._pool.pipeline(transaction=False) as pipe:
+            for message in messages:
+                pipe.publish(channel, message)
+            await pipe.execute()
+
+    async def subscribe(self, channel, callback):
+        assert self._pool is not None
+        self._subscriber = asyncio.ensure_future(self._listen(channel, callback))
+        return True
+
+    async def _listen(self, channel, callback):
+        logger = logging.getLogger("STS")
+        lost = False
+        while True:
+            pubsub = self._pool.pubsub()
+            try:
+                await pubsub.subscribe(channel)
+                if lost:
+                    lost = False
+                    callback(None)
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True,
+                                                   timeout=1.)
+                    if msg is not None:
+                        callback(msg['data'].decode('utf-8'))
+            except asyncio.CancelledError:  # pylint: disable=try-except-raise
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning("Subscription to Redis channel %s failed: %s",
+                               channel, str(exc))
+                lost = True
+            finally:
+                await pubsub.reset()
+            await asyncio.sleep(SUBSCRIBE_RETRY_DELAY)
+
     async def teardown(self):
         assert self._pool is not None
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            try:
+                await self._subscriber
+            except asyncio.CancelledError:
+                pass
+            self._subscriber = None
         await self._pool.close()
 
-class RedisSentinelCache(BaseCache):
-    def __init__(self, **opts):
+class RedisSentinelCache(RedisCache):
+    def __init__(self, **opts):  # pylint: disable=super-init-not-called
         self._opts = dict(opts)
+        self._scan_count = self._opts.pop('scan_count', defaults.REDIS_SCAN_COUNT)
+        self._format = self._opts.pop('format', defaults.REDIS_FORMAT)
+        self._negative_ttl = self._opts.pop('negative_ttl', defaults.NEGATIVE_CACHE_TTL)
+        self._migrate_v1 = self._opts.pop('migrate', defaults.REDIS_MIGRATE)
         self._opts['socket_timeout'] = self._opts.get(
             'socket_timeout',defaults.REDIS_TIMEOUT
         )
@@ -99,6 +378,10 @@ class RedisSentinelCache(BaseCache):
         )
         self._opts['encoding'] = 'utf-8'
         self._pool = None
+        self._touch_script = None
+        self._set_script_v2 = None
+        self._touch_script_v2 = None
+        self._subscriber = None
 
     async def setup(self):
         sentinel = aioredis.sentinel.Sentinel(self._opts['sentinels'])
@@ -107,55 +390,4 @@ class RedisSentinelCache(BaseCache):
             self._opts.pop(key)
         opts = dict((k,v) for k, v in self._opts.items())
         self._pool = sentinel.master_for(sentinel_master_name, **opts)
-
-    async def get(self, key):
-        assert self._pool is not None
-        key = key.encode('utf-8')
-        res = await self._pool.zrevrange(key, 0, 0, withscores=True)
-        if not res:
-            return None
-        packed, ts = res[0]  # pylint: disable=invalid-name
-        entry = unpack_entry(packed)
-        return CacheEntry(ts=ts, pol_id=entry.pol_id, pol_body=entry.pol_body)
-
-    async def set(self, key, value):
-        assert self._pool is not None
-        packed = pack_entry(value)
-        ts = value.ts  # pylint: disable=invalid-name
-        key = key.encode('utf-8')
-
-        # Write
-        async with self._pool.pipeline(transaction=True) as pipe:
-            pipe.zadd(key, {packed: ts})
-            pipe.zremrangebyrank(key, 0, -2)
-            await pipe.execute()
-
-    async def scan(self, token, amount_hint):
-        assert self._pool is not None
-        if token is None:
-            token = b'0'
-
-        new_token, keys = await self._pool.scan(cursor=token, count=amount_hint)
-        if not new_token:
-            new_token = None
-
-        result = []
-        for key in keys:
-            key = key.decode('utf-8')
-            if key != '_metadata':
-                result.append((key, await self.get(key)))
-        return new_token, result
-
-    async def get_proactive_fetch_ts(self):
-        assert self._pool is not None
-        val = await self._pool.hget('_metadata', 'proactive_fetch_ts')
-        return 0 if not val else float(val.decode('utf-8'))
-
-    async def set_proactive_fetch_ts(self, timestamp):
-        assert self._pool is not None
-        val = str(timestamp).encode('utf-8')
-        await self._pool.hset('_metadata', 'proactive_fetch_ts', val)
-
-    async def teardown(self):
-        assert self._pool is not None
-        await self._pool.close()
+        self._register_scripts()
@@ -1,15 +1,20 @@
 import asyncio
 import enum
 import logging
+import socket
+import ssl
 from io import BytesIO
 
 import aiodns
 import aiodns.error
 import aiohttp
+import aiohttp.abc
+import pycares
 
 from . import defaults
+from .dns_cache import DNSCache
 from .utils import parse_mta_sts_record, parse_mta_sts_policy, is_plaintext, filter_text
-from .constants import HARD_RESP_LIMIT, CHUNK
+from .constants import HARD_RESP_LIMIT, CHUNK, HTTP_CONN_LIMIT, HTTP_CONN_LIMIT_PER_HOST
 
 
 class BadSTSPolicy(Exception):
@@ -25,17 +30,86 @@ class STSFetchResult(enum.Enum):
 
 _HEADERS = {"User-Agent": defaults.USER_AGENT}
 
+_SSL_CONTEXT = None
+
+
+def _get_ssl_context():
+    """ Returns SSL context shared by all resolvers, so CA certificates are
+    loaded only once. """
+    global _SSL_CONTEXT  # pylint: disable=global-statement
+    if _SSL_CONTEXT is None:
+        _SSL_CONTEXT = ssl.create_default_context()
+    return _SSL_CONTEXT
+
+
+_DNS_CACHE = None
+
+
+def _get_dns_cache():
+    """ Returns DNS cache shared by all resolvers. """
+    global _DNS_CACHE  # pylint: disable=global-statement
+    if _DNS_CACHE is None:
+        _DNS_CACHE = DNSCache()
+    return _DNS_CACHE
+
+
+class CachingHostResolver(aiohttp.abc.AbstractResolver):
+    """ Host name resolver for aiohttp which looks up addresses of MTA-STS
+    policy hosts through cached DNS queries of STSResolver. Other hosts
+    (like proxy) and policy hosts not resolved with DNS are resolved with
+    system resolver, which honors /etc/hosts and NSS. """
+
+    _QTYPES = {
+        socket.AF_INET: (('A', socket.AF_INET),),
+        socket.AF_INET6: (('AAAA', socket.AF_INET6),),
+    }
+
+    def __init__(self, query, fallback=None):
+        self._query = query
+        self._fallback = aiohttp.ThreadedResolver() if fallback is None else fallback
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        if not host.startswith('mta-sts.'):
+            return await self._fallback.resolve(host, port, family)
+        qtypes = self._QTYPES.get(family,
+                                  (('A', socket.AF_INET), ('AAAA', socket.AF_INET6)))
+        hosts = []
+        for qtype, qfamily in qtypes:
+            try:
+                addresses = await self._query(host, qtype)
+            except (aiodns.error.DNSError, asyncio.TimeoutError):
+                continue
+            hosts.extend({
+                "hostname": host,
+                "host": address,
+                "port": port,
+                "family": qfamily,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            } for address in addresses)
+        if not hosts:
+            return await self._fallback.resolve(host, port, family)
+        return hosts
+
+    async def close(self):
+        await self._fallback.close()
+
+
 # pylint: disable=too-few-public-methods
 # pylint: disable=too-many-instance-attributes
 # pylint: disable=too-many-statements
 class STSResolver:
-    def __init__(self, *, timeout=defaults.TIMEOUT, loop):
+    def __init__(self, *, timeout=defaults.TIMEOUT, loop, dns_cache=None):
         self._loop = loop
         self._timeout = timeout
         self._resolver = aiodns.DNSResolver(timeout=timeout, loop=loop)
+        self._dns_cache = _get_dns_cache() if dns_cache is None else dns_cache
+        # In-flight resolutions table: (domain, last_known_id) -> task
+        self._inflight = {}
         self._http_timeout = aiohttp.ClientTimeout(total=timeout)
         self._proxy_info = aiohttp.helpers.proxies_from_env().get('https', None)
         self._logger = logging.getLogger("RES")
+        self._session = None
 
         if self._proxy_info is None:
             self._proxy = None
@@ -44,8 +118,94 @@ class STSResolver:
             self._proxy = self._proxy_info.proxy
             self._proxy_auth = self._proxy_info.proxy_auth
 
+    def _get_session(self):
+        """ Returns HTTP session of this resolver, creating it on first use.
+        Session keeps pool of connections to policy hosts for reuse. """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=HTTP_CONN_LIMIT,
+                                             limit_per_host=HTTP_CONN_LIMIT_PER_HOST,
+                                             ssl=_get_ssl_context(),
+                                             resolver=CachingHostResolver(self._query_addresses),
+                                             use_dns_cache=False)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=self._http_timeout)
+        return self._session
+
+    async def _query(self, name, qtype, timeout=None):
+        """ Performs DNS query, answering from DNS cache when possible. """
+        records = self._dns_cache.get(name, qtype)
+        if records is None:
+            records = await asyncio.wait_for(self._resolver.query(name, qtype),
+                                             timeout=self._timeout if timeout is None
+                                             else timeout)
+            if records:
+                self._dns_cache.set(name, qtype, records,
+                                    min(rec.ttl for rec in records))
+        return records
+
+    async def _query_addresses(self, name, qtype):
+        """ Returns addresses from A or AAAA records of name, answering
+        from DNS cache when possible. """
+        addresses = self._dns_cache.get(name, qtype)
+        if addresses is None:
+            if hasattr(self._resolver, 'query_dns'):
+                result = await asyncio.wait_for(self._resolver.query_dns(name, qtype),
+                                                timeout=self._timeout)
+                # Answer may contain CNAME records too
+                records = [(rec.data.addr, rec.ttl) for rec in result.answer
+                           if isinstance(rec.data, (pycares.ARecordData,
+                                                    pycares.AAAARecordData))]
+            else:  # pragma: no cover
+                # aiodns before 4.0
+                result = await asyncio.wait_for(self._resolver.query(name, qtype),
+                                                timeout=self._timeout)
+                records = [(rec.host, rec.ttl) for rec in result]
+            addresses = [address for address, _ in records]
+            if records:
+                self._dns_cache.set(name, qtype, addresses,
+                                    min(ttl for _, ttl in records))
+        return addresses
+
+    async def close(self):
+        pending = [task for task, _ in self._inflight.values()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def resolve(self, domain, last_known_id=None, timeout=None):
+        """ Returns awaitable with result of policy resolution for domain.
+        Network operations are limited by `timeout`, which defaults to
+        timeout of resolver. Concurrent resolutions of same domain with
+        same last known policy ID share result of the first one. Caller
+        with shorter timeout than the shared resolution waits for it no
+        longer than own timeout and gets FETCH_ERROR result on expiration. """
+        if timeout is None:
+            timeout = self._timeout
+        key = (domain, last_known_id)
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            task = asyncio.ensure_future(self._resolve(domain, last_known_id, timeout),
+                                         loop=self._loop)
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            inflight = self._inflight[key] = task, timeout
+        task, task_timeout = inflight
+        # Cancellation of one waiter shall not affect others
+        if timeout < task_timeout:
+            return self._wait_shared(task, timeout)
+        return asyncio.shield(task)
+
+    @staticmethod
+    async def _wait_shared(task, timeout):
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            return STSFetchResult.FETCH_ERROR, None
+
     # pylint: disable=too-many-locals,too-many-branches,too-many-return-statements
-    async def resolve(self, domain, last_known_id=None):
+    async def _resolve(self, domain, last_known_id, timeout):
         if domain.startswith('.'):
             return STSFetchResult.NONE, None
         # Cleanup domain name
@@ -58,9 +218,7 @@ class STSResolver:
 
         # Try to fetch it
         try:
-            txt_records = await asyncio.wait_for(
-                self._resolver.query(sts_txt_domain, 'TXT'),
-                timeout=self._timeout)
+            txt_records = await self._query(sts_txt_domain, 'TXT', timeout)
         except aiodns.error.DNSError as error:
             if error.args[0] == aiodns.error.ARES_ETIMEOUT:  # pragma: no cover pylint: disable=no-else-return,no-member
                 # This branch is not covered because of aiodns bug:
@@ -109,31 +267,30 @@ class STSResolver:
 
         # Fetch actual policy
         try:
-            async with aiohttp.ClientSession(loop=self._loop,
-                                             timeout=self._http_timeout) \
-                                                 as session:
-                async with session.get(sts_policy_url,
-                                       allow_redirects=False,
-                                       proxy=self._proxy, headers=_HEADERS,
-                                       proxy_auth=self._proxy_auth) as resp:
-                    if resp.status != 200:
-                        raise BadSTSPolicy()
-                    if not is_plaintext(resp.headers.get('Content-Type', '')):
-                        raise BadSTSPolicy()
-                    if (int(resp.headers.get('Content-Length', '0')) >
-                            HARD_RESP_LIMIT):
-                        raise BadSTSPolicy()
-                    policy_file = BytesIO()
-                    while policy_file.tell() <= HARD_RESP_LIMIT:
-                        chunk = await resp.content.read(CHUNK)
-                        if not chunk:
-                            break
-                        policy_file.write(chunk)
-                    else:
-                        raise BadSTSPolicy()
-                    charset = (resp.charset if resp.charset is not None
-                               else 'ascii')
-                    policy_text = policy_file.getvalue().decode(charset)
+            session = self._get_session()
+            async with session.get(sts_policy_url,
+                                   allow_redirects=False,
+                                   proxy=self._proxy, headers=_HEADERS,
+                                   proxy_auth=self._proxy_auth,
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                if resp.status != 200:
+                    raise BadSTSPolicy()
+                if not is_plaintext(resp.headers.get('Content-Type', '')):
+                    raise BadSTSPolicy()
+                if (int(resp.headers.get('Content-Length', '0')) >
+                        HARD_RESP_LIMIT):
+                    raise BadSTSPolicy()
+                policy_file = BytesIO()
+                while policy_file.tell() <= HARD_RESP_LIMIT:
+                    chunk = await resp.content.read(CHUNK)
+                    if not chunk:
+                        break
+                    policy_file.write(chunk)
+                else:
+                    raise BadSTSPolicy()
+                charset = (resp.charset if resp.charset is not None
+                           else 'ascii')
+                policy_text = policy_file.getvalue().decode(charset)
         except Exception as exc:
             self._logger.warning("STS policy fetch for domain %s failed with "
                                  "error: %s", repr(domain), str(exc))
@@ -172,3 +329,11 @@ class STSResolver:
 
         # Policy is valid. Returning result.
         return STSFetchResult.VALID, (mta_sts_record['id'], pol)
+
+
+def create_resolver(cfg, loop):
+    """ Creates resolver shared by all zones. Timeouts of zones are passed
+    with every resolve() call, so resolver itself gets the largest one. """
+    timeout = max(zone['timeout'] for zone in
+                  [cfg['default_zone']] + list(cfg['zones'].values()))
+    return STSResolver(loop=loop, timeout=timeout)
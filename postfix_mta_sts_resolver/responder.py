@@ -2,25 +2,29 @@ import asyncio
 import logging
 import time
 import collections
+import random
 import sys
 import os
 import socket
-from functools import partial
 
-from .resolver import STSResolver, STSFetchResult
-from .constants import QUEUE_LIMIT, CHUNK, REQUEST_LIMIT
+from .resolver import STSFetchResult, create_resolver
+from .constants import RESPONSE_CACHE_LIMIT
 from .utils import create_custom_socket, filter_domain, is_ipaddr
-from .base_cache import CacheEntry
+from .base_cache import CacheEntry, negative_entry
+from .fetch_backoff import FetchBackoff
+from .socketmap import SocketmapProtocol
 from . import netstring
 
 REQUEST_ENCODING = 'utf-8'
+NOTFOUND_RESPONSE = netstring.encode(b'NOTFOUND ')
 
-ZoneEntry = collections.namedtuple('ZoneEntry', ('strict', 'resolver', 'require_sni', 'tlsrpt'))
+ZoneEntry = collections.namedtuple('ZoneEntry', ('strict', 'resolver', 'timeout',
+                                               'require_sni', 'tlsrpt', 'deadline'))
 
 
 # pylint: disable=too-many-instance-attributes
 class STSSocketmapResponder:
-    def __init__(self, cfg, loop, cache):
+    def __init__(self, cfg, loop, cache, resolver=None):
         self._logger = logging.getLogger("STS")
         self._loop = loop
         if cfg.get('path') is not None:
@@ -34,25 +38,51 @@ class STSSocketmapResponder:
         self._reuse_port = cfg['reuse_port']
         self._shutdown_timeout = cfg['shutdown_timeout']
         self._grace = cfg['cache_grace']
-
-        # Construct configurations and resolvers for every socketmap name
+        self._negative_ttl = cfg['negative_cache_ttl']
+        if cfg['fetch_backoff']['enabled']:
+            self._backoff = FetchBackoff(cfg['fetch_backoff']['initial'],
+                                         cfg['fetch_backoff']['max'])
+        else:
+            self._backoff = None
+        self._swr_enabled = cfg['background_refresh']['stale_while_revalidate']
+        self._refresh_ahead = cfg['background_refresh']['refresh_ahead']
+
+        # Construct configurations for every socketmap name. All of them
+        # share one resolver, which is owned by caller if it is passed
+        self._own_resolver = resolver is None
+        if resolver is None:
+            resolver = create_resolver(cfg, loop)
+        self._resolver = resolver
         self._default_zone = ZoneEntry(cfg["default_zone"]["strict_testing"],
-                                       STSResolver(loop=loop,
-                                                   timeout=cfg["default_zone"]["timeout"]),
+                                       resolver,
+                                       cfg["default_zone"]["timeout"],
                                        cfg["default_zone"]["require_sni"],
-                                       cfg["default_zone"]["tlsrpt"])
+                                       cfg["default_zone"]["tlsrpt"],
+                                       cfg["default_zone"]["response_deadline"])
 
         self._zones = dict((k, ZoneEntry(zone["strict_testing"],
-                                         STSResolver(loop=loop,
-                                                     timeout=zone["timeout"]),
+                                         resolver,
+                                         zone["timeout"],
                                          zone["require_sni"],
-                                         zone["tlsrpt"]))
+                                         zone["tlsrpt"],
+                                         zone["response_deadline"]))
                            for k, zone in cfg["zones"].items())
 
         self._cache = cache
-        self._children = set()
+        self._connections = set()
         self._server = None
 
+        # In-flight lookups table: domain -> task
+        self._inflight = {}
+        # Cache entries read by lookups in progress: domain -> entry
+        self._lookup_cached = {}
+        # Background refreshes table: domain -> task
+        self._refreshing = {}
+        # Encoded responses: domain -> (pol_id, {response flags: bytes}),
+        # least recently used first
+        self._responses = collections.OrderedDict()
+        self._stats = collections.Counter()
+
     # Check if cached record is nonexistent or stale
     def is_stale(self, cached):
         ts = time.time()  # pylint: disable=invalid-name
@@ -61,6 +91,10 @@ class STSSocketmapResponder:
         if cached is None:
             return True
 
+        # Negative entry expired ?
+        if cached.negative:
+            return ts - cached.ts > self._negative_ttl
+
         # Expired grace period ?
         if ts - cached.ts > self._grace:
             return True
@@ -71,17 +105,175 @@ class STSSocketmapResponder:
 
         return False
 
+    # Check if cached record holds policy which is not expired yet
+    @staticmethod
+    def is_usable(cached):
+        return (cached is not None and not cached.negative and
+                cached.pol_body['max_age'] + cached.ts >= time.time())
+
+    # Decide if cached policy approaching its expiration shall be refreshed
+    # early. Probability of refresh grows linearly within refresh-ahead window.
+    def refresh_ahead_due(self, cached):
+        if self._refresh_ahead <= 0 or cached.negative:
+            return False
+        window = cached.pol_body['max_age'] * self._refresh_ahead
+        if window <= 0:
+            return False
+        remaining = cached.pol_body['max_age'] + cached.ts - time.time()
+        return random.random() * window > remaining
+
+    def stats(self):
+        res = {
+            "requests": self._stats["requests"],
+            "lookups": self._stats["lookups"],
+            "coalesced": self._stats["coalesced"],
+            "immediate": self._stats["immediate"],
+            "inflight": len(self._inflight),
+            "backoff_skipped": self._stats["backoff_skipped"],
+            "background_refreshes": self._stats["background_refreshes"],
+            "deadline_expired": self._stats["deadline_expired"],
+            "refreshing": len(self._refreshing),
+        }
+        if self._backoff is not None:
+            backoff_stats = self._backoff.stats()
+            res["backoff_domains"] = backoff_stats["domains"]
+            res["backoff_blocked"] = backoff_stats["blocked"]
+        return res
+
+    async def refresh_policy(self, domain, zone_cfg, cached):
+        """ Resolves policy for domain and updates cache. Returns cache entry
+        which supersedes cached one or None if there is no valid policy. """
+        ts = time.time()  # pylint: disable=invalid-name
+        if self._backoff is not None and self._backoff.blocked(domain):
+            # Recent fetches failed. Act as if this one failed too.
+            self._logger.debug("Lookup SKIPPED due to backoff: domain = %s", domain)
+            self._stats["backoff_skipped"] += 1
+            status, policy = STSFetchResult.FETCH_ERROR, None
+        else:
+            self._logger.debug("Lookup PERFORMED: domain = %s", domain)
+            # Check if newer policy exists or
+            # retrieve policy from scratch if there is no cached one
+            latest_pol_id = None if cached is None else cached.pol_id
+            status, policy = await zone_cfg.resolver.resolve(domain, latest_pol_id,
+                                                             timeout=zone_cfg.timeout)
+            if self._backoff is not None:
+                if status is STSFetchResult.FETCH_ERROR:
+                    delay = self._backoff.failure(domain)
+                    self._logger.debug("Fetch failed, next attempt in %.1fs: "
+                                       "domain = %s", delay, domain)
+                else:
+                    self._backoff.success(domain)
+
+        if status is STSFetchResult.NOT_CHANGED:
+            cached = CacheEntry(ts, cached.pol_id, cached.pol_body)
+            await self._cache.safe_touch(domain, ts, self._logger)
+        elif status is STSFetchResult.VALID:
+            pol_id, pol_body = policy
+            cached = CacheEntry(ts, pol_id, pol_body)
+            await self._cache.safe_set(domain, cached, self._logger)
+        elif status is STSFetchResult.NONE and (
+                cached is None or cached.negative or
+                cached.pol_body['max_age'] + cached.ts < ts):
+            # Remember domain has no policy unless there is
+            # unexpired cached one, which remains in use
+            cached = None
+            if self._negative_ttl > 0:
+                await self._cache.safe_set(domain, negative_entry(ts), self._logger)
+        else:
+            # Check if cached policy is expired
+            if (cached is not None and not cached.negative and
+                    cached.pol_body['max_age'] + cached.ts < ts):
+                cached = None
+        return cached
+
+    def refresh_in_background(self, domain, zone_cfg, cached):
+        """ Schedules refresh_policy() for domain unless one is already
+        running in background. """
+        if domain in self._refreshing:
+            return
+        self._stats["background_refreshes"] += 1
+        self._logger.debug("Lookup DEFERRED to background: domain = %s", domain)
+
+        async def refresh():
+            try:
+                await self.refresh_policy(domain, zone_cfg, cached)
+            except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
+                raise
+            except Exception as exc:  # pragma: no cover
+                self._logger.exception("Background refresh failed: %s", str(exc))
+
+        task = self._loop.create_task(refresh())
+        self._refreshing[domain] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(domain, None))
+
+    async def fetch_policy(self, domain, zone_cfg):
+        """ Fetches policy for domain from cache, refreshes it if needed and
+        updates cache. Returns cache entry with usable policy or None if there
+        is no valid policy for this domain. """
+        # Lookup for cached policy
+        try:
+            cached = await self._cache.get(domain)
+        except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
+            raise
+        except Exception as exc:  # pragma: no cover
+            self._logger.exception("Cache get failed: %s", str(exc))
+            cached = None
+        self._lookup_cached[domain] = cached
+
+        # DNS lookup and cache update
+        if self.is_stale(cached):
+            if self._swr_enabled and self.is_usable(cached):
+                # Answer with policy which is still valid and refresh it later
+                self.refresh_in_background(domain, zone_cfg, cached)
+            else:
+                cached = await self.refresh_policy(domain, zone_cfg, cached)
+        elif self.refresh_ahead_due(cached):
+            self.refresh_in_background(domain, zone_cfg, cached)
+        else:
+            self._logger.debug("Lookup skipped: domain = %s", domain)
+
+        if cached is not None and cached.negative:
+            return None
+        return cached
+
+    def fallback_policy(self, domain):
+        """ Returns cached policy for domain if it is not expired yet or None.
+        Used to answer when lookup does not fit into response deadline, so
+        cache backend is not queried again: entry is taken from lookup in
+        progress or from cache memory if that lookup has not read it yet. """
+        if domain in self._lookup_cached:
+            cached = self._lookup_cached[domain]
+        else:
+            cached = self._cache.get_nowait(domain)
+        return cached if self.is_usable(cached) else None
+
+    def _lookup_done(self, domain):
+        self._inflight.pop(domain, None)
+        self._lookup_cached.pop(domain, None)
+
+    def lookup(self, domain, zone_cfg):
+        """ Returns awaitable with result of fetch_policy() for domain.
+        Only one fetch_policy() runs for given domain at the same time:
+        concurrent lookups share result of the one already in progress. """
+        self._stats["requests"] += 1
+        task = self._inflight.get(domain)
+        if task is None:
+            self._stats["lookups"] += 1
+            task = self._loop.create_task(self.fetch_policy(domain, zone_cfg))
+            self._inflight[domain] = task
+            task.add_done_callback(lambda _: self._lookup_done(domain))
+        else:
+            self._stats["coalesced"] += 1
+            self._logger.debug("Lookup coalesced: domain = %s", domain)
+        # Cancellation of one waiter shall not affect others
+        return asyncio.shield(task)
+
     async def start(self):
-        def _spawn(reader, writer):
-            def done_cb(task, fut):
-                self._children.discard(task)
-            task = self._loop.create_task(self.handler(reader, writer))
-            task.add_done_callback(partial(done_cb, task))
-            self._children.add(task)
-            self._logger.debug("len(self._children) = %d", len(self._children))
+        def _spawn():
+            return SocketmapProtocol(self)
 
         if self._unix:
-            self._server = await asyncio.start_unix_server(_spawn, path=self._path)
+            self._server = await self._loop.create_unix_server(_spawn, path=self._path)
             if self._sockmode is not None:
                 os.chmod(self._path, self._sockmode)
         else:
@@ -110,117 +302,84 @@ class STSSocketmapResponder:
                             'reuse_address': True,
                             'reuse_port': True,
                         }
-            self._server = await asyncio.start_server(_spawn, **opts)
+            self._server = await self._loop.create_server(_spawn, **opts)
+
+    def connection_made(self, conn):
+        self._connections.add(conn)
+        self._logger.debug("len(self._connections) = %d", len(self._connections))
+
+    def connection_lost(self, conn):
+        self._connections.discard(conn)
 
     async def stop(self):
         self._server.close()
-        await self._server.wait_closed()
-        while True:
-            self._logger.warning("Awaiting %d client handlers to finish...",
-                                 len(self._children))
-            remaining = asyncio.gather(*self._children, return_exceptions=True)
-            self._children.clear()
-            try:
-                await asyncio.wait_for(remaining, self._shutdown_timeout)
-            except asyncio.TimeoutError:
-                self._logger.warning("Shutdown timeout expired. "
-                                     "Remaining handlers terminated.")
-                try:
-                    await remaining
-                except asyncio.CancelledError:
-                    pass
-            await asyncio.sleep(1)
-            if not self._children:
-                break
-
-    async def sender(self, queue, writer):
-        def cleanup_queue():
-            while not queue.empty():
-                task = queue.get_nowait()
-                try:
-                    task.cancel()
-                except Exception:  # pragma: no cover
-                    pass
-
+        connections = list(self._connections)
+        self._logger.warning("Awaiting %d client connections to finish...",
+                             len(connections))
+        for conn in connections:
+            conn.shutdown()
+        remaining = asyncio.gather(*(conn.wait_closed() for conn in connections))
         try:
-            while True:
-                fut = await queue.get()
-                # Check for shutdown
-                if fut is None:
-                    return
-                self._logger.debug("Got new future from queue")
-                data = await fut
-                self._logger.debug("Future await complete: data=%s", repr(data))
-                writer.write(data)
-                self._logger.debug("Wrote: %s", repr(data))
-                await writer.drain()
-        except asyncio.CancelledError:
-            cleanup_queue()
-        except Exception as exc: # pragma: no cover
-            self._logger.exception("Exception in sender coro: %s", exc)
-            cleanup_queue()
-        finally:
-            writer.close()
-
-    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-    async def process_request(self, raw_req):
-        have_policy = True
-
+            await asyncio.wait_for(remaining, self._shutdown_timeout)
+        except asyncio.TimeoutError:
+            self._logger.warning("Shutdown timeout expired. "
+                                 "Remaining connections terminated.")
+            for conn in connections:
+                conn.abort()
+        await self._server.wait_closed()
+        # Lookups left behind by expired response deadlines and
+        # background refreshes
+        pending = list(self._inflight.values()) + list(self._refreshing.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if self._own_resolver:
+            await self._resolver.close()
+
+    def parse_request(self, raw_req):
+        """ Returns requested domain and its zone config. Domain is None
+        if request needs no lookup. """
         # Parse request and canonicalize domain
         req_zone, _, req_domain = raw_req.decode(REQUEST_ENCODING).partition(' ')
         domain = filter_domain(req_domain)
 
-        # Skip lookups for parent domain policies
-        # Skip lookups to non-domains
-        if domain.startswith('.') or is_ipaddr(domain):
-            return netstring.encode(b'NOTFOUND ')
-
         # Find appropriate zone config
         if req_zone in self._zones:
             zone_cfg = self._zones[req_zone]
         else:
             zone_cfg = self._default_zone
 
-        # Lookup for cached policy
-        try:
-            cached = await self._cache.get(domain)
-        except asyncio.CancelledError:  # pragma: no cover pylint: disable=try-except-raise
-            raise
-        except Exception as exc:  # pragma: no cover
-            self._logger.exception("Cache get failed: %s", str(exc))
-            cached = None
+        # Skip lookups for parent domain policies
+        # Skip lookups to non-domains
+        if domain.startswith('.') or is_ipaddr(domain):
+            return None, zone_cfg
 
-        # DNS lookup and cache update
-        if self.is_stale(cached):
-            ts = time.time()  # pylint: disable=invalid-name
-            self._logger.debug("Lookup PERFORMED: domain = %s", domain)
-            # Check if newer policy exists or
-            # retrieve policy from scratch if there is no cached one
-            latest_pol_id = None if cached is None else cached.pol_id
-            status, policy = await zone_cfg.resolver.resolve(domain, latest_pol_id)
-
-            if status is STSFetchResult.NOT_CHANGED:
-                cached = CacheEntry(ts, cached.pol_id, cached.pol_body)
-                await self._cache.safe_set(domain, cached, self._logger)
-            elif status is STSFetchResult.VALID:
-                pol_id, pol_body = policy
-                cached = CacheEntry(ts, pol_id, pol_body)
-                await self._cache.safe_set(domain, cached, self._logger)
-            else:
-                if cached is None:
-                    have_policy = False
-                else:
-                    # Check if cached policy is expired
-                    if cached.pol_body['max_age'] + cached.ts < ts:
-                        have_policy = False
-        else:
-            self._logger.debug("Lookup skipped: domain = %s", domain)
+        return domain, zone_cfg
 
-        if have_policy:
+    def format_response(self, domain, zone_cfg, cached):
+        """ Returns encoded response for cache entry. Responses are memoized
+        per domain until policy id of its entry changes. """
+        if cached is None:
+            return NOTFOUND_RESPONSE
+        memo = self._responses.pop(domain, None)
+        if memo is None or memo[0] != cached.pol_id:
+            memo = (cached.pol_id, {})
+            if len(self._responses) >= RESPONSE_CACHE_LIMIT:
+                self._responses.popitem(last=False)
+        self._responses[domain] = memo
+        flags = (zone_cfg.strict, zone_cfg.require_sni, zone_cfg.tlsrpt)
+        resp = memo[1].get(flags)
+        if resp is None:
+            resp = memo[1][flags] = self.encode_response(domain, zone_cfg, cached)
+        return resp
+
+    @staticmethod
+    def encode_response(domain, zone_cfg, cached):
+        if cached is not None:
             mode = cached.pol_body['mode']
             # pylint: disable=no-else-return
             if mode == 'none' or (mode == 'testing' and not zone_cfg.strict):
-                return netstring.encode(b'NOTFOUND ')
+                return NOTFOUND_RESPONSE
             else:
                 assert cached.pol_body['mx'], "Empty MX list for restrictive policy!"
                 mxlist = [mx.lstrip('*') for mx in set(cached.pol_body['mx'])]
@@ -236,69 +395,43 @@ class STSSocketmapResponder:
                             for k, v in cached.pol_body.items())
                 return netstring.encode(resp.encode('utf-8'))
         else:
-            return netstring.encode(b'NOTFOUND ')
-
-    async def handler(self, reader, writer):
-        # Construct netstring parser
-        stream_reader = netstring.StreamReader(REQUEST_LIMIT)
-
-        # Construct queue for responses ordering
-        queue = asyncio.Queue(QUEUE_LIMIT)
-
-        # Create coroutine which awaits for steady responses and sends them
-        sender = asyncio.ensure_future(self.sender(queue, writer), loop=self._loop)
+            return NOTFOUND_RESPONSE
+
+    def answer_now(self, raw_req):
+        """ Returns response if request can be answered without waiting:
+        cache holds fresh entry readable without I/O. Otherwise returns None
+        and request has to be served by process_request(). """
+        domain, zone_cfg = self.parse_request(raw_req)
+        if domain is None:
+            return NOTFOUND_RESPONSE
+        cached = self._cache.get_nowait(domain)
+        if self.is_stale(cached):
+            return None
+        self._stats["requests"] += 1
+        self._stats["immediate"] += 1
+        if self.refresh_ahead_due(cached):
+            self.refresh_in_background(domain, zone_cfg, cached)
+        else:
+            self._logger.debug("Lookup skipped: domain = %s", domain)
+        return self.format_response(domain, zone_cfg,
+                                    None if cached.negative else cached)
 
-        class EndOfStream(Exception):
-            pass
+    async def process_request(self, raw_req):
+        domain, zone_cfg = self.parse_request(raw_req)
+        if domain is None:
+            return NOTFOUND_RESPONSE
 
-        async def finalize():
+        # Lookup for policy. Concurrent lookups for same domain are coalesced
+        if zone_cfg.deadline > 0:
             try:
-                await queue.put(None)
-            except asyncio.CancelledError:  # pragma: no cover
-                sender.cancel()
-                raise
-            await sender
+                cached = await asyncio.wait_for(self.lookup(domain, zone_cfg),
+                                                zone_cfg.deadline)
+            except asyncio.TimeoutError:
+                # Lookup keeps running and will update cache when done
+                self._logger.debug("Response deadline expired: domain = %s", domain)
+                self._stats["deadline_expired"] += 1
+                cached = self.fallback_policy(domain)
+        else:
+            cached = await self.lookup(domain, zone_cfg)
 
-        try:
-            while True:
-                # Extract and parse request
-                string_reader = stream_reader.next_string()
-                request_parts = []
-                while True:
-                    try:
-                        buf = string_reader.read()
-                    except netstring.WantRead:
-                        part = await reader.read(CHUNK)
-                        if not part:
-                            # pylint: disable=raise-missing-from
-                            raise EndOfStream()
-                        self._logger.debug("Read: %s", repr(part))
-                        stream_reader.feed(part)
-                    else:
-                        if buf:
-                            request_parts.append(buf)
-                        else:
-                            req = b''.join(request_parts)
-                            self._logger.debug("Enq request: %s", repr(req))
-                            fut = asyncio.ensure_future(self.process_request(req), loop=self._loop)
-                            await queue.put(fut)
-                            break
-        except netstring.ParseError:
-            self._logger.warning("Bad netstring message received")
-            await finalize()
-        except (EndOfStream, ConnectionError, TimeoutError):
-            self._logger.debug("Client disconnected")
-            await finalize()
-        except OSError as exc:  # pragma: no cover
-            if exc.errno == 107:
-                self._logger.debug("Client disconnected")
-                await finalize()
-            else:
-                self._logger.exception("Unhandled exception: %s", exc)
-                await finalize()
-        except asyncio.CancelledError:
-            sender.cancel()
-            raise
-        except Exception as exc:  # pragma: no cover
-            self._logger.exception("Unhandled exception: %s", exc)
-            await finalize()
+        return self.format_response(domain, zone_cfg, cached)
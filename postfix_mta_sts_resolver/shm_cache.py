@@ -0,0 +1,261 @@
+import asyncio
+import fcntl
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from .defaults import SHM_CACHE_SLOTS, SHM_CACHE_SLOT_SIZE
+from .constants import SHM_CACHE_PROBE_LIMIT, SHM_CACHE_READ_RETRIES, \
+    SHM_CACHE_LOCK_RETRY_DELAY
+from .base_cache import BaseCache, CacheEntry
+
+MAGIC = b'MTASTS01'
+# magic, number of slots, slot size, proactive fetch timestamp
+FILE_HEADER = struct.Struct('<8sIIq')
+FILE_HEADER_SIZE = 64
+# sequence number, key hash (0 for empty slot), timestamp,
+# key length, data length
+SLOT_HEADER = struct.Struct('<IIqHI')
+SEQ = struct.Struct('<I')
+TS = struct.Struct('<q')
+TS_OFFSET = 8
+
+
+class SharedMemoryCache(BaseCache):
+    """ Policy cache in memory-mapped file shared by processes on the host.
+
+    File holds fixed-size open-addressing hash table. Every slot holds one
+    record: key and JSON-encoded policy. Records which do not fit into slot
+    are not stored. When all slots within SHM_CACHE_PROBE_LIMIT of key
+    position are taken, record with oldest timestamp among them is replaced.
+
+    Writers are serialized with lock on the file. Readers take no lock:
+    every slot has sequence number which is odd while slot is being written,
+    so reader retries if slot was modified during read. """
+
+    def __init__(self, filename, *, slots=SHM_CACHE_SLOTS, slot_size=SHM_CACHE_SLOT_SIZE):
+        self._filename = filename
+        self._slots = slots
+        self._slot_size = slot_size
+        self._fd = None
+        self._map = None
+
+    def _init_file(self, fd, size):
+        os.ftruncate(fd, size)
+        os.pwrite(fd, FILE_HEADER.pack(MAGIC, self._slots, self._slot_size, 0), 0)
+
+    def _open(self, size):
+        """ Opens cache file of matching geometry, creating it if needed.
+        Returns descriptor of open file or None if caller has to retry. """
+        fd = os.open(self._filename, os.O_RDWR | os.O_CREAT, 0o600)
+        usable = False
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            stat = os.fstat(fd)
+            header = os.pread(fd, FILE_HEADER.size, 0)
+            if stat.st_ino != os.stat(self._filename).st_ino:
+                # File was replaced by other process meanwhile
+                pass
+            elif (stat.st_size == size and len(header) == FILE_HEADER.size and
+                  FILE_HEADER.unpack(header)[:3] == (MAGIC, self._slots, self._slot_size)):
+                usable = True
+            elif stat.st_size == 0:
+                # New file, nobody has it mapped
+                self._init_file(fd, size)
+                usable = True
+            else:
+                # File with other geometry may be mapped by other processes.
+                # Put new file in its place so their mappings stay valid.
+                tmp_name = "%s.%d.tmp" % (self._filename, os.getpid())
+                tmp_fd = os.open(tmp_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+                try:
+                    self._init_file(tmp_fd, size)
+                finally:
+                    os.close(tmp_fd)
+                os.replace(tmp_name, self._filename)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        if usable:
+            return fd
+        os.close(fd)
+        return None
+
+    async def setup(self):
+        size = FILE_HEADER_SIZE + self._slots * self._slot_size
+        fd = None
+        while fd is None:
+            fd = self._open(size)
+        self._fd = fd
+        self._map = mmap.mmap(self._fd, size)
+
+    async def teardown(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def _hash(key):
+        # Zero marks empty slot
+        return zlib.crc32(key) or 1
+
+    def _offset(self, index):
+        return FILE_HEADER_SIZE + index * self._slot_size
+
+    def _probe(self, key_hash):
+        start = key_hash % self._slots
+        for i in range(min(SHM_CACHE_PROBE_LIMIT, self._slots)):
+            yield self._offset((start + i) % self._slots)
+
+    def _read_slot(self, offset, key=None, key_hash=None):
+        """ Returns (key, entry) stored in slot, or None if slot is empty or
+        holds other key than given one. """
+        mm = self._map
+        for _ in range(SHM_CACHE_READ_RETRIES):
+            seq, slot_hash, ts, key_len, data_len = SLOT_HEADER.unpack_from(mm, offset)
+            if seq & 1:
+                continue
+            if slot_hash == 0:
+                return None
+            start = offset + SLOT_HEADER.size
+            if key is not None and (slot_hash != key_hash or key_len != len(key) or
+                                    mm[start:start + key_len] != key):
+                if SEQ.unpack_from(mm, offset)[0] == seq:
+                    return None
+                continue
+            raw_key = mm[start:start + key_len]
+            data = mm[start + key_len:start + key_len + data_len]
+            if SEQ.unpack_from(mm, offset)[0] != seq:
+                continue
+            pol_id, pol_body = json.loads(data)
+            return raw_key.decode('utf-8'), CacheEntry(ts, pol_id, pol_body)
+        return None
+
+    def _find(self, key):
+        raw_key = key.encode('utf-8')
+        key_hash = self._hash(raw_key)
+        for offset in self._probe(key_hash):
+            if SLOT_HEADER.unpack_from(self._map, offset)[1] == 0:
+                break
+            res = self._read_slot(offset, raw_key, key_hash)
+            if res is not None:
+                return res[1]
+        return None
+
+    def _write_slot(self, offset, header_tail, payload=None):
+        """ Updates slot under its sequence number. Caller holds write lock. """
+        mm = self._map
+        # Number stays odd if previous writer died amid write
+        odd = SEQ.unpack_from(mm, offset)[0] | 1
+        SEQ.pack_into(mm, offset, odd)
+        header_tail(mm, offset)
+        if payload is not None:
+            start = offset + SLOT_HEADER.size
+            mm[start:start + len(payload)] = payload
+        SEQ.pack_into(mm, offset, (odd + 1) & 0xFFFFFFFF)
+
+    def _pick_slot(self, raw_key, key_hash):
+        """ Returns (offset, timestamp) of slot holding key, or (offset, None)
+        of slot for new record: empty one or one with oldest record within
+        probe window. """
+        mm = self._map
+        oldest_ts = oldest_offset = None
+        for offset in self._probe(key_hash):
+            _, slot_hash, slot_ts, key_len, _ = SLOT_HEADER.unpack_from(mm, offset)
+            if slot_hash == 0:
+                return offset, None
+            start = offset + SLOT_HEADER.size
+            if (slot_hash == key_hash and key_len == len(raw_key) and
+                    mm[start:start + key_len] == raw_key):
+                return offset, slot_ts
+            if oldest_ts is None or slot_ts < oldest_ts:
+                oldest_ts, oldest_offset = slot_ts, offset
+        return oldest_offset, None
+
+    def _store(self, key, value, touch=False):
+        """ Stores entry unless cache holds newer one. With touch=True only
+        updates timestamp of existing entry. Caller holds write lock. """
+        raw_key = key.encode('utf-8')
+        key_hash = self._hash(raw_key)
+        ts = int(value.ts)
+        target, current_ts = self._pick_slot(raw_key, key_hash)
+        if current_ts is not None and current_ts >= ts:
+            return
+        if touch:
+            if current_ts is not None:
+                self._write_slot(target, lambda m, o: TS.pack_into(m, o + TS_OFFSET, ts))
+            return
+        data = json.dumps([value.pol_id, value.pol_body]).encode('utf-8')
+        if SLOT_HEADER.size + len(raw_key) + len(data) > self._slot_size:
+            return
+
+        def header_tail(m, o):
+            SLOT_HEADER.pack_into(m, o, SEQ.unpack_from(m, o)[0], key_hash, ts,
+                                  len(raw_key), len(data))
+        self._write_slot(target, header_tail, raw_key + data)
+
+    async def _locked(self, func, *args):
+        # Lock is held only for memory writes, so it is polled instead of
+        # blocking event loop
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(SHM_CACHE_LOCK_RETRY_DELAY)
+        try:
+            return func(*args)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get_nowait(self, key):
+        return self._find(key)
+
+    async def get(self, key):
+        return self._find(key)
+
+    async def set(self, key, value):
+        await self._locked(self._store, key, value)
+
+    async def get_many(self, keys):
+        return [self._find(key) for key in keys]
+
+    async def set_many(self, items):
+        def store_all():
+            for key, value in items:
+                self._store(key, value)
+        if items:
+            await self._locked(store_all)
+
+    async def touch(self, key, ts):  # pylint: disable=invalid-name
+        await self._locked(self._store, key, CacheEntry(ts, None, None), True)
+
+    async def touch_many(self, items):
+        def touch_all():
+            for key, ts in items:
+                self._store(key, CacheEntry(ts, None, None), True)
+        if items:
+            await self._locked(touch_all)
+
+    async def scan(self, token, amount_hint):
+        index = 0 if token is None else token
+        result = []
+        while index < self._slots and len(result) < amount_hint:
+            res = self._read_slot(self._offset(index))
+            if res is not None:
+                result.append(res)
+            index += 1
+        return (index if index < self._slots else None), result
+
+    async def get_proactive_fetch_ts(self):
+        return FILE_HEADER.unpack_from(self._map, 0)[3]
+
+    async def set_proactive_fetch_ts(self, timestamp):
+        def store():
+            magic, slots, slot_size, _ = FILE_HEADER.unpack_from(self._map, 0)
+            FILE_HEADER.pack_into(self._map, 0, magic, slots, slot_size, int(timestamp))
+        await self._locked(store)
@@ -0,0 +1,155 @@
+import asyncio
+import collections
+import logging
+
+from .constants import QUEUE_LIMIT, REQUEST_LIMIT, WRITE_BUFFER_LIMIT
+from . import netstring
+
+
+# pylint: disable=too-many-instance-attributes
+class SocketmapProtocol(asyncio.Protocol):
+    """ Serves socketmap requests of single client connection.
+
+    Requests are answered in order of arrival. Requests which responder can
+    answer right away are answered without creating a task. Others are
+    processed with responder.process_request() tasks and their responses
+    wait in the buffer until all preceding responses are sent. All responses
+    ready by the end of event loop iteration are sent with single write.
+    Reading from client is paused while QUEUE_LIMIT responses are pending
+    or while transport write buffer is above WRITE_BUFFER_LIMIT. """
+
+    def __init__(self, responder):
+        self._responder = responder
+        self._logger = logging.getLogger("STS")
+        self._transport = None
+        self._decoder = netstring.Decoder(REQUEST_LIMIT)
+        # Responses in order of requests: bytes or futures resolving to bytes
+        self._responses = collections.deque()
+        self._reading_paused = False
+        self._writing_paused = False
+        self._closing = False
+        self._flush_handle = None
+        self._closed = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport):
+        self._transport = transport
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+        self._responder.connection_made(self)
+
+    def connection_lost(self, exc):
+        self._logger.debug("Client disconnected")
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for resp in self._responses:
+            if isinstance(resp, asyncio.Future):
+                resp.cancel()
+        self._responses.clear()
+        self._responder.connection_lost(self)
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def data_received(self, data):
+        self._logger.debug("Read: %s", repr(data))
+        if self._closing:
+            return
+        try:
+            requests = self._decoder.feed(data)
+        except netstring.ParseError:
+            self._logger.warning("Bad netstring message received")
+            self.shutdown()
+            return
+        for req in requests:
+            if self._closing:  # pragma: no cover
+                break
+            self._logger.debug("Enq request: %s", repr(req))
+            self._enqueue(req)
+        if self._decoder.error is not None:
+            self._logger.warning("Bad netstring message received")
+            self.shutdown()
+        self._flush()
+
+    def eof_received(self):
+        self.shutdown()
+        # Keep transport open until pending responses are sent
+        return True
+
+    def pause_writing(self):
+        self._writing_paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._update_reading()
+
+    def _enqueue(self, req):
+        try:
+            resp = self._responder.answer_now(req)
+        except Exception as exc:  # pragma: no cover
+            self._logger.exception("Unhandled exception: %s", exc)
+            self.shutdown()
+            return
+        if resp is None:
+            resp = asyncio.ensure_future(self._responder.process_request(req))
+            resp.add_done_callback(self._on_response)
+        self._responses.append(resp)
+
+    def _on_response(self, fut):
+        # Responses completed within same loop iteration are sent together
+        if not fut.cancelled() and self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self):
+        """ Sends all ready responses preceding first pending one. """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        ready = []
+        while self._responses:
+            resp = self._responses[0]
+            if isinstance(resp, asyncio.Future):
+                if not resp.done():
+                    break
+                try:
+                    resp = resp.result()
+                except asyncio.CancelledError:  # pragma: no cover
+                    break
+                except Exception as exc:  # pragma: no cover
+                    self._logger.exception("Exception in request processing: %s", exc)
+                    self.abort()
+                    return
+            self._responses.popleft()
+            ready.append(resp)
+        if ready and not self._transport.is_closing():
+            self._logger.debug("Wrote: %s", repr(ready))
+            self._transport.writelines(ready)
+        if self._closing and not self._responses:
+            self._transport.close()
+        else:
+            self._update_reading()
+
+    def _update_reading(self):
+        if self._transport.is_closing():
+            return
+        pause = (self._closing or self._writing_paused or
+                 len(self._responses) >= QUEUE_LIMIT)
+        if pause and not self._reading_paused:
+            self._transport.pause_reading()
+            self._reading_paused = True
+        elif not pause and self._reading_paused:
+            self._transport.resume_reading()
+            self._reading_paused = False
+
+    def shutdown(self):
+        """ Stops accepting requests and closes connection
+        once pending responses are sent. """
+        if self._closing:
+            return
+        self._closing = True
+        self._flush()
+
+    def abort(self):
+        self._transport.abort()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
@@ -4,10 +4,12 @@ import asyncio
 import sqlite3
 import json
 import logging
+import time
 
 import aiosqlite
 
-from .defaults import SQLITE_THREADS, SQLITE_TIMEOUT
+from .defaults import SQLITE_THREADS, SQLITE_TIMEOUT, NEGATIVE_CACHE_TTL
+from .constants import SQLITE_BATCH_LIMIT, NEGATIVE_PURGE_INTERVAL
 from .base_cache import BaseCache, CacheEntry
 
 
@@ -75,10 +77,13 @@ class SqliteConnPool:
 
 class SqliteCache(BaseCache):
     def __init__(self, filename, *,
-                 threads=SQLITE_THREADS, timeout=SQLITE_TIMEOUT):
+                 threads=SQLITE_THREADS, timeout=SQLITE_TIMEOUT,
+                 negative_ttl=NEGATIVE_CACHE_TTL):
         self._filename = filename
         self._threads = threads
         self._timeout = timeout
+        self._negative_ttl = negative_ttl
+        self._next_purge_ts = 0
         self._last_proactive_fetch_ts_id = 1
         sqlitelogger = logging.getLogger("aiosqlite")
         if not sqlitelogger.hasHandlers():  # pragma: no cover
@@ -104,6 +109,8 @@ class SqliteCache(BaseCache):
             "(domain text, ts integer, pol_id text, pol_body text)",
             "create unique index if not exists sts_policy_domain on sts_policy_cache (domain)",
             "create index if not exists sts_policy_domain_ts on sts_policy_cache (domain, ts)",
+            "create index if not exists sts_policy_negative_ts on sts_policy_cache (ts) "
+            "where pol_id is null",
         ]
         async with self._pool.borrow(self._timeout) as conn:
             async with conn.cursor() as cur:
@@ -147,10 +154,22 @@ class SqliteCache(BaseCache):
         else:
             return None
 
+    async def _purge_negative(self, conn):
+        """ Deletes expired negative entries. Runs along with writes,
+        at most once per NEGATIVE_PURGE_INTERVAL. """
+        ts = time.time()
+        if ts < self._next_purge_ts:
+            return
+        self._next_purge_ts = ts + NEGATIVE_PURGE_INTERVAL
+        await conn.execute('delete from sts_policy_cache '
+                           'where pol_id is null and ts < ?',
+                           (int(ts - self._negative_ttl),))
+
     async def set(self, key, value):
         ts, pol_id, pol_body = value
         pol_body = json.dumps(pol_body)
         async with self._pool.borrow(self._timeout) as conn:
+            await self._purge_negative(conn)
             try:
                 await conn.execute('insert into sts_policy_cache (domain, ts, '
                                    'pol_id, pol_body) values (?, ?, ?, ?)',
@@ -163,14 +182,61 @@ class SqliteCache(BaseCache):
                                    (int(ts), pol_id, pol_body, key, int(ts)))
                 await conn.commit()
 
+    async def get_many(self, keys):
+        found = {}
+        async with self._pool.borrow(self._timeout) as conn:
+            for start in range(0, len(keys), SQLITE_BATCH_LIMIT):
+                chunk = keys[start:start + SQLITE_BATCH_LIMIT]
+                async with conn.execute('select domain, ts, pol_id, pol_body from '
+                                        'sts_policy_cache where domain in (%s)' %
+                                        (', '.join('?' * len(chunk)),),
+                                        chunk) as cur:
+                    for domain, ts, pol_id, pol_body in await cur.fetchall():
+                        found[domain] = CacheEntry(int(ts), pol_id, json.loads(pol_body))
+        return [found.get(key) for key in keys]
+
+    async def set_many(self, items):
+        if not items:
+            return
+        rows = [(key, int(ts), pol_id, json.dumps(pol_body))
+                for key, (ts, pol_id, pol_body) in items]
+        async with self._pool.borrow(self._timeout) as conn:
+            await self._purge_negative(conn)
+            await conn.executemany('insert or ignore into sts_policy_cache (domain, ts, '
+                                   'pol_id, pol_body) values (?, ?, ?, ?)',
+                                   rows)
+            await conn.executemany('update sts_policy_cache set ts = ?, '
+                                   'pol_id = ?, pol_body = ? where domain = ? '
+                                   'and ts < ?',
+                                   [(ts, pol_id, pol_body, key, ts)
+                                    for key, ts, pol_id, pol_body in rows])
+            await conn.commit()
+
+    async def touch(self, key, ts):
+        async with self._pool.borrow(self._timeout) as conn:
+            await conn.execute('update sts_policy_cache set ts = ? '
+                               'where domain = ? and ts < ?',
+                               (int(ts), key, int(ts)))
+            await conn.commit()
+
+    async def touch_many(self, items):
+        if not items:
+            return
+        async with self._pool.borrow(self._timeout) as conn:
+            await conn.executemany('update sts_policy_cache set ts = ? '
+                                   'where domain = ? and ts < ?',
+                                   [(int(ts), key, int(ts)) for key, ts in items])
+            await conn.commit()
+
     async def scan(self, token, amount_hint):
         if token is None:
             token = 1
 
         async with self._pool.borrow(self._timeout) as conn:
             async with conn.execute('select rowid, ts, pol_id, pol_body, domain from '
-                                    'sts_policy_cache where rowid between ? and ?',
-                                    (token, token + amount_hint - 1)) as cur:
+                                    'sts_policy_cache where rowid >= ? '
+                                    'order by rowid limit ?',
+                                    (token, amount_hint)) as cur:
                 res = await cur.fetchall()
         if res:
             result = []
@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+import uuid
+
+from .base_cache import BaseCache
+
+
+# pylint: disable=too-many-instance-attributes
+class TieredCache(BaseCache):
+    """ Cache which keeps recently used entries of backend cache in memory.
+
+    Entries stay in memory for at most `ttl` seconds, so changes made to
+    backend by other instances become visible after that time. Writes go
+    to backend and memory at once.
+
+    With `invalidation_channel` set, every write is also announced on that
+    channel of backend, and instances drop memory copies older than
+    announced entries right away. """
+
+    def __init__(self, backend, cache_size, ttl, invalidation_channel=None):
+        self._logger = logging.getLogger("STS")
+        self._backend = backend
+        self._cache_size = cache_size
+        self._ttl = ttl
+        self._channel = invalidation_channel
+        # Tells own announcements from ones of other instances
+        self._instance_id = uuid.uuid4().hex
+        # Announcements being sent
+        self._announcements = set()
+        # key -> (expire_ts, entry), least recently used first
+        self._cache = collections.OrderedDict()
+        self._stats = collections.Counter()
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def _get(self, key):
+        record = self._cache.pop(key, None)
+        if record is None or time.monotonic() >= record[0]:
+            self._stats["l1_misses"] += 1
+            return None
+        self._cache[key] = record
+        self._stats["l1_hits"] += 1
+        return record[1]
+
+    def get_nowait(self, key):
+        record = self._cache.get(key)
+        if record is None or time.monotonic() >= record[0]:
+            return None
+        self._cache.move_to_end(key)
+        self._stats["l1_hits"] += 1
+        return record[1]
+
+    def _set(self, key, value):
+        if self._cache.pop(key, None) is None and len(self._cache) >= self._cache_size:
+            self._cache.popitem(last=False)
+        self._cache[key] = (time.monotonic() + self._ttl, value)
+
+    def _count_backend(self, value):
+        self._stats["l2_hits" if value is not None else "l2_misses"] += 1
+
+    def invalidate(self, key=None):
+        """ Drops in-memory copy of entry for key, or of all entries
+        if key is None. Next read goes to backend. """
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    def _on_message(self, message):
+        if message is None:
+            # Announcements might have been missed
+            self.invalidate()
+            return
+        try:
+            instance_id, key, ts, pol_id = json.loads(message)  # pylint: disable=invalid-name
+        except (ValueError, TypeError):
+            self._logger.warning("Malformed invalidation message: %r", message)
+            return
+        if instance_id == self._instance_id:
+            return
+        record = self._cache.get(key)
+        if record is not None and (record[1].ts < ts or record[1].pol_id != pol_id):
+            del self._cache[key]
+            self._stats["invalidations"] += 1
+
+    def _announce(self, items):
+        """ Sends announcement in background, so writes do not wait for it """
+        task = asyncio.ensure_future(self._send_announcement(items))
+        self._announcements.add(task)
+        task.add_done_callback(self._announcements.discard)
+
+    async def _send_announcement(self, items):
+        messages = [json.dumps([self._instance_id, key, value.ts, value.pol_id])
+                    for key, value in items]
+        try:
+            await self._backend.publish(self._channel, messages)
+        except Exception as exc:  # pylint: disable=broad-except
+            self._logger.warning("Cache invalidation announcement failed: %s", str(exc))
+
+    async def setup(self):
+        await self._backend.setup()
+        if self._channel is not None and \
+                not await self._backend.subscribe(self._channel, self._on_message):
+            self._logger.warning("Cache backend can't deliver invalidation "
+                                 "announcements. Memory tier relies on ttl only.")
+            self._channel = None
+
+    async def teardown(self):
+        if self._announcements:
+            await asyncio.wait(self._announcements)
+        await self._backend.teardown()
+
+    async def get(self, key):
+        value = self._get(key)
+        if value is None:
+            value = await self._backend.get(key)
+            self._count_backend(value)
+            if value is not None:
+                self._set(key, value)
+        return value
+
+    async def set(self, key, value):
+        await self._backend.set(key, value)
+        self._set(key, value)
+        if self._channel is not None:
+            self._announce([(key, value)])
+
+    async def get_many(self, keys):
+        result = [self._get(key) for key in keys]
+        missing = [i for i, value in enumerate(result) if value is None]
+        if missing:
+            fetched = await self._backend.get_many([keys[i] for i in missing])
+            for i, value in zip(missing, fetched):
+                self._count_backend(value)
+                if value is not None:
+                    self._set(keys[i], value)
+                result[i] = value
+        return result
+
+    async def set_many(self, items):
+        await self._backend.set_many(items)
+        for key, value in items:
+            self._set(key, value)
+        if self._channel is not None and items:
+            self._announce(list(items))
+
+    async def touch(self, key, ts):  # pylint: disable=invalid-name
+        await self._backend.touch(key, ts)
+        record = self._cache.get(key)
+        if record is not None and record[1].ts < ts:
+            self._cache[key] = (record[0], record[1]._replace(ts=ts))
+
+    async def touch_many(self, items):
+        await self._backend.touch_many(items)
+        for key, ts in items:
+            record = self._cache.get(key)
+            if record is not None and record[1].ts < ts:
+                self._cache[key] = (record[0], record[1]._replace(ts=ts))
+
+    async def scan(self, token, amount_hint):
+        return await self._backend.scan(token, amount_hint)
+
+    async def get_proactive_fetch_ts(self):
+        return await self._backend.get_proactive_fetch_ts()
+
+    async def set_proactive_fetch_ts(self, timestamp):
+        await self._backend.set_proactive_fetch_ts(timestamp)
+
+    def stats(self):
+        def ratio(hits, misses):
+            total = hits + misses
+            return hits / total if total else 0.0
+
+        return {
+            "l1_entries": len(self._cache),
+            "l1_hits": self._stats["l1_hits"],
+            "l1_misses": self._stats["l1_misses"],
+            "l1_hit_ratio": ratio(self._stats["l1_hits"], self._stats["l1_misses"]),
+            "l2_hits": self._stats["l2_hits"],
+            "l2_misses": self._stats["l2_misses"],
+            "l2_hit_ratio": ratio(self._stats["l2_hits"], self._stats["l2_misses"]),
+            "invalidations": self._stats["invalidations"],
+        }
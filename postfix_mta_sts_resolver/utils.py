@@ -10,6 +10,10 @@ import yaml
 
 from . import defaults
 
+# Cache types held in process or host memory, which gain nothing from
+# wrapping into memory tier
+LOCAL_CACHE_TYPES = ("internal", "shm", "lmdb")
+
 
 # pylint: disable=invalid-name
 class LogLevel(enum.IntEnum):
@@ -77,6 +81,39 @@ def enable_uvloop():  # pragma: no cover
         return True
 
 
+def populate_cache_cfg_defaults(cache_cfg):
+    cache_cfg['type'] = cache_cfg.get('type', defaults.CACHE_BACKEND)
+
+    if 'memory_tier' not in cache_cfg:
+        cache_cfg['memory_tier'] = {}
+    cache_cfg['memory_tier']['enabled'] = cache_cfg['memory_tier'].\
+        get('enabled', defaults.MEMORY_TIER_ENABLED)
+    cache_cfg['memory_tier']['cache_size'] = cache_cfg['memory_tier'].\
+        get('cache_size', defaults.MEMORY_TIER_SIZE)
+    cache_cfg['memory_tier']['ttl'] = cache_cfg['memory_tier'].\
+        get('ttl', defaults.MEMORY_TIER_TTL)
+    cache_cfg['memory_tier']['invalidation'] = cache_cfg['memory_tier'].\
+        get('invalidation', defaults.MEMORY_TIER_INVALIDATION)
+    cache_cfg['memory_tier']['invalidation_channel'] = cache_cfg['memory_tier'].\
+        get('invalidation_channel', defaults.MEMORY_TIER_INVALIDATION_CHANNEL)
+
+    if 'read_batching' not in cache_cfg:
+        cache_cfg['read_batching'] = {}
+    cache_cfg['read_batching']['enabled'] = cache_cfg['read_batching'].\
+        get('enabled', defaults.READ_BATCHING_ENABLED)
+    cache_cfg['read_batching']['batch_size'] = cache_cfg['read_batching'].\
+        get('batch_size', defaults.READ_BATCHING_SIZE)
+    cache_cfg['read_batching']['window'] = cache_cfg['read_batching'].\
+        get('window', defaults.READ_BATCHING_WINDOW)
+
+    if cache_cfg['type'] == 'internal':
+        if 'options' not in cache_cfg:
+            cache_cfg['options'] = {}
+
+        cache_cfg['options']['cache_size'] = cache_cfg['options'].\
+            get('cache_size', defaults.INTERNAL_CACHE_SIZE)
+
+
 def populate_cfg_defaults(cfg):
     if not cfg:
         cfg = {}
@@ -87,7 +124,26 @@ def populate_cfg_defaults(cfg):
     cfg['reuse_port'] = cfg.get('reuse_port', defaults.REUSE_PORT)
     cfg['shutdown_timeout'] = cfg.get('shutdown_timeout',
                                       defaults.SHUTDOWN_TIMEOUT)
+    cfg['workers'] = cfg.get('workers', defaults.WORKERS)
     cfg['cache_grace'] = cfg.get('cache_grace', defaults.CACHE_GRACE)
+    cfg['negative_cache_ttl'] = cfg.get('negative_cache_ttl',
+                                        defaults.NEGATIVE_CACHE_TTL)
+
+    if 'fetch_backoff' not in cfg:
+        cfg['fetch_backoff'] = {}
+    cfg['fetch_backoff']['enabled'] = cfg['fetch_backoff'].\
+        get('enabled', defaults.FETCH_BACKOFF_ENABLED)
+    cfg['fetch_backoff']['initial'] = cfg['fetch_backoff'].\
+        get('initial', defaults.FETCH_BACKOFF_INITIAL)
+    cfg['fetch_backoff']['max'] = cfg['fetch_backoff'].\
+        get('max', defaults.FETCH_BACKOFF_MAX)
+
+    if 'background_refresh' not in cfg:
+        cfg['background_refresh'] = {}
+    cfg['background_refresh']['stale_while_revalidate'] = cfg['background_refresh'].\
+        get('stale_while_revalidate', defaults.STALE_WHILE_REVALIDATE)
+    cfg['background_refresh']['refresh_ahead'] = cfg['background_refresh'].\
+        get('refresh_ahead', defaults.REFRESH_AHEAD)
 
     if 'proactive_policy_fetching' not in cfg:
         cfg['proactive_policy_fetching'] = {}
@@ -99,24 +155,27 @@ def populate_cfg_defaults(cfg):
         get('concurrency_limit', defaults.PROACTIVE_FETCH_CONCURRENCY_LIMIT)
     cfg['proactive_policy_fetching']['grace_ratio'] = cfg['proactive_policy_fetching'].\
         get('grace_ratio', defaults.PROACTIVE_FETCH_GRACE_RATIO)
+    cfg['proactive_policy_fetching']['schedule'] = cfg['proactive_policy_fetching'].\
+        get('schedule', defaults.PROACTIVE_FETCH_SCHEDULE)
+    cfg['proactive_policy_fetching']['adaptive_concurrency'] = cfg['proactive_policy_fetching'].\
+        get('adaptive_concurrency', defaults.PROACTIVE_FETCH_ADAPTIVE_CONCURRENCY)
+    cfg['proactive_policy_fetching']['concurrency_min'] = cfg['proactive_policy_fetching'].\
+        get('concurrency_min', defaults.PROACTIVE_FETCH_CONCURRENCY_MIN)
+    cfg['proactive_policy_fetching']['latency_target'] = cfg['proactive_policy_fetching'].\
+        get('latency_target', defaults.PROACTIVE_FETCH_LATENCY_TARGET)
 
     if 'cache' not in cfg:
         cfg['cache'] = {}
 
-    cfg['cache']['type'] = cfg['cache'].get('type', defaults.CACHE_BACKEND)
-
-    if cfg['cache']['type'] == 'internal':
-        if 'options' not in cfg['cache']:
-            cfg['cache']['options'] = {}
-
-        cfg['cache']['options']['cache_size'] = cfg['cache']['options'].\
-            get('cache_size', defaults.INTERNAL_CACHE_SIZE)
+    populate_cache_cfg_defaults(cfg['cache'])
 
     def populate_zone(zone):
         zone['timeout'] = zone.get('timeout', defaults.TIMEOUT)
         zone['strict_testing'] = zone.get('strict_testing', defaults.STRICT_TESTING)
         zone['require_sni'] = zone.get('require_sni', defaults.REQUIRE_SNI)
         zone['tlsrpt'] = zone.get('tlsrpt', defaults.TLSRPT)
+        zone['response_deadline'] = zone.get('response_deadline',
+                                             defaults.RESPONSE_DEADLINE)
         return zone
 
     if 'default_zone' not in cfg:
@@ -215,7 +274,11 @@ async def create_custom_socket(host, port, *,  # pylint: disable=too-many-locals
     return sock
 
 
-def create_cache(cache_type, options):
+def create_cache(cache_type, options, memory_tier=None, read_batching=None,
+                 negative_ttl=None):
+    if negative_ttl is not None and cache_type not in ("internal", "shm"):
+        # Persistent backends expire negative entries on their own
+        options = dict(options, negative_ttl=negative_ttl)
     if cache_type == "internal":
         # pylint: disable=import-outside-toplevel
         from . import internal_cache
@@ -224,6 +287,14 @@ def create_cache(cache_type, options):
         # pylint: disable=import-outside-toplevel
         from . import sqlite_cache
         cache = sqlite_cache.SqliteCache(**options)
+    elif cache_type == "lmdb":
+        # pylint: disable=import-outside-toplevel
+        from . import lmdb_cache
+        cache = lmdb_cache.LmdbCache(**options)
+    elif cache_type == "shm":
+        # pylint: disable=import-outside-toplevel
+        from . import shm_cache
+        cache = shm_cache.SharedMemoryCache(**options)
     elif cache_type == "redis":
         # pylint: disable=import-outside-toplevel
         from . import redis_cache
@@ -238,6 +309,22 @@ def create_cache(cache_type, options):
         cache = postgres_cache.PostgresCache(**options)
     else:
         raise NotImplementedError("Unsupported cache type!")
+    if (read_batching is not None and read_batching['enabled'] and
+            cache_type not in LOCAL_CACHE_TYPES):
+        # pylint: disable=import-outside-toplevel
+        from . import batching_cache
+        cache = batching_cache.BatchingCache(cache,
+                                             read_batching['batch_size'],
+                                             read_batching['window'])
+    if (memory_tier is not None and memory_tier['enabled'] and
+            cache_type not in LOCAL_CACHE_TYPES):
+        # pylint: disable=import-outside-toplevel
+        from . import tiered_cache
+        cache = tiered_cache.TieredCache(cache,
+                                         memory_tier['cache_size'],
+                                         memory_tier['ttl'],
+                                         memory_tier['invalidation_channel']
+                                         if memory_tier['invalidation'] else None)
     return cache
 
 
@@ -0,0 +1,89 @@
+import logging
+import multiprocessing
+import os
+import time
+
+from .constants import WORKER_RESTART_DELAY
+
+
+class WorkerPool:
+    """ Runs `count` worker processes and restarts ones which exited.
+
+    Each worker runs target(*args, worker_id) in a freshly spawned
+    interpreter, where worker_id is its index in range(count). Restarted
+    worker gets the same worker_id as the one it replaces. Methods are not
+    coroutines: pool is driven by periodic check() calls. """
+
+    def __init__(self, count, target, args=()):
+        self._logger = logging.getLogger("MAIN")
+        self._ctx = multiprocessing.get_context('spawn')
+        self._target = target
+        self._args = tuple(args)
+        self._workers = [None] * count
+        # worker_id -> monotonic time when dead worker may be started again
+        self._restart_at = {}
+        self._stats = {"restarts": 0}
+
+    def _spawn(self, worker_id):
+        proc = self._ctx.Process(target=self._target,
+                                 args=self._args + (worker_id,),
+                                 name="mta-sts-worker-%d" % (worker_id,))
+        proc.start()
+        self._workers[worker_id] = proc
+        self._logger.info("Worker #%d started: pid = %d", worker_id, proc.pid)
+
+    def start(self):
+        for worker_id in range(len(self._workers)):
+            self._spawn(worker_id)
+
+    def check(self):
+        """ Restarts workers which exited. Worker which exited is started
+        again not earlier than WORKER_RESTART_DELAY seconds after its
+        death was noticed. """
+        now = time.monotonic()
+        for worker_id, proc in enumerate(self._workers):
+            if proc is None or proc.is_alive():
+                continue
+            restart_at = self._restart_at.get(worker_id)
+            if restart_at is None:
+                self._logger.warning("Worker #%d (pid = %d) exited with code %s. "
+                                     "Restarting.", worker_id, proc.pid, proc.exitcode)
+                self._restart_at[worker_id] = now + WORKER_RESTART_DELAY
+            elif now >= restart_at:
+                del self._restart_at[worker_id]
+                self._stats["restarts"] += 1
+                self._spawn(worker_id)
+
+    def alive(self):
+        return sum(1 for proc in self._workers
+                   if proc is not None and proc.is_alive())
+
+    def send_signal(self, signum):
+        for proc in self._workers:
+            if proc is not None and proc.is_alive():
+                os.kill(proc.pid, signum)
+
+    def stop(self, timeout):
+        """ Asks workers to terminate gracefully with SIGTERM and kills
+        ones still running after timeout seconds. """
+        for proc in self._workers:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        deadline = time.monotonic() + timeout
+        for proc in self._workers:
+            if proc is None or proc.exitcode is not None:
+                continue
+            proc.join(max(0, deadline - time.monotonic()))
+            if proc.exitcode is None:
+                self._logger.warning("Worker %s did not stop in time. Killing it.",
+                                     proc.name)
+                proc.kill()
+                proc.join()
+        self._workers = [None] * len(self._workers)
+
+    def stats(self):
+        return {
+            "workers": len(self._workers),
+            "alive": self.alive(),
+            "restarts": self._stats["restarts"],
+        }
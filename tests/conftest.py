@@ -1,10 +1,16 @@
 import asyncio
+import collections
 import os
 
 import pytest
 
+from postfix_mta_sts_resolver.internal_cache import InternalLRUCache
+from postfix_mta_sts_resolver.resolver import STSFetchResult
+from postfix_mta_sts_resolver.responder import STSSocketmapResponder
 from postfix_mta_sts_resolver.utils import enable_uvloop, create_cache, populate_cfg_defaults
 
+from testdata import POLICY, POLICY_ID
+
 @pytest.fixture(scope="session")
 def event_loop():
     uvloop_test = os.environ['TOXENV'].endswith('-uvloop')
@@ -32,3 +38,78 @@ async def module_cache_fixture():
     await cache.setup()
     yield cache
     await cache.teardown()
+
+
+class FakeResolver:
+    """ Stands in for STSResolver. Answers every domain with (status, policy)
+    pair or with result of answer(domain) after delay seconds (or
+    delays[domain]). Calls are counted in total and per domain. """
+    def __init__(self, answer=(STSFetchResult.VALID, (POLICY_ID, POLICY)),
+                 delay=0, delays=None):
+        self.answer = answer
+        self.delay = delay
+        self.delays = {} if delays is None else delays
+        self.calls = 0
+        self.domain_calls = collections.Counter()
+
+    async def resolve(self, domain, last_known_id=None, timeout=None):
+        self.calls += 1
+        self.domain_calls[domain] += 1
+        await asyncio.sleep(self.delays.get(domain, self.delay))
+        return self.answer(domain) if callable(self.answer) else self.answer
+
+    async def close(self):
+        pass
+
+
+class CountingCache(InternalLRUCache):
+    """ Internal cache which counts backend reads and records keys of
+    every get_many() call. Batch reads fail if fail is set. """
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+        self.reads = 0
+        self.batches = []
+
+    async def get(self, key):
+        self.reads += 1
+        return await super().get(key)
+
+    async def get_many(self, keys):
+        self.reads += 1
+        self.batches.append(list(keys))
+        await asyncio.sleep(0)
+        if self.fail:
+            raise ConnectionError("backend is down")
+        return await super().get_many(keys)
+
+
+@pytest.fixture
+def fake_resolver():
+    return FakeResolver
+
+
+@pytest.fixture
+def counting_cache():
+    return CountingCache
+
+
+@pytest.fixture
+async def make_responder():
+    """ Returns factory of responders which resolve policies of default zone
+    with given resolver. Caches created by factory are torn down after test. """
+    caches = []
+
+    async def factory(cfg, resolver, cache=None):
+        if cache is None:
+            cache = create_cache(cfg['cache']['type'],
+                                 cfg['cache']['options'])
+            await cache.setup()
+            caches.append(cache)
+        resp = STSSocketmapResponder(cfg, asyncio.get_event_loop(), cache)
+        resp._default_zone = resp._default_zone._replace(resolver=resolver)
+        return resp, cache
+
+    yield factory
+    for cache in caches:
+        await cache.teardown()
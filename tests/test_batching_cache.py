@@ -0,0 +1,76 @@
+import asyncio
+import tempfile
+
+import pytest
+
+import postfix_mta_sts_resolver.utils as utils
+from postfix_mta_sts_resolver.base_cache import CacheEntry
+from postfix_mta_sts_resolver.batching_cache import BatchingCache
+from postfix_mta_sts_resolver.internal_cache import InternalLRUCache
+from postfix_mta_sts_resolver.tiered_cache import TieredCache
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reads_batched(counting_cache):
+    backend = counting_cache()
+    cache = BatchingCache(backend, 100, 0)
+    await cache.setup()
+    entry = CacheEntry(1, "pol_id", {"mode": "none"})
+    try:
+        await backend.set("a.loc", entry)
+        await backend.set("b.loc", entry)
+        res = await asyncio.gather(*(cache.get(key) for key in
+                                     ["a.loc", "b.loc", "a.loc", "c.loc"]))
+        assert res == [entry, entry, entry, None]
+        assert backend.batches == [["a.loc", "b.loc", "c.loc"]]
+        assert await cache.get("b.loc") == entry
+        assert len(backend.batches) == 2
+        # single key reads never reach the backend
+        assert backend.reads == len(backend.batches)
+        stats = cache.stats()
+        assert stats["reads"] == 5
+        assert stats["batches"] == 2
+        assert stats["avg_batch_size"] == 2
+    finally:
+        await cache.teardown()
+
+
+@pytest.mark.asyncio
+async def test_batch_size_and_window(counting_cache):
+    backend = counting_cache()
+    cache = BatchingCache(backend, 2, 0.1)
+    keys = ["%d.loc" % n for n in range(5)]
+    res = await asyncio.gather(*(cache.get(key) for key in keys))
+    assert res == [None] * 5
+    assert backend.batches == [keys[0:2], keys[2:4], keys[4:]]
+    assert backend.reads == len(backend.batches)
+
+
+@pytest.mark.asyncio
+async def test_batch_failure_reaches_all_readers(counting_cache):
+    cache = BatchingCache(counting_cache(fail=True), 100, 0)
+    res = await asyncio.gather(cache.get("a.loc"), cache.get("b.loc"),
+                               return_exceptions=True)
+    assert all(isinstance(exc, ConnectionError) for exc in res)
+
+
+@pytest.mark.asyncio
+async def test_create_batching_cache():
+    cfg = utils.populate_cfg_defaults({"cache": {"read_batching": {"enabled": True},
+                                                 "memory_tier": {"enabled": True}}})
+    assert isinstance(utils.create_cache("internal", {}, cfg["cache"]["memory_tier"],
+                                         cfg["cache"]["read_batching"]),
+                      InternalLRUCache)
+    with tempfile.NamedTemporaryFile() as tmpfile:
+        cache = utils.create_cache("sqlite", {"filename": tmpfile.name},
+                                   cfg["cache"]["memory_tier"],
+                                   cfg["cache"]["read_batching"])
+        assert isinstance(cache, TieredCache)
+        assert isinstance(cache.backend, BatchingCache)
+        assert not hasattr(cache.backend.backend, "stats")
+        await cache.setup()
+        entry = CacheEntry(1, "pol_id", {"mode": "none"})
+        await cache.set("test.loc", entry)
+        cache.invalidate()
+        assert await cache.get("test.loc") == entry
+        await cache.teardown()
@@ -1,15 +1,28 @@
+import asyncio
+import fcntl
+import os
 import tempfile
+import time
 import pytest
 import postfix_mta_sts_resolver.utils as utils
 import postfix_mta_sts_resolver.base_cache as base_cache
 from postfix_mta_sts_resolver import constants
 
 
+def cleanup_tmp(tmpfile):
+    if isinstance(tmpfile, tempfile.TemporaryDirectory):
+        tmpfile.cleanup()
+    elif tmpfile is not None:
+        tmpfile.close()
+
 async def setup_cache(cache_type, cache_opts):
     tmpfile = None
-    if cache_type == 'sqlite':
+    if cache_type in ('sqlite', 'shm'):
         tmpfile = tempfile.NamedTemporaryFile()
         cache_opts["filename"] = tmpfile.name
+    if cache_type == 'lmdb':
+        tmpfile = tempfile.TemporaryDirectory()
+        cache_opts["path"] = tmpfile.name
     cache = utils.create_cache(cache_type, cache_opts)
     await cache.setup()
     if cache_type == 'redis':
@@ -25,8 +38,13 @@ async def setup_cache(cache_type, cache_opts):
     ("internal", {}, False),
     ("sqlite", {}, True),
     ("sqlite", {}, False),
+    ("shm", {}, True),
+    ("shm", {}, False),
+    ("lmdb", {}, True),
+    ("lmdb", {}, False),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, True),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, False),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5", "format": 2}, True),
     ("postgres", {"dsn": "postgres://postgres@localhost:5432"}, True),
     ("postgres", {"dsn": "postgres://postgres@localhost:5432"}, False),
 ])
@@ -46,13 +64,80 @@ async def test_cache_lifecycle(cache_type, cache_opts, safe_set):
         assert await cache.get("test") == stored
     finally:
         await cache.teardown()
-        if cache_type == 'sqlite':
-            tmpfile.close()
+        cleanup_tmp(tmpfile)
+
+@pytest.mark.parametrize("cache_type,cache_opts", [
+    ("internal", {}),
+    ("sqlite", {}),
+    ("shm", {}),
+    ("lmdb", {}),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5", "format": 2}),
+    ("postgres", {"dsn": "postgres://postgres@%2Frun%2Fpostgresql/postgres"}),
+])
+@pytest.mark.asyncio
+async def test_negative_entry_lifecycle(cache_type, cache_opts):
+    cache, tmpfile = await setup_cache(cache_type, cache_opts)
+
+    try:
+        await cache.set("test", base_cache.negative_entry(1))
+        stored = await cache.get("test")
+        assert stored == base_cache.negative_entry(1)
+        assert stored.negative
+        # Negative entry gets replaced with newer policy
+        positive = base_cache.CacheEntry(2, "pol_id", {"mode": "none"})
+        await cache.set("test", positive)
+        stored = await cache.get("test")
+        assert stored == positive
+        assert not stored.negative
+    finally:
+        await cache.teardown()
+        cleanup_tmp(tmpfile)
+
+@pytest.mark.parametrize("cache_type,cache_opts", [
+    ("sqlite", {"negative_ttl": 60}),
+    ("lmdb", {"negative_ttl": 60}),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5",
+               "negative_ttl": 60}),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5",
+               "negative_ttl": 60, "format": 2}),
+    ("postgres", {"dsn": "postgres://postgres@%2Frun%2Fpostgresql/postgres",
+                  "negative_ttl": 60}),
+])
+@pytest.mark.asyncio
+async def test_negative_entry_expiry(cache_type, cache_opts):
+    cache, tmpfile = await setup_cache(cache_type, cache_opts)
+
+    try:
+        now = int(time.time())
+        positive = base_cache.CacheEntry(now - 3600, "pol_id", {"mode": "none"})
+        fresh = base_cache.negative_entry(now)
+        await cache.set("expired", base_cache.negative_entry(now - 120))
+        await cache.set_many([("fresh", fresh), ("positive", positive)])
+        if cache_type == 'redis':
+            # Redis expires keys of negative entries on its own
+            pool = cache._pool
+            prefix = "sts:" if cache_opts.get("format") == 2 else ""
+            assert 0 < await pool.ttl(prefix + "fresh") <= 60
+            assert await pool.ttl(prefix + "positive") == -1
+        else:
+            if cache_type in ('sqlite', 'postgres'):
+                cache._next_purge_ts = 0
+            await cache.set("other", fresh)
+            assert await cache.get("expired") is None
+        assert await cache.get("fresh") == fresh
+        assert await cache.get("positive") == positive
+    finally:
+        await cache.teardown()
+        cleanup_tmp(tmpfile)
 
 @pytest.mark.parametrize("cache_type,cache_opts", [
     ("internal", {}),
     ("sqlite", {}),
+    ("shm", {}),
+    ("lmdb", {}),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5", "format": 2}),
     ("postgres", {"dsn": "postgres://postgres@%2Frun%2Fpostgresql/postgres"}),
     ("postgres", {"dsn": "postgres://postgres@%2Frun%2Fpostgresql/postgres"}),
 ])
@@ -70,8 +155,7 @@ async def test_proactive_fetch_ts_lifecycle(cache_type, cache_opts):
         assert await cache.get_proactive_fetch_ts() == 321
     finally:
         await cache.teardown()
-        if cache_type == 'sqlite':
-            tmpfile.close()
+        cleanup_tmp(tmpfile)
 
 @pytest.mark.parametrize("cache_type,cache_opts,n_items,batch_size_limit", [
     ("internal", {}, 3, 1),
@@ -86,10 +170,20 @@ async def test_proactive_fetch_ts_lifecycle(cache_type, cache_opts):
     ("sqlite", {}, 3, 4),
     ("sqlite", {}, 0, 4),
     ("sqlite", {}, constants.DOMAIN_QUEUE_LIMIT*2, constants.DOMAIN_QUEUE_LIMIT),
+    ("shm", {}, 3, 1),
+    ("shm", {}, 3, 4),
+    ("shm", {}, 0, 4),
+    ("shm", {}, constants.DOMAIN_QUEUE_LIMIT*2, constants.DOMAIN_QUEUE_LIMIT),
+    ("lmdb", {}, 3, 1),
+    ("lmdb", {}, 3, 2),
+    ("lmdb", {}, 3, 4),
+    ("lmdb", {}, 0, 4),
+    ("lmdb", {}, constants.DOMAIN_QUEUE_LIMIT*2, constants.DOMAIN_QUEUE_LIMIT),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, 3, 1),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, 3, 2),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, 3, 3),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, 3, 4),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5", "format": 2}, 3, 2),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, 0, 4),
     ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}, constants.DOMAIN_QUEUE_LIMIT*2, constants.DOMAIN_QUEUE_LIMIT),
     ("postgres", {"dsn": "postgres://postgres@%2Frun%2Fpostgresql/postgres"}, 3, 1),
@@ -129,8 +223,264 @@ async def test_scanning_in_batches(cache_type, cache_opts, n_items, batch_size_l
             assert scanned == data
     finally:
         await cache.teardown()
-        if cache_type == 'sqlite':
-            tmpfile.close()
+        cleanup_tmp(tmpfile)
+
+@pytest.mark.parametrize("cache_type,cache_opts", [
+    ("internal", {}),
+    ("sqlite", {}),
+    ("shm", {}),
+    ("lmdb", {}),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5"}),
+    ("redis", {"url": "redis://127.0.0.1/0?socket_timeout=5&socket_connect_timeout=5", "format": 2}),
+    ("postgres", {"dsn": "postgres://postgres@%2Frun%2Fpostgresql/postgres"}),
+])
+@pytest.mark.timeout(10)
+@pytest.mark.asyncio
+async def test_batch_lifecycle(cache_type, cache_opts):
+    cache, tmpfile = await setup_cache(cache_type, cache_opts)
+
+    try:
+        assert await cache.get_many([]) == []
+        await cache.set_many([])
+        items = [("test{:04d}".format(n), base_cache.CacheEntry(10, "pol_id", {"n": n}))
+                 for n in range(constants.SQLITE_BATCH_LIMIT + 1)]
+        await cache.set_many(items)
+        assert await cache.get_many(["test0000", "nonexistent", "test0001"]) == \
+            [items[0][1], None, items[1][1]]
+        keys = [key for key, _ in items]
+        assert await cache.get_many(keys) == [value for _, value in items]
+
+        await cache.set_many([("test0000", base_cache.CacheEntry(20, "new_id", {}))])
+        assert await cache.get("test0000") == base_cache.CacheEntry(20, "new_id", {})
+
+        # Touch updates only timestamp and only forward
+        await cache.touch("test0001", 30)
+        await cache.touch("test0002", 1)
+        await cache.safe_touch("nonexistent", 30, None)
+        assert await cache.get_many(["test0001", "test0002", "nonexistent"]) == \
+            [items[1][1]._replace(ts=30), items[2][1], None]
+        await cache.touch_many([])
+        await cache.safe_touch_many([("test0003", 40), ("test0004", 1),
+                                     ("nonexistent", 40)], None)
+        assert await cache.get_many(["test0003", "test0004", "nonexistent"]) == \
+            [items[3][1]._replace(ts=40), items[4][1], None]
+    finally:
+        await cache.teardown()
+        cleanup_tmp(tmpfile)
+
+@pytest.mark.asyncio
+async def test_shm_cache_shared():
+    with tempfile.NamedTemporaryFile() as tmpfile:
+        opts = {"filename": tmpfile.name, "slots": 4, "slot_size": 128}
+        writer = utils.create_cache("shm", opts)
+        reader = utils.create_cache("shm", opts)
+        await writer.setup()
+        await reader.setup()
+        try:
+            stored = base_cache.CacheEntry(10, "pol_id", {"mx": ["mail.loc"]})
+            await writer.set("test1", stored)
+            assert reader.get_nowait("test1") == stored
+            # Older entry does not replace newer one
+            await reader.set("test1", base_cache.CacheEntry(5, "old_id", {}))
+            assert await writer.get("test1") == stored
+            # Records over slot size are not stored
+            await writer.set("test2", base_cache.CacheEntry(10, "pol_id", {"mx": ["x" * 128]}))
+            assert await reader.get("test2") is None
+            # Full table replaces oldest entries
+            for n in range(6):
+                await writer.set("more%d" % n, base_cache.CacheEntry(20 + n, "pol_id", {}))
+            assert await reader.get("test1") is None
+            assert await reader.get("more5") == base_cache.CacheEntry(25, "pol_id", {})
+            # Writes wait for lock without blocking event loop
+            lock_fd = os.open(tmpfile.name, os.O_RDWR)
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            task = asyncio.ensure_future(writer.set("locked", stored))
+            await asyncio.sleep(0.05)
+            assert not task.done()
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+            await task
+            assert reader.get_nowait("locked") == stored
+            # Other geometry puts new file in place, old mappings stay valid
+            other = utils.create_cache("shm", dict(opts, slots=8))
+            await other.setup()
+            assert await other.get("more5") is None
+            assert await reader.get("more5") == base_cache.CacheEntry(25, "pol_id", {})
+            await other.teardown()
+            # Slots left mid-write by dead writer become readable after next write
+            from postfix_mta_sts_resolver import shm_cache
+            for index in range(opts["slots"]):
+                shm_cache.SEQ.pack_into(writer._map, writer._offset(index), 7)
+            assert reader.get_nowait("locked") is None
+            await writer.set("locked", stored._replace(ts=11))
+            assert reader.get_nowait("locked") == stored._replace(ts=11)
+        finally:
+            await writer.teardown()
+            await reader.teardown()
+
+@pytest.mark.asyncio
+async def test_lmdb_cache_group_commit():
+    with tempfile.TemporaryDirectory() as path:
+        cache = utils.create_cache("lmdb", {"path": path})
+        await cache.setup()
+        commits = []
+        commit = cache._commit
+        cache._commit = lambda ops: commits.append(len(ops)) or commit(ops)
+        try:
+            await asyncio.gather(*(cache.set("test%d" % n, base_cache.CacheEntry(n, "pol_id", {}))
+                                   for n in range(10)))
+            assert sum(commits) == 10
+            assert len(commits) < 10
+            assert cache.get_nowait("test9") == base_cache.CacheEntry(9, "pol_id", {})
+        finally:
+            await cache.teardown()
+        # Entries survive reopening
+        cache = utils.create_cache("lmdb", {"path": path})
+        await cache.setup()
+        try:
+            assert await cache.get("test5") == base_cache.CacheEntry(5, "pol_id", {})
+        finally:
+            await cache.teardown()
+
+@pytest.mark.asyncio
+async def test_lmdb_cache_map_full():
+    with tempfile.TemporaryDirectory() as path:
+        cache = utils.create_cache("lmdb", {"path": path, "map_size": 1 << 17,
+                                            "negative_ttl": 86400})
+        await cache.setup()
+        now = int(time.time())
+        policy = base_cache.CacheEntry(now, "pol_id", {"mode": "none", "max_age": 86400})
+        try:
+            await cache.set("policy", policy)
+            # Negative entries fill map many times over
+            for n in range(100):
+                await cache.set_many([("neg%d.%d" % (n, m), base_cache.negative_entry(now))
+                                      for m in range(100)])
+            assert await cache.get("policy") == policy
+            assert await cache.get("neg99.99") == base_cache.negative_entry(now)
+            assert await cache.get("neg0.0") is None
+        finally:
+            await cache.teardown()
+
+@pytest.mark.asyncio
+async def test_internal_cache_snapshot():
+    with tempfile.TemporaryDirectory() as path:
+        opts = {"snapshot_file": path + "/snapshot", "snapshot_interval": 0.1}
+        now = time.time()
+        fresh = base_cache.CacheEntry(now, "pol_id", {"max_age": 86400})
+        expired = base_cache.CacheEntry(now - 100, "pol_id", {"max_age": 10})
+        negative = base_cache.negative_entry(now)
+
+        cache = utils.create_cache("internal", opts)
+        await cache.setup()
+        await cache.set("fresh1", fresh)
+        await cache.set("expired", expired)
+        await cache.set("negative", negative)
+        await cache.set("fresh2", fresh)
+        await cache.set_proactive_fetch_ts(123)
+        await asyncio.sleep(0.3)
+        assert os.path.exists(opts["snapshot_file"])
+        await cache.set("fresh3", fresh)
+        await cache.teardown()
+        # Temporary file is private to process and gone after write
+        assert os.listdir(path) == ["snapshot"]
+
+        cache = utils.create_cache("internal", dict(opts, cache_size=3))
+        await cache.setup()
+        try:
+            token, items = await cache.scan(None, 10)
+            assert items == [("negative", negative), ("fresh2", fresh), ("fresh3", fresh)]
+            assert await cache.get_proactive_fetch_ts() == 123
+        finally:
+            await cache.teardown()
+
+        # Broken snapshot is ignored
+        with open(opts["snapshot_file"], "w") as snapshot:
+            snapshot.write("garbage")
+        cache = utils.create_cache("internal", opts)
+        await cache.setup()
+        assert await cache.get("fresh2") is None
+        await cache.teardown()
+
+class FakeRedisPipeline:
+    def __init__(self, pool):
+        self._pool = pool
+        self._keys = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    def zrevrange(self, key, start, stop, withscores=False):
+        self._keys.append((key.decode('utf-8'), []))
+
+    def get(self, key):
+        self._keys.append((key.decode('utf-8'), None))
+
+    async def execute(self):
+        self._pool.round_trips += 1
+        return [self._pool.data.get(key, missing) for key, missing in self._keys]
+
+
+class FakeRedisPool:
+    def __init__(self, data):
+        self.data = data
+        self.round_trips = 0
+
+    async def scan(self, cursor, count):
+        self.round_trips += 1
+        keys = sorted(self.data) + ['_metadata']
+        return 0, [key.encode('utf-8') for key in keys]
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+@pytest.mark.asyncio
+async def test_redis_scan_fetches_page_at_once():
+    from postfix_mta_sts_resolver import redis_cache
+    cache = redis_cache.RedisCache(url="redis://127.0.0.1/0", scan_count=10)
+    data = {"test%d" % n: [(redis_cache.pack_entry(
+        base_cache.CacheEntry(n, "pol_id", {"n": n})), n)] for n in range(5)}
+    data["gone"] = []
+    cache._pool = FakeRedisPool(data)
+    token, items = await cache.scan(None, 1000)
+    assert token is None
+    assert items == [("test%d" % n, base_cache.CacheEntry(n, "pol_id", {"n": n}))
+                     for n in range(5)]
+    assert cache._pool.round_trips == 2
+
+@pytest.mark.parametrize("migrate,round_trips", [(True, 2), (False, 1)])
+@pytest.mark.asyncio
+async def test_redis_v2_miss_round_trips(migrate, round_trips):
+    from postfix_mta_sts_resolver import redis_cache
+    cache = redis_cache.RedisCache(url="redis://127.0.0.1/0", format=2, migrate=migrate)
+    stored = base_cache.CacheEntry(1, "pol_id", {"n": 1})
+    cache._pool = FakeRedisPool({"sts:test": redis_cache.pack_entry_v2(stored)})
+    assert await cache.get_many(["test", "nonexistent"]) == [stored, None]
+    assert cache._pool.round_trips == round_trips
+
+@pytest.mark.parametrize("entry", [
+    base_cache.CacheEntry(1700000000.5, "pol_id", {"mode": "enforce", "max_age": 86400}),
+    base_cache.CacheEntry(1, "", "pol_body"),
+    base_cache.negative_entry(123),
+])
+def test_redis_v2_entry_roundtrip(entry):
+    from postfix_mta_sts_resolver import redis_cache
+    packed = redis_cache.pack_entry_v2(entry)
+    assert redis_cache.unpack_entry_v2(packed) == entry
+
+def test_redis_v2_expiration():
+    from postfix_mta_sts_resolver import redis_cache
+    now = 1000
+    policy = base_cache.CacheEntry(100, "pol_id", {"max_age": 50})
+    assert redis_cache.entry_expire_at(policy, now) == 151
+    assert redis_cache.entry_expire_at(base_cache.negative_entry(900), now, 60) == \
+        now + 60
+    assert redis_cache.entry_expire_at(
+        base_cache.CacheEntry(100, "pol_id", "pol_body"), now) == ''
 
 @pytest.mark.asyncio
 async def test_capped_cache():
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from postfix_mta_sts_resolver.concurrency import AIMDLimiter
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_limiter_aimd():
+    limiter = AIMDLimiter(1, 8, 1)
+    assert limiter.limit == 1
+    # Slow start: limit grows by one per success
+    for _ in range(3):
+        limiter.release(await limiter.acquire(), True)
+    assert limiter.limit == 4
+    limiter.release(await limiter.acquire(), False)
+    assert limiter.limit == 2
+    # Additive increase after first decrease
+    for _ in range(2):
+        limiter.release(await limiter.acquire(), True)
+    assert limiter.limit == 2
+    for _ in range(2):
+        limiter.release(await limiter.acquire(), True)
+    assert limiter.limit == 3
+    # Unknown outcome keeps limit
+    limiter.release(await limiter.acquire())
+    assert limiter.limit == 3
+    stats = limiter.stats()
+    assert stats["limit"] == 3
+    assert stats["active"] == 0
+    assert stats["decreases"] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_limiter_decrease_once_per_round():
+    limiter = AIMDLimiter(1, 8, 1)
+    for _ in range(7):
+        limiter.release(await limiter.acquire(), True)
+    assert limiter.limit == 8
+    tokens = [await limiter.acquire() for _ in range(8)]
+    for token in tokens:
+        limiter.release(token, False)
+    assert limiter.limit == 4
+    limiter.release(await limiter.acquire(), False)
+    assert limiter.limit == 2
+    for _ in range(3):
+        limiter.release(await limiter.acquire(), False)
+    assert limiter.limit == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_limiter_bounds_concurrency():
+    limiter = AIMDLimiter(2, 2, 1)
+    active = 0
+    peak = 0
+
+    async def job():
+        nonlocal active, peak
+        token = await limiter.acquire()
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+        limiter.release(token, True)
+
+    await asyncio.gather(*(job() for _ in range(10)))
+    assert peak == 2
+    assert limiter.stats()["waiting"] == 0
@@ -0,0 +1,81 @@
+import socket
+import time
+
+import pytest
+
+from postfix_mta_sts_resolver.dns_cache import DNSCache
+from postfix_mta_sts_resolver.resolver import CachingHostResolver
+
+def test_dns_cache_ttl():
+    cache = DNSCache()
+    cache.set("a.loc", "TXT", ["x"], 0.1)
+    cache.set("b.loc", "TXT", ["y"], 0)
+    assert cache.get("a.loc", "TXT") == ["x"]
+    assert cache.get("a.loc", "A") is None
+    assert cache.get("b.loc", "TXT") is None
+    time.sleep(0.2)
+    assert cache.get("a.loc", "TXT") is None
+    assert len(cache) == 0
+
+
+def test_dns_cache_max_ttl():
+    cache = DNSCache(max_ttl=0.1)
+    cache.set("a.loc", "TXT", ["x"], 3600)
+    time.sleep(0.2)
+    assert cache.get("a.loc", "TXT") is None
+
+
+def test_dns_cache_lru():
+    cache = DNSCache(size=2)
+    cache.set("a.loc", "A", ["a"], 60)
+    cache.set("b.loc", "A", ["b"], 60)
+    assert cache.get("a.loc", "A") == ["a"]
+    cache.set("c.loc", "A", ["c"], 60)
+    assert cache.get("a.loc", "A") == ["a"]
+    assert cache.get("b.loc", "A") is None
+    assert cache.get("c.loc", "A") == ["c"]
+
+
+class FakeSystemResolver:
+    def __init__(self):
+        self.calls = []
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        self.calls.append(host)
+        return [{"hostname": host, "host": "10.0.0.1", "port": port,
+                 "family": socket.AF_INET, "proto": 0, "flags": socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_host_resolver():
+    calls = []
+
+    async def query(name, qtype):
+        calls.append((name, qtype))
+        if name == "mta-sts.hosts.loc":
+            return []
+        if qtype == 'A':
+            return ["127.0.0.1"]
+        return ["::1"]
+
+    system = FakeSystemResolver()
+    resolver = CachingHostResolver(query, system)
+    hosts = await resolver.resolve("mta-sts.good.loc", 443, socket.AF_INET)
+    assert [(h["host"], h["port"], h["family"]) for h in hosts] == \
+        [("127.0.0.1", 443, socket.AF_INET)]
+    hosts = await resolver.resolve("mta-sts.good.loc", 443, socket.AF_UNSPEC)
+    assert [h["host"] for h in hosts] == ["127.0.0.1", "::1"]
+    assert calls == [("mta-sts.good.loc", "A"),
+                     ("mta-sts.good.loc", "A"),
+                     ("mta-sts.good.loc", "AAAA")]
+    assert system.calls == []
+    # Proxy and other hosts go to system resolver
+    hosts = await resolver.resolve("localhost", 3128, socket.AF_INET)
+    assert [h["host"] for h in hosts] == ["10.0.0.1"]
+    # So do policy hosts not resolved with DNS
+    hosts = await resolver.resolve("mta-sts.hosts.loc", 443, socket.AF_INET)
+    assert [h["host"] for h in hosts] == ["10.0.0.1"]
+    assert system.calls == ["localhost", "mta-sts.hosts.loc"]
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from postfix_mta_sts_resolver.fetch_backoff import FetchBackoff
+from postfix_mta_sts_resolver.resolver import STSFetchResult
+from postfix_mta_sts_resolver.base_cache import CacheEntry
+import postfix_mta_sts_resolver.utils as utils
+
+from testdata import POLICY
+
+
+def test_backoff_delays():
+    backoff = FetchBackoff(1, 5)
+    assert not backoff.blocked("good.loc")
+    assert [backoff.failure("good.loc") for _ in range(5)] == [1, 2, 4, 5, 5]
+    assert backoff.blocked("good.loc")
+    assert not backoff.blocked("other.loc")
+    assert backoff.stats() == {"domains": 1, "blocked": 1}
+    backoff.success("good.loc")
+    assert not backoff.blocked("good.loc")
+    assert backoff.stats() == {"domains": 0, "blocked": 0}
+
+
+def test_backoff_expires():
+    backoff = FetchBackoff(0.1, 1)
+    backoff.failure("good.loc")
+    assert backoff.blocked("good.loc")
+    time.sleep(0.2)
+    assert not backoff.blocked("good.loc")
+    # Failure count persists until success
+    assert backoff.failure("good.loc") == 0.2
+
+
+def test_backoff_table_limit():
+    backoff = FetchBackoff(10, 10, size=2)
+    for domain in ("a.loc", "b.loc", "c.loc"):
+        backoff.failure(domain)
+    assert not backoff.blocked("a.loc")
+    assert backoff.blocked("b.loc")
+    assert backoff.blocked("c.loc")
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_responder_backoff(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({"cache_grace": 0})
+    resolver = fake_resolver((STSFetchResult.FETCH_ERROR, None))
+    resp, cache = await make_responder(cfg, resolver)
+    await cache.set("good.loc", CacheEntry(time.time() - 1, "0", POLICY))
+    for _ in range(3):
+        assert await resp.process_request(b'test good.loc') == \
+            b'44:OK secure match=mail.loc servername=hostname,'
+        assert await resp.process_request(b'test bad.loc') == b'9:NOTFOUND ,'
+    assert resolver.calls == 2
+    stats = resp.stats()
+    assert stats["backoff_skipped"] == 4
+    assert stats["backoff_blocked"] == 2
@@ -117,3 +117,43 @@ def test_limit(limit, sample):
     string_reader = stream_reader.next_string()
     with pytest.raises(netstring.TooLong):
         string_reader.read()
+
+@pytest.mark.parametrize("reference,sequence", [
+    pytest.param([[], [], [b'']], [b'0', b':', b','], id="empty"),
+    pytest.param([[], [b'X', b'abc'], [b'ok']], [b'1:', b'X,3:abc,2:', b'ok,'], id="multiple_and_partial"),
+    pytest.param([[], [b'X'], [], [], [], [b'123456789', b'ok']],
+                 [b'1:', b'X,9:123', b'456', b'78', b'9', b',2:ok,'], id="multiple_and_partial2"),
+])
+def test_decoder(reference, sequence):
+    decoder = netstring.Decoder()
+    assert [decoder.feed(chunk) for chunk in sequence] == reference
+    assert not decoder.pending()
+
+@pytest.mark.parametrize("sequence,exc", [
+    pytest.param([b'1:X,', b'a'], netstring.BadLength, id="bad_length"),
+    pytest.param([b'1:X,:'], netstring.BadLength, id="no_length"),
+    pytest.param([b'1:X', b'_'], netstring.BadTerminator, id="bad_terminator"),
+    pytest.param([b'4'], netstring.TooLong, id="too_long"),
+    pytest.param([b'1', b'0:'], netstring.TooLong, id="too_long_partial"),
+])
+def test_decoder_errors(sequence, exc):
+    decoder = netstring.Decoder(3)
+    with pytest.raises(exc):
+        for chunk in sequence:
+            decoder.feed(chunk)
+        if decoder.error is not None:
+            raise decoder.error
+
+def test_decoder_error_after_complete_strings():
+    decoder = netstring.Decoder(1024)
+    assert decoder.feed(b'13:test good.loc,x:garbage,') == [b'test good.loc']
+    assert isinstance(decoder.error, netstring.BadLength)
+    with pytest.raises(netstring.BadLength):
+        decoder.feed(b'1:X,')
+
+def test_decode_yields_strings_before_error():
+    res = []
+    with pytest.raises(netstring.BadLength):
+        for string in netstring.decode(b'1:X,a'):
+            res.append(string)
+    assert res == [b'X']
@@ -4,7 +4,9 @@ import time
 import pytest
 
 from postfix_mta_sts_resolver import base_cache, utils
+from postfix_mta_sts_resolver.internal_cache import InternalLRUCache
 from postfix_mta_sts_resolver.proactive_fetcher import STSProactiveFetcher
+from postfix_mta_sts_resolver.resolver import STSFetchResult
 
 from postfix_mta_sts_resolver.utils import populate_cfg_defaults, create_cache
 
@@ -119,3 +121,59 @@ async def test_respect_previous_proactive_fetch_ts(event_loop, cache):
     assert result == init_record  # no update
 
     await pf.stop()
+
+
+class WriteCountingCache(InternalLRUCache):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    async def set(self, key, value):
+        self.writes.append("set")
+        await super().set(key, value)
+
+    async def touch(self, key, ts):
+        self.writes.append("touch")
+        await super().touch(key, ts)
+
+    async def set_many(self, items):
+        self.writes.append(("set_many", len(items)))
+        await super().set_many(items)
+
+    async def touch_many(self, items):
+        self.writes.append(("touch_many", len(items)))
+        for key, ts in items:
+            await super().touch(key, ts)
+
+
+def changing_answer(domain):
+    if domain.startswith("changed"):
+        return STSFetchResult.VALID, ("2", {"mode": "none", "max_age": 86400})
+    return STSFetchResult.NOT_CHANGED, None
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_interval_writes_batched(fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    cfg['proactive_policy_fetching']['concurrency_limit'] = 10
+    cache = WriteCountingCache()
+    await cache.setup()
+    entry = base_cache.CacheEntry(0, "1", {"mode": "none", "max_age": 86400})
+    for n in range(150):
+        await cache.set("changed%d.loc" % n, entry)
+        await cache.set("same%d.loc" % n, entry)
+    cache.writes.clear()
+
+    pf = STSProactiveFetcher(cfg, asyncio.get_event_loop(), cache,
+                             fake_resolver(changing_answer))
+    await pf.iterate_domains()
+
+    assert "set" not in cache.writes
+    assert "touch" not in cache.writes
+    assert sum(count for _, count in cache.writes) == 300
+    assert len(cache.writes) <= 6
+    for n in range(150):
+        assert (await cache.get("changed%d.loc" % n)).pol_id == "2"
+        assert (await cache.get("same%d.loc" % n)).ts > 0
+    await cache.teardown()
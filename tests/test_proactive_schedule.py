@@ -0,0 +1,154 @@
+import asyncio
+import time
+
+import pytest
+
+from postfix_mta_sts_resolver import base_cache, constants, utils
+from postfix_mta_sts_resolver.proactive_fetcher import STSProactiveFetcher
+from postfix_mta_sts_resolver.resolver import STSFetchResult
+
+from testdata import policy
+
+NOT_CHANGED = (STSFetchResult.NOT_CHANGED, None)
+
+UPDATED = (STSFetchResult.VALID, ("2", policy(86400)))
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_deadline_schedule(fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    cfg['proactive_policy_fetching']['enabled'] = True
+    cfg['proactive_policy_fetching']['schedule'] = 'deadline'
+    cfg['proactive_policy_fetching']['grace_ratio'] = 2.0
+    cfg['shutdown_timeout'] = 1
+    cache = utils.create_cache(cfg['cache']['type'],
+                               cfg['cache']['options'])
+    await cache.setup()
+    ts = time.time()
+    await cache.set("short.loc", base_cache.CacheEntry(ts - 1, "1", policy(2)))
+    await cache.set("long.loc", base_cache.CacheEntry(ts, "1", policy(86400)))
+    await cache.set("none.loc", base_cache.negative_entry(ts))
+
+    resolver = fake_resolver(NOT_CHANGED)
+    pf = STSProactiveFetcher(cfg, asyncio.get_event_loop(), cache, resolver)
+    await pf.start()
+    try:
+        # short.loc is due right away and then every second
+        await asyncio.sleep(2.5)
+        assert resolver.domain_calls["short.loc"] >= 2
+        assert resolver.domain_calls["long.loc"] == 0
+        assert resolver.domain_calls["none.loc"] == 0
+        assert time.time() - (await cache.get("short.loc")).ts < 1.5
+        assert (await cache.get("long.loc")).ts == ts
+    finally:
+        await pf.stop()
+        await cache.teardown()
+
+
+def test_unknown_schedule(fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    cfg['proactive_policy_fetching']['schedule'] = 'weekly'
+    with pytest.raises(NotImplementedError):
+        STSProactiveFetcher(cfg, None, None, fake_resolver())
+
+
+def flaky_answer(domain):
+    if domain == "broken.loc":
+        raise RuntimeError("resolver failure")
+    return UPDATED
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_refresh_scheduled_failures(fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    cache = utils.create_cache(cfg['cache']['type'],
+                               cfg['cache']['options'])
+    await cache.setup()
+    ts = time.time()
+    domains = ["broken.loc", "slow.loc", "fast.loc"]
+    for domain in domains:
+        await cache.set(domain, base_cache.CacheEntry(ts - 10, "1", policy(2)))
+    resolver = fake_resolver(flaky_answer, delays={"slow.loc": 0.1})
+    pf = STSProactiveFetcher(cfg, asyncio.get_event_loop(), cache, resolver)
+    schedule = []
+    done = []
+    await pf.refresh_scheduled(domains, schedule, done.append)
+    # Domains are put back as soon as their fetch completes
+    assert done == ["broken.loc", "fast.loc", "slow.loc"]
+    assert (await cache.get("fast.loc")).pol_id == "2"
+    assert (await cache.get("slow.loc")).pol_id == "2"
+    assert (await cache.get("broken.loc")).pol_id == "1"
+    deadlines = dict((domain, deadline) for deadline, domain in schedule)
+    assert len(schedule) == 3
+    assert deadlines["broken.loc"] >= ts + constants.PROACTIVE_FETCH_RETRY_DELAY
+    await cache.teardown()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_rebuild_skips_domains_in_flight(fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    cfg['proactive_policy_fetching']['enabled'] = True
+    cfg['proactive_policy_fetching']['schedule'] = 'deadline'
+    cfg['proactive_policy_fetching']['interval'] = 0.3
+    cfg['shutdown_timeout'] = 1
+    cache = utils.create_cache(cfg['cache']['type'],
+                               cfg['cache']['options'])
+    await cache.setup()
+    await cache.set("slow.loc", base_cache.CacheEntry(time.time() - 10, "1", policy(2)))
+    resolver = fake_resolver(UPDATED, delay=1.5)
+    pf = STSProactiveFetcher(cfg, asyncio.get_event_loop(), cache, resolver)
+    await pf.start()
+    try:
+        # Schedule is rebuilt several times while slow.loc is refreshed
+        await asyncio.sleep(2.5)
+        assert resolver.domain_calls["slow.loc"] == 1
+        assert (await cache.get("slow.loc")).pol_id == "2"
+    finally:
+        await pf.stop()
+        await cache.teardown()
+
+
+def gone_answer(domain):
+    if domain == "down.loc":
+        return STSFetchResult.FETCH_ERROR, None
+    return STSFetchResult.NONE, None
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_refresh_scheduled_backoff_and_drop(fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    cache = utils.create_cache(cfg['cache']['type'],
+                               cfg['cache']['options'])
+    await cache.setup()
+    ts = time.time()
+    # Policy of gone.loc expired, policy of going.loc is still valid
+    await cache.set("gone.loc", base_cache.CacheEntry(ts - 10, "1", policy(2)))
+    await cache.set("going.loc", base_cache.CacheEntry(ts - 10, "1", policy(20)))
+    await cache.set("down.loc", base_cache.CacheEntry(ts - 10, "1", policy(2)))
+    pf = STSProactiveFetcher(cfg, asyncio.get_event_loop(), cache,
+                             fake_resolver(gone_answer))
+    schedule = []
+    done = []
+    await pf.refresh_scheduled(["gone.loc", "going.loc", "down.loc"], schedule, done.append)
+    assert sorted(done) == ["down.loc", "going.loc", "gone.loc"]
+    deadlines = dict((domain, deadline) for deadline, domain in schedule)
+    assert sorted(deadlines) == ["down.loc", "going.loc"]
+    assert (await cache.get("gone.loc")).negative
+    assert (await cache.get("going.loc")).pol_id == "1"
+
+    # Delay grows with every failure
+    first_delay = deadlines["down.loc"] - ts
+    schedule.clear()
+    await pf.refresh_scheduled(["down.loc"], schedule, done.append)
+    assert schedule[0][0] - ts >= 2 * first_delay - 1
+
+    # Rebuilt schedule keeps backoff of failing domains
+    rebuilt = dict((domain, deadline) for deadline, domain in await pf.build_schedule())
+    assert "gone.loc" not in rebuilt
+    assert rebuilt["down.loc"] == schedule[0][0]
+    assert rebuilt["going.loc"] == deadlines["going.loc"]
+    await cache.teardown()
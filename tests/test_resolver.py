@@ -1,3 +1,4 @@
+import asyncio
 import collections.abc
 import contextlib
 import os
@@ -102,3 +103,57 @@ async def test_proxy_negative(event_loop):
     status, body = await resolver.resolve("good.loc")
     assert status is FR.FETCH_ERROR
     assert body is None
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_session_reuse():
+    resolver = Resolver(loop=None, timeout=1)
+    session = resolver._get_session()
+    assert resolver._get_session() is session
+    other = Resolver(loop=None)
+    assert other._get_session() is not session
+    await other.close()
+    await resolver.close()
+    assert session.closed
+    assert resolver._get_session() is not session
+    await resolver.close()
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_concurrent_resolves_deduplicated():
+    resolver = Resolver(loop=None, timeout=1)
+    calls = []
+
+    async def slow_resolve(domain, last_known_id, timeout):
+        calls.append((domain, last_known_id, timeout))
+        await asyncio.sleep(0.2)
+        return FR.NONE, None
+
+    resolver._resolve = slow_resolve
+    results = await asyncio.gather(resolver.resolve("a.loc", timeout=3),
+                                   resolver.resolve("a.loc", timeout=5),
+                                   resolver.resolve("a.loc", "1"),
+                                   resolver.resolve("b.loc"))
+    assert results == [(FR.NONE, None)] * 4
+    assert calls == [("a.loc", None, 3), ("a.loc", "1", 1), ("b.loc", None, 1)]
+    await resolver.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_shared_resolve_respects_caller_timeout():
+    resolver = Resolver(loop=None, timeout=1)
+    calls = []
+
+    async def slow_resolve(domain, last_known_id, timeout):
+        calls.append((domain, last_known_id, timeout))
+        await asyncio.sleep(0.5)
+        return FR.NONE, None
+
+    resolver._resolve = slow_resolve
+    results = await asyncio.gather(resolver.resolve("a.loc", timeout=3),
+                                   resolver.resolve("a.loc", timeout=0.1),
+                                   resolver.resolve("a.loc", timeout=5))
+    assert results == [(FR.NONE, None), (FR.FETCH_ERROR, None), (FR.NONE, None)]
+    assert calls == [("a.loc", None, 3)]
+    await resolver.close()
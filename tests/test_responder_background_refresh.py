@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import pytest
+
+from postfix_mta_sts_resolver import responder
+from postfix_mta_sts_resolver.resolver import STSFetchResult
+from postfix_mta_sts_resolver.base_cache import CacheEntry
+import postfix_mta_sts_resolver.utils as utils
+
+from testdata import policy, UPDATED_POLICY
+
+POLICY = policy(100)
+
+UPDATED = (STSFetchResult.VALID, ("2", dict(UPDATED_POLICY, max_age=100)))
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_stale_while_revalidate(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({
+        "cache_grace": 10,
+        "background_refresh": {"stale_while_revalidate": True},
+    })
+    resolver = fake_resolver(UPDATED, delay=0.5)
+    resp, cache = await make_responder(cfg, resolver)
+    await cache.set("good.loc", CacheEntry(time.time() - 20, "1", POLICY))
+    for _ in range(3):
+        assert await resp.process_request(b'test good.loc') == \
+            b'44:OK secure match=mail.loc servername=hostname,'
+    assert resp.stats()["refreshing"] == 1
+    await asyncio.sleep(1)
+    assert resolver.calls == 1
+    assert resp.stats()["background_refreshes"] == 1
+    assert resp.stats()["refreshing"] == 0
+    assert await resp.process_request(b'test good.loc') == \
+        b'42:OK secure match=mx.loc servername=hostname,'
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_expired_policy_not_served(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({
+        "background_refresh": {"stale_while_revalidate": True},
+    })
+    resolver = fake_resolver(UPDATED, delay=0.5)
+    resp, cache = await make_responder(cfg, resolver)
+    await cache.set("good.loc", CacheEntry(time.time() - 200, "1", POLICY))
+    assert await resp.process_request(b'test good.loc') == \
+        b'42:OK secure match=mx.loc servername=hostname,'
+    assert resolver.calls == 1
+    assert resp.stats()["background_refreshes"] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_refresh_ahead(monkeypatch, make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({
+        "cache_grace": 1000,
+        "background_refresh": {"refresh_ahead": 0.5},
+    })
+    resolver = fake_resolver(UPDATED, delay=0.5)
+    resp, cache = await make_responder(cfg, resolver)
+    await cache.set("early.loc", CacheEntry(time.time() - 10, "1", POLICY))
+    await cache.set("late.loc", CacheEntry(time.time() - 90, "1", POLICY))
+    monkeypatch.setattr(responder.random, "random", lambda: 0.5)
+    assert await resp.process_request(b'test early.loc') == \
+        b'44:OK secure match=mail.loc servername=hostname,'
+    assert await resp.process_request(b'test late.loc') == \
+        b'44:OK secure match=mail.loc servername=hostname,'
+    await asyncio.sleep(1)
+    assert resolver.calls == 1
+    assert (await cache.get("early.loc")).pol_id == "1"
+    assert (await cache.get("late.loc")).pol_id == "2"
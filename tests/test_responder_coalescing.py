@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+import postfix_mta_sts_resolver.utils as utils
+
+from testdata import POLICY_ID
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_concurrent_lookups_coalesced(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    resolver = fake_resolver(delay=0.5)
+    resp, cache = await make_responder(cfg, resolver)
+    answers = await asyncio.gather(*(resp.process_request(b'test good.loc')
+                                     for _ in range(10)))
+    assert len(set(answers)) == 1
+    assert answers[0] == b'44:OK secure match=mail.loc servername=hostname,'
+    assert resolver.calls == 1
+    stats = resp.stats()
+    assert stats["requests"] == 10
+    assert stats["lookups"] == 1
+    assert stats["coalesced"] == 9
+    assert stats["inflight"] == 0
+    assert (await cache.get("good.loc")).pol_id == POLICY_ID
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_cancelled_waiter_does_not_cancel_lookup(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    resolver = fake_resolver(delay=0.5)
+    resp, _ = await make_responder(cfg, resolver)
+    first = asyncio.ensure_future(resp.process_request(b'test good.loc'))
+    second = asyncio.ensure_future(resp.process_request(b'test good.loc'))
+    await asyncio.sleep(0.1)
+    first.cancel()
+    assert await second == b'44:OK secure match=mail.loc servername=hostname,'
+    assert resolver.calls == 1
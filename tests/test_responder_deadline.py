@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import pytest
+
+from postfix_mta_sts_resolver.resolver import STSFetchResult
+from postfix_mta_sts_resolver.base_cache import CacheEntry
+from postfix_mta_sts_resolver.internal_cache import InternalLRUCache
+import postfix_mta_sts_resolver.utils as utils
+
+from testdata import POLICY, UPDATED_POLICY
+
+UPDATED = (STSFetchResult.VALID, ("2", UPDATED_POLICY))
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_deadline_cached_policy(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({
+        "cache_grace": 0,
+        "default_zone": {"response_deadline": 0.2},
+    })
+    resolver = fake_resolver(UPDATED, delay=1)
+    resp, cache = await make_responder(cfg, resolver)
+    await cache.set("good.loc", CacheEntry(time.time() - 1, "1", POLICY))
+    start = time.time()
+    assert await resp.process_request(b'test good.loc') == \
+        b'44:OK secure match=mail.loc servername=hostname,'
+    assert time.time() - start < 0.5
+    assert resp.stats()["deadline_expired"] == 1
+    await asyncio.sleep(1.5)
+    assert resolver.calls == 1
+    assert (await cache.get("good.loc")).pol_id == "2"
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_deadline_no_cached_policy(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({
+        "default_zone": {"response_deadline": 0.2},
+    })
+    resolver = fake_resolver(UPDATED, delay=1)
+    resp, _ = await make_responder(cfg, resolver)
+    assert await resp.process_request(b'test good.loc') == b'9:NOTFOUND ,'
+    await asyncio.sleep(1.5)
+    assert resolver.calls == 1
+    assert await resp.process_request(b'test good.loc') == \
+        b'42:OK secure match=mx.loc servername=hostname,'
+    assert resolver.calls == 1
+
+
+class SlowCache(InternalLRUCache):
+    """ Remote-like cache: slow reads, nothing readable without I/O """
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get_nowait(self, key):
+        return None
+
+    async def get(self, key):
+        self.reads += 1
+        await asyncio.sleep(1)
+        return await super().get(key)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_deadline_slow_cache(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({
+        "cache_grace": 0,
+        "default_zone": {"response_deadline": 0.2},
+    })
+    cache = SlowCache()
+    await cache.set("good.loc", CacheEntry(time.time() - 1, "1", POLICY))
+    resp, _ = await make_responder(cfg, fake_resolver(UPDATED, delay=1), cache)
+    start = time.time()
+    assert await resp.process_request(b'test good.loc') == b'9:NOTFOUND ,'
+    assert time.time() - start < 0.5
+    assert cache.reads == 1
+    # Entry already read by lookup in progress is used as fallback
+    await asyncio.sleep(1)
+    start = time.time()
+    assert await resp.process_request(b'test good.loc') == \
+        b'44:OK secure match=mail.loc servername=hostname,'
+    assert time.time() - start < 0.5
+    assert cache.reads == 1
+    await asyncio.sleep(1)
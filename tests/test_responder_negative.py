@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+from postfix_mta_sts_resolver.resolver import STSFetchResult
+from postfix_mta_sts_resolver.base_cache import CacheEntry
+import postfix_mta_sts_resolver.utils as utils
+
+from testdata import POLICY
+
+NO_POLICY = (STSFetchResult.NONE, None)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_negative_cache_hit(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults(None)
+    resolver = fake_resolver(NO_POLICY)
+    resp, cache = await make_responder(cfg, resolver)
+    for _ in range(3):
+        assert await resp.process_request(b'test no-record.loc') == b'9:NOTFOUND ,'
+    assert resolver.calls == 1
+    assert (await cache.get("no-record.loc")).negative
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_negative_cache_disabled(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({"negative_cache_ttl": 0})
+    resolver = fake_resolver(NO_POLICY)
+    resp, cache = await make_responder(cfg, resolver)
+    for _ in range(3):
+        assert await resp.process_request(b'test no-record.loc') == b'9:NOTFOUND ,'
+    assert resolver.calls == 3
+    assert await cache.get("no-record.loc") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_unexpired_policy_kept(make_responder, fake_resolver):
+    cfg = utils.populate_cfg_defaults({"cache_grace": 0})
+    resolver = fake_resolver(NO_POLICY)
+    resp, cache = await make_responder(cfg, resolver)
+    entry = CacheEntry(time.time() - 1, "0", POLICY)
+    await cache.set("no-record.loc", entry)
+    assert await resp.process_request(b'test no-record.loc') == \
+        b'44:OK secure match=mail.loc servername=hostname,'
+    assert resolver.calls == 1
+    assert await cache.get("no-record.loc") == entry
@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+
+from postfix_mta_sts_resolver import netstring
+from postfix_mta_sts_resolver.socketmap import SocketmapProtocol
+from postfix_mta_sts_resolver.resolver import STSFetchResult
+import postfix_mta_sts_resolver.utils as utils
+
+from testdata import POLICY, POLICY_ID
+
+
+def answer(domain):
+    if domain.startswith("none"):
+        return STSFetchResult.NONE, None
+    return STSFetchResult.VALID, (POLICY_ID, POLICY)
+
+
+@pytest.fixture
+def start_responder(make_responder, fake_resolver):
+    async def start(port, delays):
+        cfg = utils.populate_cfg_defaults(None)
+        cfg["port"] = port
+        cfg["shutdown_timeout"] = 1
+        resolver = fake_resolver(answer, delays=delays)
+        resp, _ = await make_responder(cfg, resolver)
+        await resp.start()
+        return resp, resolver, cfg
+
+    return start
+
+
+async def read_answers(reader, count):
+    stream_reader = netstring.StreamReader()
+    answers = []
+    for _ in range(count):
+        string_reader = stream_reader.next_string()
+        res = b''
+        while True:
+            try:
+                part = string_reader.read()
+            except netstring.WantRead:
+                data = await reader.read(4096)
+                assert data
+                stream_reader.feed(data)
+            else:
+                if not part:
+                    break
+                res += part
+        answers.append(res)
+    return answers
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_pipelined_answers_keep_order(start_responder):
+    resp, resolver, cfg = await start_responder(38471, {"slow.loc": 0.3})
+    try:
+        reader, writer = await asyncio.open_connection(cfg['host'], cfg['port'])
+        writer.write(b''.join(netstring.encode(req) for req in (
+            b'test slow.loc', b'test none.loc', b'test .parent.loc', b'test fast.loc')))
+        answers = await read_answers(reader, 4)
+        assert answers == [b'OK secure match=mail.loc servername=hostname',
+                           b'NOTFOUND ',
+                           b'NOTFOUND ',
+                           b'OK secure match=mail.loc servername=hostname']
+        # Cached entries are served right away
+        writer.write(netstring.encode(b'test slow.loc') + netstring.encode(b'test none.loc'))
+        assert await read_answers(reader, 2) == [
+            b'OK secure match=mail.loc servername=hostname', b'NOTFOUND ']
+        assert resolver.calls == 3
+        stats = resp.stats()
+        assert stats["immediate"] == 2
+        assert stats["lookups"] == 3
+        writer.close()
+    finally:
+        await resp.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_bad_netstring_closes_connection(start_responder):
+    resp, _, cfg = await start_responder(38472, {})
+    try:
+        reader, writer = await asyncio.open_connection(cfg['host'], cfg['port'])
+        writer.write(netstring.encode(b'test good.loc') + b'x:garbage,')
+        assert await read_answers(reader, 1) == [
+            b'OK secure match=mail.loc servername=hostname']
+        assert await reader.read() == b''
+        writer.close()
+    finally:
+        await resp.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_stop_sends_pending_answers(start_responder):
+    resp, _, cfg = await start_responder(38473, {"slow.loc": 0.3})
+    reader, writer = await asyncio.open_connection(cfg['host'], cfg['port'])
+    writer.write(netstring.encode(b'test slow.loc'))
+    await writer.drain()
+    await asyncio.sleep(0.1)
+    await resp.stop()
+    assert await read_answers(reader, 1) == [
+        b'OK secure match=mail.loc servername=hostname']
+    assert await reader.read() == b''
+    writer.close()
+
+
+class RecordingTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+        self.closed = False
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def writelines(self, list_of_data):
+        self.writes.append(list(list_of_data))
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+class EchoResponder:
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    def connection_made(self, conn):
+        pass
+
+    def connection_lost(self, conn):
+        pass
+
+    def answer_now(self, raw_req):
+        return None
+
+    async def process_request(self, raw_req):
+        await self.release.wait()
+        return netstring.encode(raw_req)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_ready_responses_written_together():
+    transport = RecordingTransport()
+    responder = EchoResponder()
+    proto = SocketmapProtocol(responder)
+    proto.connection_made(transport)
+    proto.data_received(netstring.encode(b'a') + netstring.encode(b'b'))
+    proto.data_received(netstring.encode(b'c'))
+    proto.eof_received()
+    await asyncio.sleep(0.1)
+    assert transport.writes == []
+    responder.release.set()
+    await asyncio.sleep(0.1)
+    assert transport.writes == [[b'1:a,', b'1:b,', b'1:c,']]
+    assert transport.closed
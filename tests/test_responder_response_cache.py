@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from postfix_mta_sts_resolver.responder import STSSocketmapResponder
+from postfix_mta_sts_resolver.base_cache import CacheEntry
+import postfix_mta_sts_resolver.utils as utils
+
+POLICY = {
+    "version": "STSv1",
+    "mode": "enforce",
+    "mx": ["mail.loc"],
+    "max_age": 86400,
+}
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_encoded_responses_memoized():
+    cfg = utils.populate_cfg_defaults({"zones": {"tlsrpt": {"tlsrpt": True}}})
+    cache = utils.create_cache(cfg['cache']['type'],
+                               cfg['cache']['options'])
+    resp = STSSocketmapResponder(cfg, asyncio.get_event_loop(), cache)
+    try:
+        default_zone = resp._default_zone
+        tlsrpt_zone = resp._zones["tlsrpt"]
+        entry = CacheEntry(0, "1", POLICY)
+
+        answer = resp.format_response("good.loc", default_zone, entry)
+        assert answer == b'44:OK secure match=mail.loc servername=hostname,'
+        assert resp.format_response("good.loc", default_zone, entry) is answer
+        assert resp.format_response("good.loc", default_zone,
+                                    entry._replace(ts=100)) is answer
+
+        report = resp.format_response("good.loc", tlsrpt_zone, entry)
+        assert b'policy_domain=good.loc' in report
+        assert resp.format_response("good.loc", tlsrpt_zone, entry) is report
+        assert resp.format_response("other.loc", tlsrpt_zone, entry) is not report
+
+        # New policy id replaces all responses memoized for domain
+        changed = CacheEntry(100, "2", dict(POLICY, mx=["mx.loc"]))
+        assert (resp.format_response("good.loc", default_zone, changed) ==
+                b'42:OK secure match=mx.loc servername=hostname,')
+        assert resp.format_response("good.loc", tlsrpt_zone, changed) != report
+    finally:
+        await resp._resolver.close()
@@ -0,0 +1,128 @@
+import asyncio
+import tempfile
+import time
+
+import pytest
+
+import postfix_mta_sts_resolver.utils as utils
+from postfix_mta_sts_resolver.base_cache import CacheEntry
+from postfix_mta_sts_resolver.internal_cache import InternalLRUCache
+from postfix_mta_sts_resolver.tiered_cache import TieredCache
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_hits(counting_cache):
+    backend = counting_cache()
+    cache = TieredCache(backend, 10, 60)
+    await cache.setup()
+    entry = CacheEntry(1, "pol_id", {"mode": "none"})
+    try:
+        await backend.set("remote.loc", entry)
+        for _ in range(3):
+            assert await cache.get("remote.loc") == entry
+        assert await cache.get("nonexistent.loc") is None
+        assert backend.reads == 2
+        await cache.set("local.loc", entry)
+        assert await backend.get("local.loc") == entry
+        assert await cache.get_many(["local.loc", "remote.loc", "other.loc"]) == \
+            [entry, entry, None]
+        await cache.touch("local.loc", 5)
+        assert (await cache.get("local.loc")).ts == 5
+        assert (await backend.get("local.loc")).ts == 5
+        stats = cache.stats()
+        assert stats["l1_hits"] == 5
+        assert stats["l1_misses"] == 3
+        assert stats["l2_hits"] == 1
+        assert stats["l2_misses"] == 2
+        assert stats["l2_hit_ratio"] == pytest.approx(1 / 3)
+    finally:
+        await cache.teardown()
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_expiration_and_invalidation():
+    backend = InternalLRUCache()
+    cache = TieredCache(backend, 1, 0.1)
+    old = CacheEntry(1, "old", {})
+    new = CacheEntry(2, "new", {})
+    await cache.set("test.loc", old)
+    await backend.set("test.loc", new)
+    assert await cache.get("test.loc") == old
+    time.sleep(0.2)
+    assert await cache.get("test.loc") == new
+    await backend.set("test.loc", old)
+    cache.invalidate("test.loc")
+    assert await cache.get("test.loc") == old
+    # Size limit
+    await cache.set("other.loc", new)
+    await backend.set("test.loc", new)
+    assert await cache.get("test.loc") == new
+
+
+@pytest.mark.asyncio
+async def test_create_tiered_cache():
+    cfg = utils.populate_cfg_defaults({"cache": {"memory_tier": {"enabled": True}}})
+    assert isinstance(utils.create_cache("internal", {}, cfg["cache"]["memory_tier"]),
+                      InternalLRUCache)
+    with tempfile.NamedTemporaryFile() as tmpfile:
+        cache = utils.create_cache("sqlite", {"filename": tmpfile.name},
+                                   cfg["cache"]["memory_tier"])
+        assert isinstance(cache, TieredCache)
+        await cache.setup()
+        await cache.teardown()
+
+
+class BusCache(InternalLRUCache):
+    """ Shared backend which delivers published messages to all subscribers """
+    def __init__(self):
+        super().__init__()
+        self.subscribers = []
+
+    async def publish(self, channel, messages):
+        for subscribed, callback in self.subscribers:
+            if subscribed == channel:
+                for message in messages:
+                    callback(message)
+
+    async def subscribe(self, channel, callback):
+        self.subscribers.append((channel, callback))
+        return True
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_invalidation_bus():
+    backend = BusCache()
+    node1 = TieredCache(backend, 10, 3600, "chan")
+    node2 = TieredCache(backend, 10, 3600, "chan")
+    await node1.setup()
+    await node2.setup()
+    old = CacheEntry(1, "old", {})
+    new = CacheEntry(2, "new", {})
+    await node1.set("test.loc", old)
+    assert await node2.get("test.loc") == old
+    await node1.set_many([("test.loc", new)])
+    # Announcement is sent in background
+    await asyncio.sleep(0)
+    assert await node2.get("test.loc") == new
+    assert node2.stats()["invalidations"] == 1
+    assert node1.stats()["invalidations"] == 0
+    # Same entry announced again keeps memory copy
+    await node2.set("test.loc", new)
+    await asyncio.sleep(0)
+    assert node1.get_nowait("test.loc") == new
+    # Possibly lost announcements drop everything
+    node1._on_message(None)
+    assert node1.get_nowait("test.loc") is None
+    node1._on_message("garbage")
+    node1._on_message("5")
+    node1._on_message('{"key": "test.loc"}')
+    await node1.teardown()
+    await node2.teardown()
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_invalidation_unsupported():
+    cache = TieredCache(InternalLRUCache(), 10, 60, "chan")
+    await cache.setup()
+    await cache.set("test.loc", CacheEntry(1, "pol_id", {}))
+    assert cache._channel is None
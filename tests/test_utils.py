@@ -22,18 +22,29 @@ def test_populate_cfg_defaults(cfg):
     assert isinstance(res['port'], int)
     assert 0 < res['port'] < 65536
     assert isinstance(res['cache_grace'], (int, float))
+    assert isinstance(res['negative_cache_ttl'], (int, float))
+    assert isinstance(res['workers'], int)
+    assert isinstance(res['background_refresh']['stale_while_revalidate'], bool)
+    assert isinstance(res['background_refresh']['refresh_ahead'], (int, float))
     assert isinstance(res['proactive_policy_fetching']['enabled'], bool)
     assert isinstance(res['proactive_policy_fetching']['interval'], int)
     assert isinstance(res['proactive_policy_fetching']['concurrency_limit'], int)
     assert isinstance(res['proactive_policy_fetching']['grace_ratio'], (int, float))
+    assert res['proactive_policy_fetching']['schedule'] in ('interval', 'deadline')
+    assert isinstance(res['proactive_policy_fetching']['adaptive_concurrency'], bool)
+    assert isinstance(res['proactive_policy_fetching']['concurrency_min'], int)
+    assert isinstance(res['proactive_policy_fetching']['latency_target'], (int, float))
     assert isinstance(res['cache'], collections.abc.Mapping)
     assert res['cache']['type'] in ('redis', 'sqlite', 'postgres', 'internal')
+    assert isinstance(res['cache']['memory_tier']['enabled'], bool)
+    assert isinstance(res['cache']['read_batching']['enabled'], bool)
     assert isinstance(res['default_zone'], collections.abc.Mapping)
     assert isinstance(res['zones'], collections.abc.Mapping)
     for zone in list(res['zones'].values()) + [res['default_zone']]:
         assert isinstance(zone, collections.abc.Mapping)
         assert 'timeout' in zone
         assert 'strict_testing' in zone
+        assert 'response_deadline' in zone
 
 def test_empty_config():
     assert utils.load_config('/dev/null') == utils.populate_cfg_defaults(None)
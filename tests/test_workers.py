@@ -0,0 +1,70 @@
+import multiprocessing
+import os
+import signal
+import time
+
+import pytest
+
+from postfix_mta_sts_resolver.workers import WorkerPool
+
+
+def sleeper(seconds, worker_id):
+    time.sleep(seconds)
+
+
+def crasher(worker_id):
+    if worker_id == 0:
+        os._exit(3)
+    time.sleep(30)
+
+
+def stubborn(ready, worker_id):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    ready.set()
+    time.sleep(30)
+
+
+def wait_until(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(.1)
+
+
+@pytest.mark.timeout(30)
+def test_pool_start_stop():
+    pool = WorkerPool(2, sleeper, (30,))
+    pool.start()
+    try:
+        assert pool.alive() == 2
+        pool.send_signal(0)
+    finally:
+        pool.stop(5)
+    assert pool.stats() == {"workers": 2, "alive": 0, "restarts": 0}
+
+
+@pytest.mark.timeout(30)
+def test_pool_restarts_dead_worker():
+    pool = WorkerPool(2, crasher)
+    pool.start()
+    try:
+        def restarted():
+            pool.check()
+            return pool.stats()["restarts"] >= 2
+        wait_until(restarted, 20)
+        assert pool.alive() >= 1
+    finally:
+        pool.stop(5)
+
+
+@pytest.mark.timeout(30)
+def test_pool_kills_stuck_worker():
+    ready = multiprocessing.get_context('spawn').Event()
+    pool = WorkerPool(1, stubborn, (ready,))
+    pool.start()
+    proc = pool._workers[0]
+    assert ready.wait(10)
+    started = time.monotonic()
+    pool.stop(1)
+    assert time.monotonic() - started < 10
+    assert proc.exitcode == -signal.SIGKILL
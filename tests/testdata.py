@@ -2,6 +2,26 @@ import os
 
 TESTDIR = os.path.dirname(os.path.realpath(__file__))
 
+POLICY_ID = "20180907T090909"
+
+POLICY = {
+    "version": "STSv1",
+    "mode": "enforce",
+    "mx": ["mail.loc"],
+    "max_age": 86400,
+}
+
+UPDATED_POLICY = {
+    "version": "STSv1",
+    "mode": "enforce",
+    "mx": ["mx.loc"],
+    "max_age": 86400,
+}
+
+
+def policy(max_age):
+    return dict(POLICY, max_age=max_age)
+
 def load_testdata(dataset_name):
     filename = os.path.join(TESTDIR, dataset_name + '.tsv')
     with open(filename, 'rb') as f: